@@ -1,42 +1,99 @@
 import asyncio
+import copy
+import json
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
 from operator import itemgetter
-from typing import List, Optional, Sequence, Tuple, Union
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional, Sequence, Tuple, Union
 import logging
-from uuid import UUID
+from uuid import UUID, uuid4
+
+if __name__ == "__main__":
+    # Serve through uvicorn's entry point instead of running this module as
+    # the main script: the extraction pool's spawned processes re-run the
+    # main script, and would each build the whole service otherwise.
+    os.execv(
+        sys.executable,
+        [
+            sys.executable, "-m", "uvicorn", "app:app",
+            "--app-dir", os.path.dirname(os.path.realpath(__file__)),
+            "--host", "0.0.0.0", "--port", "8080",
+        ],
+    )
+
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
+from sse_starlette.sse import AppStatus, EventSourceResponse
+from cachetools import TTLCache
+import anyio
 
-from langchain.callbacks.manager import CallbackManagerForRetrieverRun
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_anthropic import ChatAnthropic
-from langchain_community.chat_models import ChatVertexAI
-from langchain_community.document_loaders import AsyncHtmlLoader
-from langchain_community.document_transformers import Html2TextTransformer
-from langchain.retrievers.contextual_compression import ContextualCompressionRetriever
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
-from langchain.retrievers import (
-    ContextualCompressionRetriever,
-    TavilySearchAPIRetriever,
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
 )
-from langchain.retrievers.document_compressors import (
-    EmbeddingsFilter,
-    DocumentCompressorPipeline,
-)
-from langchain.retrievers.kay import KayAiRetriever
-from langchain.retrievers.you import YouRetriever
+from langchain_openai import ChatOpenAI
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
+from langchain_community.retrievers import TavilySearchAPIRetriever
 from langchain.schema import Document
 from langchain.schema.language_model import BaseLanguageModel
 from langchain.schema.messages import AIMessage, HumanMessage
 from langchain.schema.output_parser import StrOutputParser
 from langchain.schema.retriever import BaseRetriever
-from langchain.schema.runnable import ConfigurableField, Runnable, RunnableBranch, RunnableLambda, RunnableMap
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema.runnable import ConfigurableField, Runnable, RunnableBranch, RunnableConfig, RunnableLambda, RunnableMap
+from langchain_core.runnables.config import ensure_config, patch_config
+from langserve.serialization import WellKnownLCSerializer
 from langsmith import Client
+from langsmith.utils import LangSmithError
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+
+from utils.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    ProviderLimits,
+    ProviderThrottled,
+    parse_rates,
+)
+from utils.condense import QuestionCondenser
+from utils.batch import BatchRunner, dumps_line
+from utils.context import ContextPacker, parse_budgets
+from utils.dedup import NearDuplicateFilter
+from utils.early import detach, ranked_prefix_ready, wait_good_enough
+from utils.embeddings import VectorizedEmbeddingsFilter, cached_openai_embeddings
+from utils.feedback import FeedbackQueue
+from utils.extract import ExtractionPool, extract_text
+from utils.fetch import PageFetcher
+from utils.fusion import reciprocal_rank_fusion
+from utils.hedging import CircuitBreaker, HedgedChatModel
+from utils.history import ConversationStore, HistoryWindow
+from utils.logging import configure_logging, TraceContextMiddleware
+from utils.metadata import MetadataClient
+from utils.page_cache import CachedPage, PageCache
+from utils.registry import LazyComponents
+from utils.rerank import HybridReranker
+from utils.search_cache import RedisTier, SearchResultCache
+from utils.semantic_cache import CachedAnswer, SemanticAnswerCache
+from utils.telemetry import registry as metrics_registry
+from utils.vector_index import KAY_INDEXES, LocalFirstRetriever, open_kay_index
+from utils.telemetry import (
+    admission_rejections,
+    admission_wait,
+    provider_throttled,
+    provider_wait,
+    retrieval_late_sources,
+    stage_metrics,
+)
+from utils.tokens import count_tokens
 
 logger = logging.getLogger(__name__)
+# JSON log lines are formatted and written by a background thread
+background_logging = configure_logging()
 
 RESPONSE_TEMPLATE = """\
 You are an expert researcher and writer, tasked with answering any question.
@@ -81,8 +138,111 @@ Follow Up Input: {question}
 Standalone Question:
 """
 
+SUMMARIZE_TEMPLATE = """
+Extend the summary of a conversation with the new lines of it, keeping the facts, names, numbers and open questions a follow-up could refer to. Be concise.
+Current summary: {summary}
+New lines:
+{turns}
+Extended summary:
+"""
+
 client = Client()
+_langsmith_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="langsmith")
+feedback_queue = FeedbackQueue(
+    _langsmith_executor,
+    max_size=int(os.environ.get("FEEDBACK_QUEUE_SIZE", 1000)),
+)
+trace_url_cache = TTLCache(maxsize=4096, ttl=24 * 3600)
 app = FastAPI()
+app.state.ready = False
+_serializer = WellKnownLCSerializer()
+page_fetcher = PageFetcher()
+# Pooled, cached metadata server client for the project id and ID tokens
+metadata_client = MetadataClient()
+# Pages are converted to text in separate processes and cut off at
+# PAGE_TEXT_MAX_CHARS, far more than the context packer keeps per document
+extraction_pool = ExtractionPool(
+    processes=int(os.environ.get("EXTRACT_PROCESSES", 2)),
+    max_chars=int(os.environ.get("PAGE_TEXT_MAX_CHARS", 50_000)),
+)
+page_cache = PageCache(
+    path=os.environ.get("PAGE_CACHE_PATH", "/tmp/page_cache.sqlite3"),
+    ttl=float(os.environ.get("PAGE_CACHE_TTL_SECONDS", 6 * 3600)),
+    max_bytes=int(os.environ.get("PAGE_CACHE_MAX_BYTES", 256 * 2**20)),
+)
+# Shared by every OpenAI model and the embeddings, so the CA bundle is loaded
+# once instead of twice per client and connections are pooled together
+openai_http_clients = {
+    "http_client": DefaultHttpxClient(),
+    "http_async_client": DefaultAsyncHttpxClient(),
+}
+cached_embeddings = cached_openai_embeddings(**openai_http_clients)
+# Local tier for the Kay retrievers, filled by `python -m utils.vector_index`
+# from the chunks Kay returned when the index could not answer
+_kay_tiers = {name: open_kay_index(name, cached_embeddings.namespace) for name in KAY_INDEXES}
+kay_indexes = {name: index for name, (index, _) in _kay_tiers.items()}
+kay_spools = {name: spool for name, (_, spool) in _kay_tiers.items()}
+search_cache = SearchResultCache(
+    max_entries=int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 2048)),
+    max_bytes=int(os.environ.get("SEARCH_CACHE_MAX_BYTES", 64 * 2**20)),
+    ttl=float(os.environ.get("SEARCH_CACHE_TTL_SECONDS", 900)),
+    shared=(
+        RedisTier(os.environ["SEARCH_CACHE_REDIS_URL"])
+        if os.environ.get("SEARCH_CACHE_REDIS_URL")
+        else None
+    ),
+)
+# Per-worker limits: chains running at once, and requests per second to each
+# upstream provider
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get("MAX_CONCURRENT_CHAINS", 32)),
+    max_waiting=int(os.environ.get("ADMISSION_QUEUE_SIZE", 64)),
+    max_wait=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 5)),
+)
+provider_limits = ProviderLimits(
+    parse_rates(
+        os.environ.get(
+            "PROVIDER_RATE_LIMITS",
+            "openai=20,anthropic=5,googlevertex=5,tavily=10,you=10,kay=5,google=10",
+        )
+    ),
+    max_wait=float(os.environ.get("PROVIDER_MAX_WAIT_SECONDS", 10)),
+)
+
+async def _throttle(provider: Optional[str]) -> None:
+    try:
+        waited = await provider_limits.acquire(provider)
+    except ProviderThrottled:
+        provider_throttled.inc(provider=provider)
+        raise
+    if provider_limits.get(provider) is not None:
+        provider_wait.observe(waited, provider=provider)
+
+def _throttle_sync(provider: Optional[str]) -> None:
+    try:
+        waited = provider_limits.wait(provider)
+    except ProviderThrottled:
+        provider_throttled.inc(provider=provider)
+        raise
+    if provider_limits.get(provider) is not None:
+        provider_wait.observe(waited, provider=provider)
+
+def _llm_throttle(provider: Optional[str] = None) -> Runnable:
+    """Passes its input through once the LLM provider's token bucket allows a
+    call; the provider defaults to the request's `llm` alternative"""
+
+    def _provider(config: RunnableConfig) -> str:
+        return provider or config.get("configurable", {}).get("llm", "openai")
+
+    def wait(inputs, config: RunnableConfig):
+        _throttle_sync(_provider(config))
+        return inputs
+
+    async def await_(inputs, config: RunnableConfig):
+        await _throttle(_provider(config))
+        return inputs
+
+    return RunnableLambda(wait, afunc=await_).with_config(run_name="ProviderRateLimit")
 
 app.add_middleware(
     CORSMiddleware,
@@ -90,24 +250,29 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["*"]
-
+    expose_headers=["*"],
+)
+app.add_middleware(TraceContextMiddleware)
 
 
 class ChatRequest(BaseModel):
-    pass
     question: str
     chat_history: List[Tuple[str, str]] = Field(
-        ..., extra={"widget": {"type": "chat", "input": "question", "output": "answer"}}
+        default_factory=list,
+        extra={"widget": {"type": "chat", "input": "question", "output": "answer"}},
     )
-   
-    question: str
-
-from langchain_community.retrievers.google_search import GoogleSearchAPIWrapper
+    # history kept on the server under this id, issued by POST /conversations,
+    # replaces chat_history
+    conversation_id: Optional[str] = Field(None, min_length=1, max_length=128)
 
 class GoogleCustomSearchRetriever(BaseRetriever):
-    search: Optional[GoogleSearchAPIWrapper] = None
+    # a GoogleSearchAPIWrapper, created on first use
+    search: Optional[Any] = None
     num_search_results: int = 6
+    # stop waiting for pages once this many top-ranked ones are ready, or
+    # once `soft_deadline` seconds have passed; None waits for every page
+    min_documents: Optional[int] = None
+    soft_deadline: Optional[float] = None
 
     def clean_search_query(self, query: str) -> str:
         if query[0].isdigit():
@@ -123,84 +288,504 @@ class GoogleCustomSearchRetriever(BaseRetriever):
         result = self.search.results(query_clean, num_search_results)
         return result
 
+    def _ensure_search(self):
+        if self.search is None:
+            from langchain_community.utilities import GoogleSearchAPIWrapper
+
+            self.search = GoogleSearchAPIWrapper()
+        return self.search
+
+    def _ranked_links(self, search_results: List[dict]) -> List[Tuple[str, dict]]:
+        return [(res["link"], res) for res in search_results if res.get("link", None)]
+
+    def _to_document(
+        self, url: str, text: str, title: Optional[str], result: dict
+    ) -> Document:
+        metadata = {"source": url}
+        if result.get("title", None) or title:
+            metadata["title"] = result.get("title", None) or title
+        return Document(page_content=text, metadata=metadata)
+
     def _get_relevant_documents(
         self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ):
-        if os.environ.get("GOOGLE_API_KEY", None) is None:
-            self.search = GoogleSearchAPIWrapper()  # Replace with the appropriate initialization of GoogleSearchAPIWrappervided")
-        if self.search is None:
-            self.search = GoogleSearchAPIWrapper()
-        urls_to_look = []
+        self._ensure_search()
         search_results = self.search_tool(query, self.num_search_results)
-        for res in search_results:
-            if res.get("link", None):
-                urls_to_look.append(res["link"])
-        loader = AsyncHtmlLoader(urls_to_look)
-        html2text = Html2TextTransformer()
-        docs = loader.load()
-        docs = list(html2text.transform_documents(docs))
-        for i in range(len(docs)):
-            if search_results[i].get("title", None):
-                docs[i].metadata["title"] = search_results[i]["title"]
+        links = self._ranked_links(search_results)
+        cached = {url: page_cache.get(url) for url, _ in links}
+        to_load = [
+            url for url, page in cached.items()
+            if page is None or not page.is_fresh(page_cache.ttl)
+        ]
+        loaded = {}
+        if to_load:
+            from langchain_community.document_loaders import AsyncHtmlLoader
+
+            loaded = dict(zip(to_load, AsyncHtmlLoader(to_load).load()))
+        docs = []
+        for url, result in links:
+            if url in loaded:
+                if not loaded[url].page_content:
+                    continue
+                text, title = extract_text(
+                    loaded[url].page_content, extraction_pool.max_chars
+                )
+                if not text:
+                    continue
+                doc = self._to_document(url, text, title, result)
+                page_cache.put(url, doc.page_content, title=doc.metadata.get("title"))
+                docs.append(doc)
+            elif cached[url] is not None:
+                docs.append(self._from_cache(url, cached[url]))
         return docs
 
+    def _from_cache(self, url: str, page: CachedPage) -> Document:
+        metadata = {"source": url}
+        if page.title:
+            metadata["title"] = page.title
+        return Document(page_content=page.text, metadata=metadata)
+
+    async def _load_document(self, url: str, result: dict) -> Optional[Document]:
+        """Serves a page from the page cache, revalidating stale entries with
+        a conditional request, and fetches and converts it on a miss. The
+        cache is read and written from a thread, since another worker may
+        hold its file's lock."""
+        cached = await asyncio.to_thread(page_cache.get, url)
+        if cached is not None and cached.is_fresh(page_cache.ttl):
+            return self._from_cache(url, cached)
+        headers = cached.revalidation_headers() if cached is not None else None
+        page = await page_fetcher.fetch(url, headers=headers)
+        if page is None:
+            return self._from_cache(url, cached) if cached is not None else None
+        if page.status == 304 and cached is not None:
+            await asyncio.to_thread(page_cache.mark_revalidated, url)
+            return self._from_cache(url, cached)
+        if page.status >= 400 or not page.text:
+            return None
+        text, title = await extraction_pool.extract(page.text)
+        if not text:
+            return None
+        doc = self._to_document(url, text, title, result)
+        await asyncio.to_thread(
+            page_cache.put,
+            url,
+            doc.page_content,
+            title=doc.metadata.get("title"),
+            etag=page.headers.get("etag"),
+            last_modified=page.headers.get("last-modified"),
+        )
+        return doc
+
+    def _from_snippet(self, url: str, result: dict) -> Optional[Document]:
+        if not result.get("snippet", None):
+            return None
+        doc = self._to_document(url, result["snippet"], None, result)
+        doc.metadata["snippet_only"] = True
+        return doc
+
+    async def aiter_documents(self, query: str) -> AsyncIterator[Document]:
+        """Yields documents in search-rank order, each as soon as it and every
+        higher-ranked page have finished downloading. Pages are fetched
+        concurrently over the shared connection pool.
+
+        With `min_documents` set, pages still loading once the top ones are
+        ready (or at the soft deadline) are not waited for: they are yielded
+        last as their search snippets, marked `snippet_only`, and keep
+        loading in the background to fill the page cache."""
+        self._ensure_search()
+        search_results = await _arun(self.search_tool, query, self.num_search_results)
+        links = self._ranked_links(search_results)
+        tasks = [
+            asyncio.ensure_future(self._load_document(url, result))
+            for url, result in links
+        ]
+        if self.min_documents:
+            await wait_good_enough(
+                tasks,
+                self.soft_deadline,
+                ranked_prefix_ready(tasks, self.min_documents),
+            )
+        late, detached = [], set()
+        try:
+            for task, (url, result) in zip(tasks, links):
+                if self.min_documents and not task.done():
+                    late.append(self._from_snippet(url, result))
+                    detached.add(detach(task))
+                    continue
+                doc = await task
+                if doc is not None:
+                    yield doc
+            if late:
+                retrieval_late_sources.inc(len(late), retriever="google")
+            for doc in late:
+                if doc is not None:
+                    yield doc
+        finally:
+            for task in tasks:
+                if task not in detached:
+                    task.cancel()
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [doc async for doc in self.aiter_documents(query)]
+
+
+class EnsembleSearchRetriever(BaseRetriever):
+    """Queries several retrievers concurrently and fuses their results with
+    reciprocal-rank fusion. Providers that miss their deadline are dropped.
+
+    With `soft_deadline` set, providers still searching that many seconds
+    in are left out of the fusion once at least one has answered; they
+    finish in the background so their results reach the search cache."""
+
+    retrievers: Dict[str, BaseRetriever]
+    timeouts: Dict[str, float] = {}
+    default_timeout: float = 4.0
+    soft_deadline: Optional[float] = None
+    k: int = 6
+
+    def _timeout_for(self, name: str) -> float:
+        return self.timeouts.get(name, self.default_timeout)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        executor = ThreadPoolExecutor(max_workers=len(self.retrievers))
+        futures = {
+            name: executor.submit(
+                retriever.invoke,
+                query,
+                {"callbacks": run_manager.get_child(f"ensemble:{name}")},
+            )
+            for name, retriever in self.retrievers.items()
+        }
+        started = time.monotonic()
+        results = []
+        for name, future in futures.items():
+            remaining = self._timeout_for(name) - (time.monotonic() - started)
+            try:
+                results.append(future.result(timeout=max(remaining, 0)))
+            except FuturesTimeoutError:
+                logger.warning("Ensemble retriever %s missed its deadline", name)
+            except Exception as e:
+                logger.warning("Ensemble retriever %s failed: %s", name, e)
+        executor.shutdown(wait=False, cancel_futures=True)
+        return reciprocal_rank_fusion(results, limit=self.k)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        async def _search(name: str, retriever: BaseRetriever) -> List[Document]:
+            try:
+                return await asyncio.wait_for(
+                    retriever.ainvoke(
+                        query, {"callbacks": run_manager.get_child(f"ensemble:{name}")}
+                    ),
+                    timeout=self._timeout_for(name),
+                )
+            except asyncio.TimeoutError:
+                logger.warning("Ensemble retriever %s missed its deadline", name)
+            except Exception as e:
+                logger.warning("Ensemble retriever %s failed: %s", name, e)
+            return []
+
+        tasks = {
+            name: asyncio.ensure_future(_search(name, retriever))
+            for name, retriever in self.retrievers.items()
+        }
+        await wait_good_enough(list(tasks.values()), self.soft_deadline)
+        results = []
+        for name, task in tasks.items():
+            if task.done():
+                results.append(task.result())
+            else:
+                logger.info("Ensemble retriever %s is late, answering without it", name)
+                retrieval_late_sources.inc(retriever=f"ensemble:{name}")
+                detach(task)
+        return reciprocal_rank_fusion(results, limit=self.k)
+
+
+class CachedRetriever(BaseRetriever):
+    """Serves a retriever's results from the shared search-result cache, keyed
+    on the normalized query and the name of the retriever alternative."""
+
+    retriever: BaseRetriever
+    namespace: str
+    cache: SearchResultCache
+    # token bucket consulted before calling the provider on a cache miss
+    provider: Optional[str] = None
+
+    @staticmethod
+    def _dump(docs: List[Document]) -> List[dict]:
+        return [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]
+
+    @staticmethod
+    def _complete(payload: List[dict]) -> bool:
+        # snippets standing in for pages that were still loading would
+        # outlive the pages, which the page cache has by the next request
+        return bool(payload) and not any(
+            d["metadata"].get("snippet_only") for d in payload
+        )
+
+    @staticmethod
+    def _load(payload: List[dict]) -> List[Document]:
+        return [
+            Document(page_content=d["page_content"], metadata=copy.deepcopy(d["metadata"]))
+            for d in payload
+        ]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        def _search() -> List[dict]:
+            _throttle_sync(self.provider)
+            docs = self.retriever.invoke(query, {"callbacks": run_manager.get_child()})
+            return self._dump(docs)
+
+        payload = self.cache.get_or_compute(
+            self.cache.key(self.namespace, query), _search, self._complete
+        )
+        return self._load(payload)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        async def _search() -> List[dict]:
+            await _throttle(self.provider)
+            docs = await self.retriever.ainvoke(
+                query, {"callbacks": run_manager.get_child()}
+            )
+            return self._dump(docs)
+
+        payload = await self.cache.aget_or_compute(
+            self.cache.key(self.namespace, query), _search, self._complete
+        )
+        return self._load(payload)
+
+
+class RefinedRetriever(BaseRetriever):
+    """Collapses near-duplicates in another retriever's results, then reranks
+    the rest against the standalone question it searched for. The inner
+    retriever gets the caller's config, so configurable alternatives still
+    apply."""
+
+    retriever: Runnable
+    deduplicator: Optional[NearDuplicateFilter] = None
+    reranker: Optional[HybridReranker] = None
+
+    def invoke(
+        self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> List[Document]:
+        return super().invoke(input, config, search_config=ensure_config(config), **kwargs)
+
+    async def ainvoke(
+        self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> List[Document]:
+        return await super().ainvoke(
+            input, config, search_config=ensure_config(config), **kwargs
+        )
+
+    def _deduplicate(self, docs: List[Document]) -> List[Document]:
+        return docs if self.deduplicator is None else self.deduplicator.deduplicate(docs)
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        search_config: RunnableConfig,
+    ) -> List[Document]:
+        docs = self._deduplicate(
+            self.retriever.invoke(
+                query, patch_config(search_config, callbacks=run_manager.get_child())
+            )
+        )
+        return docs if self.reranker is None else self.reranker.rerank(docs, query)
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        search_config: RunnableConfig,
+    ) -> List[Document]:
+        docs = self._deduplicate(
+            await self.retriever.ainvoke(
+                query, patch_config(search_config, callbacks=run_manager.get_child())
+            )
+        )
+        if self.reranker is None:
+            return docs
+        return await self.reranker.arerank(docs, query)
+
+
+components = LazyComponents()
+# On the Google and ensemble paths synthesis starts once the top sources are
+# in or the deadline has passed, rather than after the slowest page; 0 waits
+early_min_sources = int(os.environ.get("EARLY_SYNTHESIS_MIN_SOURCES", 3)) or None
+early_deadline = (
+    float(os.environ.get("EARLY_SYNTHESIS_DEADLINE_SECONDS", 1.5))
+    if early_min_sources
+    else None
+)
 
 def get_retriever():
-    embeddings = OpenAIEmbeddings()
-    splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=20)
-    relevance_filter = EmbeddingsFilter(embeddings=embeddings, similarity_threshold=0.8)
-    pipeline_compressor = DocumentCompressorPipeline(
-        transformers=[splitter, relevance_filter]
-    )
-    base_tavily_retriever = TavilySearchAPIRetriever(
-        k=6, include_raw_content=True, include_images=False
-    )
-    # Use the base retriever directly if ContextualCompressionRetriever is not available
-    tavily_retriever = base_tavily_retriever
-    base_google_retriever = GoogleCustomSearchRetriever()
-    google_retriever = base_google_retriever
-    base_you_retriever = YouRetriever(
-        ydc_api_key=os.environ.get("YDC_API_KEY", "not_provided")
-    )
-    you_retriever = base_you_retriever
-    base_kay_retriever = KayAiRetriever.create(
-        dataset_id="company", data_types=["10-K", "10-Q"], num_contexts=6
-    )
-    kay_retriever = base_kay_retriever
-    base_kay_press_release_retriever = KayAiRetriever.create(
-        dataset_id="company", data_types=["PressRelease"], num_contexts=6
-    )
-    kay_press_release_retriever = ContextualCompressionRetriever(
-        base_compressor=pipeline_compressor,
-        base_retriever=base_kay_press_release_retriever,
+    def _cached(
+        namespace: str, retriever: BaseRetriever, provider: Optional[str] = None
+    ) -> BaseRetriever:
+        return CachedRetriever(
+            retriever=retriever,
+            namespace=namespace,
+            cache=search_cache,
+            provider=provider or namespace,
+        )
+
+    # Only the default Tavily retriever is built here; the alternatives are
+    # built, along with their imports, the first time a request selects them
+    tavily_retriever = _cached(
+        "tavily",
+        TavilySearchAPIRetriever(k=6, include_raw_content=True, include_images=False),
     )
+
+    def google_retriever():
+        return _cached(
+            "google",
+            GoogleCustomSearchRetriever(
+                min_documents=early_min_sources,
+                soft_deadline=early_deadline,
+            ),
+        )
+
+    def you_retriever():
+        from langchain_community.retrievers import YouRetriever
+
+        return _cached(
+            "you", YouRetriever(ydc_api_key=os.environ.get("YDC_API_KEY", "not_provided"))
+        )
+
+    def _local_first(name: str, fallback: BaseRetriever) -> BaseRetriever:
+        return LocalFirstRetriever(
+            index=kay_indexes[name],
+            embeddings=cached_embeddings,
+            fallback=fallback,
+            spool=kay_spools[name],
+            name=name,
+            min_score=float(os.environ.get("KAY_INDEX_MIN_SCORE", 0.8)),
+            min_results=int(os.environ.get("KAY_INDEX_MIN_RESULTS", 3)),
+        )
+
+    def kay_retriever():
+        from langchain_community.retrievers import KayAiRetriever
+
+        return _local_first(
+            "kay",
+            _cached(
+                "kay",
+                KayAiRetriever.create(
+                    dataset_id="company", data_types=["10-K", "10-Q"], num_contexts=6
+                ),
+            ),
+        )
+
+    def kay_press_release_retriever():
+        from langchain.retrievers.contextual_compression import (
+            ContextualCompressionRetriever,
+        )
+        from langchain.retrievers.document_compressors import DocumentCompressorPipeline
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        from langchain_community.retrievers import KayAiRetriever
+
+        splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=20)
+        relevance_filter = VectorizedEmbeddingsFilter(
+            embeddings=cached_embeddings, similarity_threshold=0.8
+        )
+        pipeline_compressor = DocumentCompressorPipeline(
+            transformers=[splitter, relevance_filter]
+        )
+        base_kay_press_release_retriever = KayAiRetriever.create(
+            dataset_id="company", data_types=["PressRelease"], num_contexts=6
+        )
+        return _local_first(
+            "kay_press_release",
+            _cached(
+                "kay_press_release",
+                ContextualCompressionRetriever(
+                    base_compressor=pipeline_compressor,
+                    base_retriever=base_kay_press_release_retriever,
+                ),
+                provider="kay",
+            ),
+        )
+
+    def ensemble_retriever():
+        return EnsembleSearchRetriever(
+            retrievers={
+                "tavily": tavily_retriever,
+                "google": components.get("retriever:google"),
+                "you": components.get("retriever:you"),
+            },
+            timeouts={"tavily": 4.0, "google": 6.0, "you": 3.0},
+            soft_deadline=early_deadline,
+        )
+
     return tavily_retriever.configurable_alternatives(
         ConfigurableField(id="retriever"),
         default_key="tavily",
-        google=google_retriever,
-        you=you_retriever,
-        kay=kay_retriever,
-        kay_press_release=kay_press_release_retriever,
+        google=components.register("retriever:google", google_retriever),
+        you=components.register("retriever:you", you_retriever),
+        kay=components.register("retriever:kay", kay_retriever),
+        kay_press_release=components.register(
+            "retriever:kay_press_release", kay_press_release_retriever
+        ),
+        ensemble=components.register("retriever:ensemble", ensemble_retriever),
     ).with_config(run_name="FinalSourceRetriever")
 
 def create_retriever_chain(
-    llm: BaseLanguageModel, retriever: BaseRetriever
+    llm: BaseLanguageModel,
+    retriever: BaseRetriever,
+    condense_llm: Optional[BaseLanguageModel] = None,
+    deduplicator: Optional[NearDuplicateFilter] = None,
+    reranker: Optional[HybridReranker] = None,
 ) -> Runnable:
+    if deduplicator is not None or reranker is not None:
+        # the refined documents take over the FinalSourceRetriever name, so
+        # clients get the same sources, in the same order, as the prompt
+        retriever = RefinedRetriever(
+            retriever=retriever.with_config(run_name="SearchRetriever"),
+            deduplicator=deduplicator,
+            reranker=reranker,
+        ).with_config(run_name="FinalSourceRetriever")
     CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(REPHRASE_TEMPLATE)
     condense_question_chain = (
-        CONDENSE_QUESTION_PROMPT | llm | StrOutputParser()
+        CONDENSE_QUESTION_PROMPT
+        | _llm_throttle("openai" if condense_llm is not None else None)
+        | (condense_llm or llm)
+        | StrOutputParser()
     ).with_config(run_name="CondenseQuestion")
-    conversation_chain = condense_question_chain | retriever
-    return RunnableBranch(
-        RunnableLambda(lambda x: bool(x.get("chat_history"))).with_config(
-            run_name="HasChatHistoryCheck"
-        ),
-        conversation_chain.with_config(run_name="RetrievalChainWithHistory"),
-        RunnableLambda(itemgetter("question")).with_config(
-            run_name="Itemgetter:question"
+    condenser = QuestionCondenser(
+        condense_question_chain,
+        timeout=float(os.environ.get("CONDENSE_TIMEOUT_SECONDS", 2.0)),
+    )
+    conversation_chain = (
+        RunnableLambda(condenser.condense, afunc=condenser.acondense).with_config(
+            run_name="CondenseQuestionFastPath"
         )
         | retriever
-        .with_config(run_name="RetrievalChainWithNoHistory"),
+    )
+    return RunnableBranch(
+        (
+            RunnableLambda(lambda x: bool(x.get("chat_history"))).with_config(
+                run_name="HasChatHistoryCheck"
+            ),
+            conversation_chain.with_config(run_name="RetrievalChainWithHistory"),
+        ),
+        (
+            RunnableLambda(itemgetter("question")).with_config(
+                run_name="Itemgetter:question"
+            )
+            | retriever
+        ).with_config(run_name="RetrievalChainWithNoHistory"),
     ).with_config(run_name="RouteDependingOnChatHistory")
 
 def serialize_history(request: ChatRequest):
@@ -213,54 +798,78 @@ def serialize_history(request: ChatRequest):
             converted_chat_history.append(AIMessage(content=message[1]))
     return converted_chat_history
 
+def format_docs(docs: Sequence[Document]) -> str:
     formatted_docs = []
-    # Add indented block of code here Remove the unused variable 'i'ument]) -> str:
-    formatted_docs = []
-    for i, doc in enumerate(docs):
+    for doc in docs:
         doc_string = f"{doc.page_content}"
         formatted_docs.append(doc_string)
     return "\n".join(formatted_docs)
 
 def create_chain(
-    retriever_chain = create_retriever_chain(llm, retriever) | RunnableLambda()
+    llm: BaseLanguageModel,
+    retriever: BaseRetriever,
+    condense_llm: Optional[BaseLanguageModel] = None,
+    context_packer: Optional[ContextPacker] = None,
+    history_window: Optional[HistoryWindow] = None,
+    deduplicator: Optional[NearDuplicateFilter] = None,
+    reranker: Optional[HybridReranker] = None,
 ) -> Runnable:
-    retriever_chain = create_retriever_chain(llm, retriever) | RunnableLambda()
+    retriever_chain = create_retriever_chain(
+        llm,
+        retriever,
+        condense_llm=condense_llm,
+        deduplicator=deduplicator,
+        reranker=reranker,
+    )
+    if context_packer is None:
+        retriever_chain = retriever_chain | RunnableLambda(format_docs).with_config(
+            run_name="FormatDocumentChunks"
+        )
+    else:
+
+        def pack_docs(inputs: dict, config: RunnableConfig) -> str:
+            budget = context_packer.budget_for(config.get("configurable", {}).get("llm"))
+            return format_docs(
+                context_packer.pack(inputs["docs"], inputs["question"], budget)
+            )
+
+        retriever_chain = RunnableMap(
+            {"docs": retriever_chain, "question": itemgetter("question")}
+        ) | RunnableLambda(pack_docs).with_config(run_name="FormatDocumentChunks")
     _context = RunnableMap(
-        context=retriever_chain.with_config(run_name="RetrievalChain"),
-        question=RunnableLambda(itemgetter("question")).with_config(
-            run_name="Itemgetter:question"
-        ),
-        chat_history=RunnableLambda(itemgetter("chat_history")).with_config(
-            run_name="Itemgetter:chat_history"
-        ),
-    ),
-    run_name="Itemgetter:chat_history"
-)
+        {
+            "context": retriever_chain.with_config(run_name="RetrievalChain"),
+            "question": RunnableLambda(itemgetter("question")).with_config(
+                run_name="Itemgetter:question"
+            ),
+            "chat_history": RunnableLambda(itemgetter("chat_history")).with_config(
+                run_name="Itemgetter:chat_history"
+            ),
+        }
+    )
     prompt = ChatPromptTemplate.from_messages(
-        ("system", RESPONSE_TEMPLATE),
-        MessagesPlaceholder(variable_name="chat_history"),
-    response_synthesizer = (prompt | llm | StrOutputParser()).with_config()
+        [
+            ("system", RESPONSE_TEMPLATE),
+            MessagesPlaceholder(variable_name="chat_history"),
+            ("human", "{question}"),
+        ]
     ).partial(current_date=datetime.now().isoformat())
-    response_synthesizer = (prompt | llm | StrOutputParser()).with_config()
-    RunnableMap(
-        context=retriever_chain.with_config(run_name="RetrievalChain"),
-        question=RunnableLambda(itemgetter("question")).with_config(
-        chat_history=RunnableLambda(serialize_history).with_config(
-            run_name="SerializeHistory"
-        ),
-        ),
-        chat_history=RunnableLambda(itemgetter("chat_history")).with_config(
-            run_name="Itemgetter:chat_history"
-        ),
+    response_synthesizer = (prompt | _llm_throttle() | llm | StrOutputParser()).with_config(
+        run_name="GenerateResponse",
     )
-            run_name="Itemgetter:question"
-        ),
-        chat_history=RunnableLambda(serialize_history).with_config(
-            run_name="SerializeHistory"
-        | _context | response_synthesizer)
-    ) | _context | response_synthe| _context | response_synthesizer)zer   ),
-        | _context | response_s   ),
-        | _context | response_synthesizer)
+    return (
+        {
+            "question": RunnableLambda(itemgetter("question")).with_config(
+                run_name="Itemgetter:question"
+            ),
+            "chat_history": (
+                RunnableLambda(serialize_history)
+                if history_window is None
+                else RunnableLambda(history_window.window, afunc=history_window.awindow)
+            ).with_config(run_name="SerializeHistory"),
+        }
+        | _context
+        | response_synthesizer
     )
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -269,59 +878,459 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = (
 )
 has_google_creds = os.path.isfile(os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
 
-llm = ChatOpenAI(
+def anthropic_llm():
+    from langchain_anthropic import ChatAnthropic
+
+    return ChatAnthropic(
+        model="claude-3-opus-20240229",
+        max_tokens=16384,
+        temperature=0.1,
+        anthropic_api_key=os.environ.get("ANTHROPIC_API_KEY", "not_provided"),
+    )
+
+def googlevertex_llm():
+    from langchain_community.chat_models import ChatVertexAI
+
+    return ChatVertexAI(
+        model_name="chat-bison-32k",
+        temperature=0.1,
+        max_output_tokens=8192,
+        stream=True,
+    )
+
+llm_alternatives = {"anthropic": components.register("llm:anthropic", anthropic_llm)}
+if has_google_creds:
+    llm_alternatives["googlevertex"] = components.register(
+        "llm:googlevertex", googlevertex_llm
+    )
+
+openai_llm = ChatOpenAI(
     model="gpt-4o",
     # model="gpt-4",
     streaming=True,
     temperature=0.1,
-).configurable_alternatives(
+    **openai_http_clients,
+)
+
+# `llm=hedged` streams from HEDGE_PRIMARY, hedging to the backups when the
+# first token is slow and failing over when a provider errors or its
+# circuit breaker is open
+llm_breakers = {
+    name: CircuitBreaker(
+        name,
+        failure_rate=float(os.environ.get("BREAKER_FAILURE_RATE", 0.5)),
+        slow_after=float(os.environ.get("BREAKER_SLOW_SECONDS", 10)),
+        cooldown=float(os.environ.get("BREAKER_COOLDOWN_SECONDS", 30)),
+    )
+    for name in ["openai", *llm_alternatives]
+}
+
+def hedged_llm():
+    return HedgedChatModel(
+        primary=os.environ.get("HEDGE_PRIMARY", "openai"),
+        backups=os.environ.get("HEDGE_BACKUPS", "anthropic,googlevertex").split(","),
+        models={"openai": openai_llm, **llm_alternatives},
+        hedge_after=float(os.environ.get("HEDGE_AFTER_SECONDS", 2)),
+        breakers=llm_breakers,
+        acquire=_throttle,
+        acquire_sync=_throttle_sync,
+    )
+
+llm = openai_llm.configurable_alternatives(
     ConfigurableField(id="llm"),
     default_key="openai",
-    anthropic=ChatAnthropic(
-        model="claude-3-opus-20240229",
-        max_tokens=16384,
-        temperature=0.1,
-        anthropic_api_key=os.environ.get("ANTHROPIC_API_KEY", "not_provided"),
+    hedged=components.register("llm:hedged", hedged_llm),
+    **llm_alternatives,
+)
+
+condense_llm = ChatOpenAI(
+    model=os.environ.get("CONDENSE_MODEL", "gpt-4o-mini"),
+    temperature=0,
+    **openai_http_clients,
+)
+
+# Older turns of long conversations are summarized by the condense model
+history_window = HistoryWindow(
+    (
+        PromptTemplate.from_template(SUMMARIZE_TEMPLATE)
+        | _llm_throttle("openai")
+        | condense_llm
+        | StrOutputParser()
+    ).with_config(run_name="SummarizeHistory"),
+    max_tokens=int(os.environ.get("HISTORY_MAX_TOKENS", 2000)),
+    timeout=float(os.environ.get("HISTORY_SUMMARY_TIMEOUT_SECONDS", 2.0)),
+)
+conversation_store = ConversationStore(
+    path=os.environ.get("CONVERSATION_STORE_PATH", "/tmp/conversations.sqlite3"),
+    ttl=float(os.environ.get("CONVERSATION_TTL_SECONDS", 24 * 3600)),
+    max_turns=int(os.environ.get("CONVERSATION_MAX_TURNS", 200)),
+)
+
+context_packer = ContextPacker(
+    budgets=parse_budgets(
+        os.environ.get(
+            "CONTEXT_TOKEN_BUDGETS",
+            "openai=6000,anthropic=8000,googlevertex=6000,hedged=6000",
+        )
     ),
+    max_doc_tokens=int(os.environ.get("CONTEXT_MAX_DOC_TOKENS", 1500)),
 )
 
-if has_google_creds:
-    llm = ChatOpenAI(
-        model="gpt-4o",
-        # model="gpt-4",
-        streaming=True,
-        temperature=0.1,
-    ).configurable_alternatives(
-        ConfigurableField(id="llm"),
-        default_key="openai",
-        anthropic=ChatAnthropic(
-            model="claude-3-opus-20240229",
-            max_tokens=16384,
-            temperature=0.1,
-            anthropic_api_key=os.environ.get("ANTHROPIC_API_KEY", "not_provided"),
-        ),
-        googlevertex=ChatVertexAI(
-            model_name="chat-bison-32k",
-            temperature=0.1,
-            max_output_tokens=8192,
-            stream=True,
-        ),
+# Syndicated copies of an article are sent to the LLM once
+deduplicator = (
+    NearDuplicateFilter(
+        max_distance=int(os.environ.get("DEDUP_MAX_DISTANCE", 3)),
+        containment=float(os.environ.get("DEDUP_CONTAINMENT", 0.5)),
+    )
+    if os.environ.get("DEDUP_ENABLED", "true").lower() == "true"
+    else None
+)
+
+# Only the most relevant retrieved documents are packed into the prompt
+rerank_top_k = int(os.environ.get("RERANK_TOP_K", 4))
+reranker = (
+    HybridReranker(
+        cached_embeddings,
+        top_k=rerank_top_k,
+        bm25_weight=float(os.environ.get("RERANK_BM25_WEIGHT", 0.5)),
+        embedding_timeout=float(os.environ.get("RERANK_EMBEDDING_TIMEOUT_SECONDS", 0.05)),
     )
+    if rerank_top_k
+    else None
+)
 
 retriever = get_retriever()
-chain = create_chain(llm, retriever)
+chain = create_chain(
+    llm,
+    retriever,
+    condense_llm=condense_llm,
+    context_packer=context_packer,
+    history_window=history_window,
+    deduplicator=deduplicator,
+    reranker=reranker,
+)
 
-@app.post("/chat/stream_log")
-async def chat(request: ChatRequest):
-    logger.info(f"Received chat request: {request}")
+
+def _alternatives(runnable: Runnable) -> Tuple[str, ...]:
+    runnable = getattr(runnable, "bound", runnable)
+    return (runnable.default_key, *runnable.alternatives)
+
+
+# The `llm` and `retriever` query parameters only accept registered
+# alternatives, so a bad value gets a 422 before any stream starts
+LLMName = Literal[_alternatives(llm)]
+RetrieverName = Literal[_alternatives(retriever)]
+
+semantic_cache = None
+if os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true":
+    semantic_cache = SemanticAnswerCache(
+        cached_embeddings,
+        threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+        ttl=float(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", 3600)),
+        max_entries=int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 5000)),
+    )
+
+def reopen_after_fork():
+    """Gives a forked worker its own SQLite connections; with a preloading
+    server the chain and caches are built once in the parent. Metrics stay
+    per worker, so each is labelled with the worker's pid."""
+    background_logging.after_fork()
+    metrics_registry.set_const_labels(worker=str(os.getpid()))
+    page_cache.reopen()
+    cached_embeddings.reopen()
+    conversation_store.reopen()
+    for index in kay_indexes.values():
+        index.reopen()
+
+def _warm_up():
+    # load the tokenizer used by the context packer and walk the chain's
+    # configurable fields so the first request doesn't pay for either
+    count_tokens("warm up")
+    chain.config_specs
+
+def _request_config(
+    llm: Optional[str] = None,
+    retriever: Optional[str] = None,
+    trace_header: Optional[str] = None,
+) -> dict:
+    configurable = {}
+    if llm:
+        configurable["llm"] = llm
+    if retriever:
+        configurable["retriever"] = retriever
+    metadata = {}
+    if trace_header:
+        metadata["cloud_trace_context"] = trace_header
+    return {
+        "configurable": configurable,
+        "callbacks": [stage_metrics],
+        "metadata": metadata,
+    }
+
+def _cache_namespace(config: Optional[dict]) -> str:
+    configurable = (config or {}).get("configurable", {})
+    return f"{configurable.get('llm', 'openai')}:{configurable.get('retriever', 'tavily')}"
+
+def _cached_answer_ops(cached: CachedAnswer) -> List[dict]:
+    """Replays a cached answer as the same patch sequence astream_log produces"""
+    now = datetime.now().isoformat()
+    return [
+        {
+            "op": "replace",
+            "path": "",
+            "value": {
+                "id": str(uuid4()),
+                "name": "SemanticAnswerCache",
+                "type": "chain",
+                "streamed_output": [],
+                "final_output": None,
+                "logs": {},
+            },
+        },
+        {
+            "op": "add",
+            "path": "/logs/FinalSourceRetriever",
+            "value": {
+                "id": str(uuid4()),
+                "name": "FinalSourceRetriever",
+                "type": "retriever",
+                "tags": ["semantic_cache"],
+                "metadata": {"similarity": cached.similarity},
+                "start_time": now,
+                "streamed_output": [],
+                "streamed_output_str": [],
+                "final_output": {"documents": cached.sources},
+                "end_time": now,
+            },
+        },
+        {"op": "add", "path": "/streamed_output/-", "value": cached.answer},
+        {"op": "replace", "path": "/final_output", "value": cached.answer},
+    ]
+
+def _answer_ops(ops: List[dict], final_only: bool) -> List[dict]:
+    if not final_only:
+        return ops
+    return [op for op in ops if op["path"] == "/streamed_output/-"]
+
+async def _remember_turn(request: ChatRequest, answer: str) -> None:
+    if request.conversation_id and answer:
+        await conversation_store.aappend(
+            request.conversation_id, [("human", request.question), ("ai", answer)]
+        )
+
+async def _stream_chat_log(
+    request: ChatRequest, final_only: bool = False, config: Optional[dict] = None
+) -> AsyncIterator[dict]:
+    """Yields server-sent events carrying JSON-patch ops, in the same shape as
+    langserve's stream_log. Retrieved sources are emitted as soon as the
+    FinalSourceRetriever run finishes, followed by the answer tokens.
+    First-turn questions may be answered from the semantic cache instead.
+    With a `conversation_id`, the stored history is used and the new turn is
+    appended to it once the answer is complete."""
     try:
-        logger.info("Invoking the chain with the request data...")
-        result = await chain.ainvoke(request.dict())
-        logger.info(f"Chain invocation successful. Result: {result}")
-        return result
+        if request.conversation_id:
+            request = request.model_copy(
+                update={"chat_history": await conversation_store.aload(request.conversation_id)}
+            )
+        cache_vector = None
+        if semantic_cache is not None and not request.chat_history:
+            namespace = _cache_namespace(config)
+            try:
+                cached, cache_vector = await semantic_cache.alookup(
+                    request.question, namespace
+                )
+            except Exception as e:
+                logger.warning("Semantic cache lookup failed: %s", e)
+                cached = None
+            if cached is not None:
+                ops = _answer_ops(_cached_answer_ops(cached), final_only)
+                yield {"event": "data", "data": _serializer.dumps({"ops": ops}).decode("utf-8")}
+                await _remember_turn(request, cached.answer)
+                yield {"event": "end"}
+                return
+
+        answer, sources = [], []
+        async for patch in chain.astream_log(
+            request.dict(), config, include_names=["FinalSourceRetriever"]
+        ):
+            for op in patch.ops:
+                if op["path"] == "/streamed_output/-":
+                    answer.append(op["value"])
+                elif op["path"] == "/logs/FinalSourceRetriever/final_output":
+                    sources = op["value"].get("documents", [])
+            ops = _answer_ops(patch.ops, final_only)
+            if ops:
+                yield {"event": "data", "data": _serializer.dumps({"ops": ops}).decode("utf-8")}
+
+        if cache_vector is not None:
+            semantic_cache.store(
+                cache_vector, request.question, "".join(answer), sources, namespace
+            )
+        await _remember_turn(request, "".join(answer))
+    except ProviderThrottled as e:
+        logger.warning("Provider rate limit exhausted: %s", e)
+        yield {
+            "event": "error",
+            "data": json.dumps(
+                {
+                    "status_code": 503,
+                    "message": "Service Unavailable",
+                    "retry_after": round(e.retry_after),
+                }
+            ),
+        }
     except Exception as e:
-        logger.exception(f"An error occurred while processing the chat request: {str(e)}")
-        return {"error": "An internal server error occurred. Please try again later.", "code": 500}
+        logger.exception("An error occurred while streaming the chat response: %s", e)
+        yield {
+            "event": "error",
+            "data": json.dumps({"status_code": 500, "message": "Internal Server Error"}),
+        }
+    yield {"event": "end"}
+
+def _release_once():
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            admission.release()
+
+    return release
+
+async def _admitted(events: AsyncIterator[dict], release) -> AsyncIterator[dict]:
+    """Holds the request's admission slot until its stream is finished or
+    abandoned"""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        release()
+
+class DrainingEventSourceResponse(EventSourceResponse):
+    """EventSourceResponse that keeps streaming when the server is asked to
+    exit, so in-flight answers finish within the graceful shutdown timeout
+    instead of being cut off"""
+
+    @staticmethod
+    async def listen_for_exit_signal() -> None:
+        await anyio.sleep_forever()
+
+def _conversation_not_found():
+    return JSONResponse({"error": "Conversation not found", "code": 404}, status_code=404)
+
+@app.post("/chat/stream_log")
+async def chat(
+    request: ChatRequest,
+    http_request: Request,
+    final_only: bool = False,
+    llm: Optional[LLMName] = None,
+    retriever: Optional[RetrieverName] = None,
+):
+    logger.info(
+        "Received chat request",
+        extra={
+            "question": request.question,
+            "chat_history_turns": len(request.chat_history),
+            "conversation_id": request.conversation_id,
+            "llm": llm,
+            "retriever": retriever,
+        },
+    )
+    if request.conversation_id and not await conversation_store.aexists(
+        request.conversation_id
+    ):
+        return _conversation_not_found()
+    started = time.perf_counter()
+    try:
+        await admission.acquire()
+    except AdmissionRejected as e:
+        admission_rejections.inc(status=str(e.status_code))
+        logger.warning(
+            "Rejected chat request: %s", e.message, extra={"status_code": e.status_code}
+        )
+        return JSONResponse(
+            {"error": e.message, "code": e.status_code},
+            status_code=e.status_code,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    admission_wait.observe(time.perf_counter() - started)
+    config = _request_config(
+        llm=llm,
+        retriever=retriever,
+        trace_header=http_request.headers.get("X-Cloud-Trace-Context"),
+    )
+    # the background task releases the slot if the stream never started
+    release = _release_once()
+    return DrainingEventSourceResponse(
+        _admitted(_stream_chat_log(request, final_only=final_only, config=config), release),
+        background=BackgroundTask(release),
+    )
+
+
+def _batch_inputs(payload: dict) -> dict:
+    # called by the batch runner in a thread
+    request = ChatRequest(**payload)
+    if request.conversation_id:
+        if not conversation_store.exists(request.conversation_id):
+            raise ValueError("Conversation not found")
+        request = request.model_copy(
+            update={"chat_history": conversation_store.load(request.conversation_id)}
+        )
+    return request.model_dump()
+
+
+def _remember_batch_turn(inputs: dict, answer: str) -> None:
+    # called by the batch runner in a thread
+    if inputs.get("conversation_id") and answer:
+        conversation_store.append(
+            inputs["conversation_id"], [("human", inputs["question"]), ("ai", answer)]
+        )
+
+
+# Retrieval and condense caches are shared with interactive requests, and
+# requests in one batch run independently of each other
+batch_runner = BatchRunner(
+    prepare=_batch_inputs,
+    on_answer=_remember_batch_turn,
+    concurrency=int(os.environ.get("BATCH_MAX_CONCURRENCY", 8)),
+    window=int(os.environ.get("BATCH_WINDOW_SIZE", 64)),
+    admission=admission,
+)
+
+
+@app.post("/chat/batch")
+async def chat_batch(
+    http_request: Request,
+    offset: int = 0,
+    llm: Optional[LLMName] = None,
+    retriever: Optional[RetrieverName] = None,
+):
+    """Answers a JSONL body of ChatRequests, each optionally with an "id",
+    streaming JSONL results back in completion order. Lines before `offset`
+    are skipped, so a batch can resume from its last checkpoint record.
+    Each chain in the batch takes its own admission slot."""
+    logger.info(
+        "Received chat batch",
+        extra={"offset": offset, "llm": llm, "retriever": retriever},
+    )
+    config = _request_config(
+        llm=llm,
+        retriever=retriever,
+        trace_header=http_request.headers.get("X-Cloud-Trace-Context"),
+    )
+    # read up front: the response listens for the client disconnecting
+    # on the same channel the body would be streamed in on
+    body = await http_request.body()
+
+    async def results() -> AsyncIterator[bytes]:
+        async for record in batch_runner.run(
+            chain, body.decode("utf-8").splitlines(), config, offset=offset
+        ):
+            yield dumps_line(record)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 
 class SendFeedbackBody(BaseModel):
     run_id: UUID
@@ -330,22 +1339,38 @@ class SendFeedbackBody(BaseModel):
     feedback_id: Optional[UUID] = None
     comment: Optional[str] = None
 
+def _feedback_queue_full():
+    logger.warning("Feedback queue is full, rejecting feedback")
+    return JSONResponse(
+        {"error": "Too much feedback is pending. Please try again later.", "code": 503},
+        status_code=503,
+    )
+
 @app.post("/feedback")
 async def send_feedback(body: SendFeedbackBody):
-    try:
-        logger.info(f"Received feedback: {body}")
-        client.create_feedback(
-            body.run_id,
-            body.key,
-            score=body.score,
-            comment=body.comment,
-            feedback_id=body.feedback_id,
-        )
-        logger.info("Feedback posted successfully")
-        return {"result": "posted feedback successfully", "code": 200}
-    except Exception as e:
-        logger.exception(f"An error occurred while posting feedback: {str(e)}")
-        return {"error": "An internal server error occurred. Please try again later.", "code": 500}
+    logger.info(
+        "Received feedback for run %s",
+        body.run_id,
+        extra={"key": body.key, "score": body.score, "comment": body.comment},
+    )
+    # the id is fixed before the first attempt so a retried write updates
+    # the same record, and the client can PATCH it
+    feedback_id = body.feedback_id or uuid4()
+    queued = feedback_queue.submit(
+        client.create_feedback,
+        body.run_id,
+        body.key,
+        score=body.score,
+        comment=body.comment,
+        feedback_id=feedback_id,
+    )
+    if not queued:
+        return _feedback_queue_full()
+    return {
+        "result": "posted feedback successfully",
+        "code": 200,
+        "feedback_id": str(feedback_id),
+    }
 
 class UpdateFeedbackBody(BaseModel):
     feedback_id: UUID
@@ -361,31 +1386,107 @@ async def update_feedback(body: UpdateFeedbackBody):
             "result": "No feedback ID provided",
             "code": 400,
         }
-    try:
-        logger.info(f"Updating feedback with ID: {feedback_id}")
-        client.update_feedback(
-            feedback_id,
-            score=body.score,
-            comment=body.comment,
-        )
-        logger.info("Feedback updated successfully")
-        return {"result": "patched feedback successfully", "code": 200}
-    except Exception as e:
-        logger.exception(f"An error occurred while updating feedback: {str(e)}")
-        return {"error": "An internal server error occurred. Please try again later.", "code": 500}
+    logger.info("Updating feedback with ID: %s", feedback_id)
+    queued = feedback_queue.submit(
+        client.update_feedback,
+        feedback_id,
+        score=body.score,
+        comment=body.comment,
+    )
+    if not queued:
+        return _feedback_queue_full()
+    return {"result": "patched feedback successfully", "code": 200}
+
+@app.post("/conversations")
+async def create_conversation():
+    return {
+        "result": "created conversation successfully",
+        "code": 200,
+        "conversation_id": await conversation_store.acreate(),
+    }
+
+@app.delete("/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str):
+    if not await conversation_store.adelete(conversation_id):
+        return _conversation_not_found()
+    return {"result": "deleted conversation successfully", "code": 200}
+
+@app.on_event("startup")
+async def warm_up():
+    await _arun(_warm_up)
+    app.state.ready = True
+    logger.info("Chain is warm, ready to serve")
+
+@app.on_event("startup")
+async def resolve_log_project():
+    # log lines carry the project in their trace field; look it up once from
+    # the metadata server rather than with google.auth.default() in the writer
+    detach(asyncio.ensure_future(background_logging.project.aresolve(metadata_client)))
+
+@app.get("/ready")
+async def ready():
+    if AppStatus.should_exit:
+        return JSONResponse({"status": "draining", "code": 503}, status_code=503)
+    if not app.state.ready:
+        return JSONResponse({"status": "starting", "code": 503}, status_code=503)
+    return {"status": "ready", "code": 200}
+
+@app.on_event("shutdown")
+async def close_page_fetcher():
+    await page_fetcher.close()
+    extraction_pool.shutdown()
+
+@app.on_event("shutdown")
+async def close_metadata_client():
+    await metadata_client.close()
+
+@app.on_event("shutdown")
+async def flush_feedback():
+    await feedback_queue.stop()
 
 async def _arun(func, *args, **kwargs):
     return await asyncio.get_running_loop().run_in_executor(None, func, *args, **kwargs)
 
+async def _arun_langsmith(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_langsmith_executor, func, *args)
+
 async def aget_trace_url(run_id: str) -> str:
+    if run_id in trace_url_cache:
+        return trace_url_cache[run_id]
+    # The run may not have been ingested by LangSmith yet
     for i in range(5):
         try:
-            await _arun(client.read_run, run_id)
-        except Exception:  # Replace langsmith.utils.LangSmithError with the appropriate exception type
-await asyncio.sleep(1**i)
-    if await _arun(client.run_is_shared, run_id):
-        return await _arun(client.read_run_shared_link, run_id)
-    return await _arun(client.share_run, run_id)
+            await _arun_langsmith(client.read_run, run_id)
+            break
+        except LangSmithError:
+            await asyncio.sleep(0.25 * 2**i)
+    if await _arun_langsmith(client.run_is_shared, run_id):
+        trace_url = await _arun_langsmith(client.read_run_shared_link, run_id)
+    else:
+        trace_url = await _arun_langsmith(client.share_run, run_id)
+    trace_url_cache[run_id] = trace_url
+    return trace_url
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(
+        metrics_registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+@app.get("/cache/stats")
+async def cache_stats():
+    stats = {
+        "pages": page_cache.stats(),
+        "search": search_cache.stats(),
+        "embeddings": cached_embeddings.stats(),
+        "history": history_window.stats(),
+        "kay_index": {name: index.stats() for name, index in kay_indexes.items()},
+        "logging": background_logging.stats(),
+        "metadata": metadata_client.stats(),
+    }
+    if semantic_cache is not None:
+        stats["answers"] = semantic_cache.stats()
+    return stats
 
 class GetTraceBody(BaseModel):
     run_id: UUID
@@ -400,15 +1501,10 @@ async def get_trace(body: GetTraceBody):
             "code": 400,
         }
     try:
-        logger.info(f"Getting trace URL for run ID: {run_id}")
+        logger.info("Getting trace URL for run ID: %s", run_id)
         trace_url = await aget_trace_url(str(run_id))
-        logger.info(f"Trace URL retrieved: {trace_url}")
+        logger.info("Trace URL retrieved: %s", trace_url)
         return trace_url
     except Exception as e:
-        logger.exception(f"An error occurred while getting the trace URL: {str(e)}")
+        logger.exception("An error occurred while getting the trace URL: %s", e)
         return {"error": "An internal server error occurred. Please try again later.", "code": 500}
-
-import uvicorn
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
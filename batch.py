@@ -0,0 +1,137 @@
+"""Answers a JSONL file of ChatRequests, one JSON object per line.
+
+    python batch.py questions.jsonl answers.jsonl --concurrency 8
+    python batch.py questions.jsonl answers.jsonl --url https://SERVICE_URL
+
+Results are appended to the output file as they complete, so an
+interrupted run picks up where it left off: requests already answered in
+the output are skipped. Lines without an "id" are given their line number,
+and lines that are not JSON objects are reported under theirs.
+Without `--url` the chain runs in this process, otherwise requests are sent
+to a running service's /chat/batch endpoint."""
+
+import argparse
+import asyncio
+import os
+import sys
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Set
+
+import orjson
+
+
+def answered_ids(path: str) -> Set:
+    """Ids that already have an answer in the output file"""
+    answered = set()
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # a line cut short when the last run stopped
+                if "answer" in record:
+                    answered.add(orjson.dumps(record["id"]))
+    return answered
+
+
+def pending_lines(
+    path: str, answered: Set, rejected: Optional[List[Dict]] = None
+) -> Iterator[str]:
+    """Input lines not answered yet, each with an explicit id. Lines that
+    are not JSON objects cannot carry one, so instead of being sent they are
+    added to `rejected` as error records with their line number."""
+    with open(path, "rb") as f:
+        index = 0
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                request = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                request, error = None, str(e)
+            else:
+                error = "Each line must be a JSON object"
+            if isinstance(request, dict):
+                request.setdefault("id", index)
+                if orjson.dumps(request["id"]) not in answered:
+                    yield orjson.dumps(request).decode("utf-8")
+            elif rejected is not None:
+                rejected.append({"id": index, "error": error, "code": 400})
+            index += 1
+
+
+async def _local_records(
+    lines: Iterator[str], args: argparse.Namespace
+) -> AsyncIterator[dict]:
+    import app as service
+    from utils.batch import BatchRunner
+
+    runner = BatchRunner(
+        prepare=service.batch_runner.prepare,
+        on_answer=service.batch_runner.on_answer,
+        concurrency=args.concurrency,
+        window=args.window,
+    )
+    config = service._request_config(llm=args.llm, retriever=args.retriever)
+    async for record in runner.run(service.chain, lines, config):
+        yield record
+
+
+async def _remote_records(
+    lines: Iterator[str], args: argparse.Namespace
+) -> AsyncIterator[dict]:
+    import httpx
+
+    async def body() -> AsyncIterator[bytes]:
+        for line in lines:
+            yield line.encode("utf-8") + b"\n"
+
+    params = {
+        key: getattr(args, key) for key in ("llm", "retriever") if getattr(args, key)
+    }
+    async with httpx.AsyncClient(timeout=None) as client:
+        async with client.stream(
+            "POST", f"{args.url.rstrip('/')}/chat/batch", params=params, content=body()
+        ) as res:
+            res.raise_for_status()
+            async for line in res.aiter_lines():
+                if line.strip():
+                    yield orjson.loads(line)
+
+
+async def run(args: argparse.Namespace) -> int:
+    rejected: List[Dict] = []
+    lines = pending_lines(args.input, answered_ids(args.output), rejected)
+    records = _remote_records if args.url else _local_records
+    failed = 0
+    with open(args.output, "ab") as out:
+        async for record in records(lines, args):
+            if "checkpoint" in record:
+                continue
+            out.write(orjson.dumps(record) + b"\n")
+            out.flush()
+            failed += "error" in record
+        for record in rejected:
+            out.write(orjson.dumps(record) + b"\n")
+        failed += len(rejected)
+    return failed
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL file of ChatRequests")
+    parser.add_argument("output", help="JSONL file the results are appended to")
+    parser.add_argument("--url", help="base URL of a running service")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--window", type=int, default=64)
+    parser.add_argument("--llm")
+    parser.add_argument("--retriever")
+    args = parser.parse_args(argv)
+    failed = asyncio.run(run(args))
+    if failed:
+        print(f"{failed} requests failed; run again to retry them", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
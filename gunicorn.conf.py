@@ -0,0 +1,29 @@
+# Production serving profile: gunicorn managing uvicorn workers.
+#
+#     gunicorn -c gunicorn.conf.py app:app
+
+import os
+
+from utils.serving import worker_count
+
+bind = f":{os.environ.get('PORT', '8080')}"
+workers = worker_count()
+worker_class = "utils.serving.DrainingUvicornWorker"
+
+# Import app.py, and so build the chain and every client, once in the
+# arbiter; workers inherit it copy-on-write instead of rebuilding it.
+preload_app = True
+
+# Seconds a worker's event loop may go without a heartbeat before it is
+# restarted. Streams are long-lived, but the loop itself must never block.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+
+# Cloud Run sends SIGKILL 10 seconds after SIGTERM
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT_SECONDS", 10))
+keepalive = 5
+
+
+def post_fork(server, worker):  # noqa: ANN001, ANN201
+    import app as service
+
+    service.reopen_after_fork()
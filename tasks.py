@@ -68,7 +68,14 @@ def setup_virtualenv(c):  # noqa: ANN001, ANN201
 def start(c):  # noqa: ANN001, ANN201
     """Start the web service"""
     with c.prefix(venv):
-        c.run("python app.py")
+        c.run("uvicorn app:app --host 0.0.0.0 --port 8080")
+
+
+@task(pre=[require_venv])
+def serve(c):  # noqa: ANN001, ANN201
+    """Start the web service with the production gunicorn profile"""
+    with c.prefix(venv):
+        c.run("gunicorn -c gunicorn.conf.py app:app")
 
 
 @task(pre=[require_venv])
@@ -138,7 +145,42 @@ def deploy(c):  # noqa: ANN001, ANN201
 def test(c):  # noqa: ANN001, ANN201
     """Run unit tests"""
     with c.prefix(venv):
-        c.run("pytest test/test_app.py")
+        c.run("pytest test --ignore=test/test_system.py")
+
+
+@task(pre=[require_venv])
+def bench(c, requests=100, concurrency=10, retriever="fake"):  # noqa: ANN001, ANN201
+    """Run the offline load test against stubbed LLMs and search providers"""
+    with c.prefix(venv):
+        c.run(
+            f"python -m test.benchmark --requests {requests} "
+            f"--concurrency {concurrency} --retriever {retriever}"
+        )
+
+
+@task(pre=[require_venv])
+def profile_imports(c, top=15):  # noqa: ANN001, ANN201
+    """Report cold-start import time and the cost of each lazy alternative"""
+    with c.prefix(venv):
+        c.run(f"python -m test.import_profile --top {top}")
+
+
+@task(pre=[require_venv])
+def ingest_kay(c):  # noqa: ANN001, ANN201
+    """Add spooled Kay chunks to the local vector indexes"""
+    with c.prefix(venv):
+        c.run("python -m utils.vector_index")
+
+
+@task(pre=[require_venv])
+def batch(c, questions, answers, concurrency=8, url=""):  # noqa: ANN001, ANN201
+    """Answer a JSONL file of chat requests, resuming from the answers file"""
+    remote = f" --url {url}" if url else ""
+    with c.prefix(venv):
+        c.run(
+            f"python batch.py {questions} {answers} "
+            f"--concurrency {concurrency}{remote}"
+        )
 
 
 @task(pre=[require_venv_test])
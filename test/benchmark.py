@@ -0,0 +1,249 @@
+"""Offline load test for /chat/stream_log.
+
+Runs the real FastAPI `app` under uvicorn with fake LLMs and search
+providers, drives concurrent streaming requests at it, and reports
+time-to-first-token, total latency, throughput and RSS.
+
+    python -m test.benchmark --requests 200 --concurrency 20
+    python -m test.benchmark --retriever google --page-size 200000
+    python -m test.benchmark --retriever google --cold-pages --straggler-latency 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import statistics
+import time
+from typing import Dict, List, Optional
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+os.environ.setdefault("KAY_API_KEY", "benchmark")
+os.environ.setdefault("LANGCHAIN_TRACING_V2", "false")
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+from aiohttp import web  # noqa: E402
+from langchain_core.embeddings import DeterministicFakeEmbedding  # noqa: E402
+
+import app as service  # noqa: E402
+from test.fakes import (  # noqa: E402
+    fake_web_app,
+    FakeSearchRetriever,
+    FakeStreamingChatModel,
+)
+
+
+class LocalSearchRetriever(service.GoogleCustomSearchRetriever):
+    """GoogleCustomSearchRetriever whose search results point at the local
+    fake web server instead of calling the Custom Search API"""
+
+    base_url: str = ""
+    # give every question its own URLs so pages never come from the page cache
+    cold_pages: bool = False
+
+    def _ensure_search(self) -> None:
+        return None
+
+    def search_tool(self, query: str, num_search_results: int = 1) -> List[dict]:
+        suffix = f"?q={abs(hash(query))}" if self.cold_pages else ""
+        return [
+            {
+                "link": f"{self.base_url}/page/{i}{suffix}",
+                "title": f"Page {i}",
+                "snippet": f"Snippet of page {i}",
+            }
+            for i in range(num_search_results)
+        ]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+async def _one_request(client: httpx.AsyncClient, url: str, question: str) -> dict:
+    started = time.perf_counter()
+    first_token = None
+    ok = False
+    async with client.stream(
+        "POST", url, json={"question": question, "chat_history": []}
+    ) as resp:
+        event = None
+        async for line in resp.aiter_lines():
+            if line.startswith("event:"):
+                event = line.split(":", 1)[1].strip()
+                ok = ok or event == "end"
+                if event == "error":
+                    break
+            elif line.startswith("data:") and event == "data" and first_token is None:
+                if '"/streamed_output/-"' in line:
+                    first_token = time.perf_counter() - started
+    total = time.perf_counter() - started
+    return {"ok": ok and first_token is not None, "ttft": first_token, "total": total}
+
+
+async def run(args: argparse.Namespace) -> dict:
+    web_runner = None
+    if args.retriever == "google":
+        web_port = _free_port()
+        web_runner = web.AppRunner(
+            fake_web_app(
+                latency=args.retriever_latency,
+                page_size=args.page_size,
+                straggler_latency=args.straggler_latency,
+                stragglers=args.docs,
+            )
+        )
+        await web_runner.setup()
+        await web.TCPSite(web_runner, "127.0.0.1", web_port).start()
+        retriever = LocalSearchRetriever(
+            base_url=f"http://127.0.0.1:{web_port}",
+            num_search_results=args.docs,
+            cold_pages=args.cold_pages,
+            min_documents=service.early_min_sources,
+            soft_deadline=service.early_deadline,
+        )
+    else:
+        retriever = FakeSearchRetriever(
+            k=args.docs, latency=args.retriever_latency, page_size=args.page_size
+        )
+    llm = FakeStreamingChatModel(
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        first_token_latency=args.first_token_latency,
+    )
+    service.semantic_cache = None
+    service.chain = service.create_chain(
+        llm,
+        retriever.with_config(run_name="FinalSourceRetriever"),
+        condense_llm=llm,
+        context_packer=service.context_packer,
+        deduplicator=service.deduplicator,
+        # the hybrid reranker on offline embeddings, so misses cost no network
+        reranker=service.reranker
+        and service.HybridReranker(
+            service.CachedEmbeddings(
+                DeterministicFakeEmbedding(size=1536), namespace="benchmark"
+            ),
+            top_k=service.reranker.top_k,
+            bm25_weight=service.reranker.bm25_weight,
+            embedding_timeout=service.reranker.embedding_timeout,
+        ),
+    )
+
+    port = _free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(service.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    url = f"http://127.0.0.1:{port}/chat/stream_log"
+    semaphore = asyncio.Semaphore(args.concurrency)
+    rss_before = _rss_mb()
+
+    async def bounded(i: int) -> dict:
+        async with semaphore:
+            return await _one_request(client, url, f"benchmark question {i}")
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(bounded(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+    server.should_exit = True
+    await server_task
+    if web_runner is not None:
+        await web_runner.cleanup()
+
+    succeeded = [r for r in results if r["ok"]]
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": len(results) - len(succeeded),
+        "throughput_rps": len(succeeded) / elapsed if elapsed else None,
+        "ttft_s": _percentiles([r["ttft"] for r in succeeded]),
+        "total_s": _percentiles([r["total"] for r in succeeded]),
+        "rss_mb": {"before": rss_before, "after": _rss_mb()},
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--retriever", choices=["fake", "google"], default="fake")
+    parser.add_argument("--retriever-latency", type=float, default=0.2)
+    parser.add_argument("--docs", type=int, default=6)
+    parser.add_argument("--page-size", type=int, default=20_000)
+    parser.add_argument(
+        "--straggler-latency",
+        type=float,
+        default=0.0,
+        help="extra latency of the lowest-ranked page (google retriever)",
+    )
+    parser.add_argument(
+        "--cold-pages",
+        action="store_true",
+        help="use different page URLs for every question (google retriever)",
+    )
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--json", action="store_true", help="print the raw report")
+    return parser.parse_args(argv)
+
+
+def _format(report: dict) -> str:
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    lines = [
+        f"requests={report['requests']} concurrency={report['concurrency']} "
+        f"errors={report['errors']}",
+        f"throughput: {report['throughput_rps']:.2f} req/s",
+    ]
+    for name in ("ttft_s", "total_s"):
+        p = report[name]
+        lines.append(f"{name[:-2]:>6}: p50={ms(p['p50'])} p95={ms(p['p95'])} p99={ms(p['p99'])}")
+    lines.append(
+        f"   rss: {report['rss_mb']['before']:.0f}MB -> {report['rss_mb']['after']:.0f}MB"
+    )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2) if args.json else _format(report))
+
+
+if __name__ == "__main__":
+    main()
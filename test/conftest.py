@@ -12,18 +12,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import flask
-from flask.testing import FlaskClient
+import os
+from typing import Iterator
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
 import pytest
+from sse_starlette.sse import AppStatus
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("TAVILY_API_KEY", "test")
+os.environ.setdefault("KAY_API_KEY", "test")
+os.environ.setdefault("LANGCHAIN_TRACING_V2", "false")
 
-from app import app as flask_app
+import app as service  # noqa: E402
+from test.fakes import FakeSearchRetriever, FakeStreamingChatModel  # noqa: E402
 
 
 @pytest.fixture
-def app() -> None:
-    yield flask_app
+def app(monkeypatch: pytest.MonkeyPatch) -> Iterator[FastAPI]:
+    """The service with its chain rebuilt on offline fakes"""
+    llm = FakeStreamingChatModel(first_token_latency=0, tokens_per_second=10_000)
+    retriever = FakeSearchRetriever(latency=0).with_config(run_name="FinalSourceRetriever")
+    monkeypatch.setattr(service, "semantic_cache", None)
+    monkeypatch.setattr(
+        service,
+        "chain",
+        service.create_chain(
+            llm,
+            retriever,
+            condense_llm=llm,
+            context_packer=service.context_packer,
+            history_window=service.history_window,
+        ),
+    )
+    yield service.app
 
 
 @pytest.fixture
-def client(app: flask.app.Flask) -> FlaskClient:
-    return app.test_client()
+def client(app: FastAPI) -> TestClient:
+    # sse-starlette binds its shutdown event to the first event loop it sees,
+    # and TestClient starts a new loop for every test
+    AppStatus.should_exit_event = None
+    return TestClient(app)
@@ -0,0 +1,119 @@
+"""Offline stand-ins for the LLM, search providers and web pages, shared by
+the unit tests and the load-test benchmark."""
+
+import asyncio
+import time
+from typing import Any, AsyncIterator, List, Optional
+
+from aiohttp import web
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForLLMRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import Document
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain.schema.retriever import BaseRetriever
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Streams `answer_tokens` tokens at `tokens_per_second` after waiting
+    `first_token_latency` seconds"""
+
+    tokens_per_second: float = 200.0
+    answer_tokens: int = 50
+    first_token_latency: float = 0.05
+    token_prefix: str = "token"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat-model"
+
+    def _tokens(self) -> List[str]:
+        return [f"{self.token_prefix}{i} " for i in range(self.answer_tokens)]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.first_token_latency + self.answer_tokens / self.tokens_per_second)
+        message = AIMessage(content="".join(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.first_token_latency)
+        for token in self._tokens():
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(1 / self.tokens_per_second)
+
+
+def fake_page(index: int, size: int) -> str:
+    sentence = f"Fact {index} about the subject, with some supporting detail. "
+    return (sentence * (size // len(sentence) + 1))[:size]
+
+
+class FakeSearchRetriever(BaseRetriever):
+    """Returns `k` documents of `page_size` characters after `latency` seconds"""
+
+    k: int = 6
+    latency: float = 0.05
+    page_size: int = 2000
+
+    def _documents(self, query: str) -> List[Document]:
+        return [
+            Document(
+                page_content=fake_page(i, self.page_size),
+                metadata={"source": f"https://example.com/{i}", "title": f"{query} {i}"},
+            )
+            for i in range(self.k)
+        ]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        time.sleep(self.latency)
+        return self._documents(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        await asyncio.sleep(self.latency)
+        return self._documents(query)
+
+
+def fake_web_app(
+    latency: float = 0.05,
+    page_size: int = 20_000,
+    straggler_latency: float = 0.0,
+    stragglers: int = 6,
+) -> web.Application:
+    """aiohttp app serving HTML pages at /page/{index}. Every page whose
+    index is one less than a multiple of `stragglers` takes an extra
+    `straggler_latency` seconds."""
+
+    async def page(request: web.Request) -> web.Response:
+        index = int(request.match_info["index"])
+        slow = straggler_latency if index % stragglers == stragglers - 1 else 0
+        await asyncio.sleep(latency + slow)
+        body = f"<html><head><title>Page {index}</title></head><body><nav>menu</nav>"
+        body += f"<p>{fake_page(index, page_size)}</p></body></html>"
+        return web.Response(text=body, content_type="text/html", headers={"ETag": f'"{index}"'})
+
+    app = web.Application()
+    app.router.add_get("/page/{index}", page)
+    return app
@@ -0,0 +1,106 @@
+"""Import-time profile of app.py.
+
+Imports the service in a fresh interpreter under `python -X importtime`
+and reports the total cold-start import time, the slowest top-level
+packages, and how long each lazily built LLM and retriever alternative
+takes on first use.
+
+    python -m test.import_profile --top 15
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+os.environ.setdefault("OPENAI_API_KEY", "profile")
+os.environ.setdefault("TAVILY_API_KEY", "profile")
+os.environ.setdefault("KAY_API_KEY", "profile")
+os.environ.setdefault("LANGCHAIN_TRACING_V2", "false")
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """(module, self us, cumulative us, nesting depth) for each line of
+    `-X importtime` output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def profile_imports(module: str = "app") -> List[Tuple[str, int, int, int]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def profile_lazy_components() -> Dict[str, float]:
+    """Builds every lazy alternative in this process and returns how long
+    each one took"""
+    import app as service
+
+    for name in service.components.names():
+        service.components.get(name)
+    return service.components.stats()["built"]
+
+
+def report(top: int, build: bool) -> dict:
+    started = time.perf_counter()
+    rows = profile_imports()
+    wall = time.perf_counter() - started
+    app_row = next(row for row in rows if row[0] == "app")
+    # direct imports of app.py and anything imported before it at the top level
+    children = [row for row in rows if row[3] <= app_row[3] + 1 and row[0] != "app"]
+    slowest = sorted(children, key=lambda row: row[2], reverse=True)[:top]
+    result = {
+        "wall_s": wall,
+        "import_app_s": app_row[2] / 1e6,
+        "app_module_body_s": app_row[1] / 1e6,
+        "slowest_imports_s": {name: cumulative / 1e6 for name, _, cumulative, _ in slowest},
+    }
+    if build:
+        result["lazy_build_s"] = profile_lazy_components()
+    return result
+
+
+def _format(result: dict) -> str:
+    lines = [
+        f"import app: {result['import_app_s'] * 1000:.0f}ms "
+        f"(module body {result['app_module_body_s'] * 1000:.0f}ms, "
+        f"process {result['wall_s'] * 1000:.0f}ms)",
+        "slowest imports:",
+    ]
+    for name, seconds in result["slowest_imports_s"].items():
+        lines.append(f"  {seconds * 1000:7.0f}ms  {name}")
+    if "lazy_build_s" in result:
+        lines.append("first use of lazy alternatives:")
+        for name, seconds in result["lazy_build_s"].items():
+            lines.append(f"  {seconds * 1000:7.0f}ms  {name}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--no-build", action="store_true", help="skip building the lazy alternatives"
+    )
+    parser.add_argument("--json", action="store_true", help="print the raw report")
+    args = parser.parse_args(argv)
+    result = report(args.top, build=not args.no_build)
+    print(json.dumps(result, indent=2) if args.json else _format(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import pytest
+
+from utils.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    ProviderLimits,
+    ProviderThrottled,
+    TokenBucket,
+)
+
+
+def test_admission_queues_then_rejects() -> None:
+    async def scenario() -> None:
+        admission = AdmissionController(max_concurrent=1, max_waiting=1, max_wait=0.05)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await admission.acquire()
+        assert full.value.status_code == 429
+
+        # the running request's slot passes straight to the waiter
+        admission.release()
+        await waiter
+        assert admission.stats()["active"] == 1
+
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await admission.acquire()
+        assert timed_out.value.status_code == 503
+        admission.release()
+        assert admission.stats() == {
+            "admitted": 2,
+            "queued": 2,
+            "rejected_full": 1,
+            "rejected_timeout": 1,
+            "active": 0,
+            "waiting": 0,
+        }
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket_paces_and_refuses_long_waits() -> None:
+    bucket = TokenBucket("openai", rate=20, capacity=2, max_wait=0.1)
+    started = time.monotonic()
+    waits = [bucket.wait() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert time.monotonic() - started == pytest.approx(0.1, abs=0.05)
+
+    for _ in range(2):
+        asyncio.run(bucket.acquire())
+    with pytest.raises(ProviderThrottled):
+        for _ in range(3):
+            bucket._reserve()
+
+
+def test_unconfigured_providers_are_not_limited() -> None:
+    limits = ProviderLimits({"openai": 1, "kay": 0})
+    assert limits.get("kay") is None
+    assert limits.wait("tavily") == 0.0
+    assert limits.wait("openai") == 0.0
@@ -12,15 +12,244 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import flask
-from flask.testing import FlaskClient
+import json
+from typing import List
 
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+from sse_starlette.sse import AppStatus
 
-def test_get_index(app: flask.app.Flask, client: FlaskClient) -> None:
-    res = client.get("/")
+import app as service
+from test.fakes import FakeStreamingChatModel
+from utils.admission import AdmissionController
+from utils.history import ConversationStore
+from utils.metrics import MetricsRegistry
+
+
+def _ops(body: str) -> List[dict]:
+    ops = []
+    for line in body.splitlines():
+        if line.startswith("data:") and '"ops"' in line:
+            ops.extend(json.loads(line[len("data:") :])["ops"])
+    return ops
+
+
+def test_stream_log_sends_sources_before_tokens(client: TestClient) -> None:
+    res = client.post(
+        "/chat/stream_log", json={"question": "What is LangChain?", "chat_history": []}
+    )
     assert res.status_code == 200
+    assert res.text.rstrip().endswith("event: end")
+    paths = [op["path"] for op in _ops(res.text)]
+    sources = paths.index("/logs/FinalSourceRetriever/final_output")
+    assert sources < paths.index("/streamed_output/-")
+
+
+def test_stream_log_final_only(client: TestClient) -> None:
+    res = client.post(
+        "/chat/stream_log",
+        params={"final_only": "true"},
+        json={"question": "What is LangChain?", "chat_history": [["human", "hi"], ["ai", "hello"]]},
+    )
+    ops = _ops(res.text)
+    assert ops and all(op["path"] == "/streamed_output/-" for op in ops)
+    assert "".join(op["value"] for op in ops).startswith("token0 token1")
 
 
-def test_post_index(app: flask.app.Flask, client: FlaskClient) -> None:
-    res = client.post("/")
+def test_get_stream_log(client: TestClient) -> None:
+    res = client.get("/chat/stream_log")
     assert res.status_code == 405
+
+
+def test_unknown_alternatives_are_rejected_before_streaming(client: TestClient) -> None:
+    body = {"question": "What is LangChain?"}
+    res = client.post("/chat/stream_log", params={"retriever": "bogus"}, json=body)
+    assert res.status_code == 422
+    res = client.post("/chat/stream_log", params={"llm": "bogus"}, json=body)
+    assert res.status_code == 422
+    res = client.post("/chat/batch", params={"retriever": "bogus"}, content=b"{}")
+    assert res.status_code == 422
+
+
+def test_metrics_records_stage_latency(client: TestClient) -> None:
+    client.post("/chat/stream_log", json={"question": "What is LangChain?", "chat_history": []})
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert 'chain_stage_latency_seconds_count{stage="FinalSourceRetriever"}' in res.text
+    assert 'chain_stage_latency_seconds_count{stage="GenerateResponse"}' in res.text
+    assert 'retriever_documents_count{stage="FinalSourceRetriever"}' in res.text
+
+
+def test_metrics_carry_the_worker_label() -> None:
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Latency", (1,))
+    latency.observe(0.5, stage="a")
+    registry.set_const_labels(worker="7")
+    assert 'latency_seconds_bucket{worker="7",stage="a",le="1"} 1.0' in registry.render()
+
+
+def test_feedback_is_queued_without_blocking(
+    app: FastAPI, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    posted = []
+
+    class FakeClient:
+        def create_feedback(self, run_id, key, **kwargs) -> None:
+            posted.append((str(run_id), key, str(kwargs["feedback_id"])))
+
+    monkeypatch.setattr(service, "client", FakeClient())
+    AppStatus.should_exit_event = None
+    run_id = "00000000-0000-0000-0000-000000000001"
+    # the shutdown handler flushes the queue when the client exits
+    with TestClient(app) as client:
+        res = client.post("/feedback", json={"run_id": run_id, "score": 1})
+        body = res.json()
+        feedback_id = body.pop("feedback_id")
+        assert body == {"result": "posted feedback successfully", "code": 200}
+    # the write carries the id returned to the client, so retries are idempotent
+    assert posted == [(run_id, "user_score", feedback_id)]
+
+
+def test_ready_once_warm(app: FastAPI, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(app.state, "ready", False)
+    AppStatus.should_exit_event = None
+    assert TestClient(app).get("/ready").status_code == 503
+    with TestClient(app) as client:
+        assert client.get("/ready").json() == {"status": "ready", "code": 200}
+
+
+def test_streams_finish_while_draining(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(AppStatus, "should_exit", True)
+    assert client.get("/ready").json()["status"] == "draining"
+    res = client.post(
+        "/chat/stream_log", json={"question": "What is LangChain?", "chat_history": []}
+    )
+    assert "event: end" in res.text
+    assert any(op["path"] == "/streamed_output/-" for op in _ops(res.text))
+
+
+def test_overload_is_rejected_with_429(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    overloaded = AdmissionController(max_concurrent=0, max_waiting=0)
+    monkeypatch.setattr(service, "admission", overloaded)
+    res = client.post(
+        "/chat/stream_log", json={"question": "What is LangChain?", "chat_history": []}
+    )
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "1"
+    assert res.json()["code"] == 429
+
+
+def test_admission_slot_is_released_after_streaming(client: TestClient) -> None:
+    client.post(
+        "/chat/stream_log", json={"question": "What is LangChain?", "chat_history": []}
+    )
+    assert service.admission.stats()["active"] == 0
+
+
+def test_conversation_history_is_kept_on_the_server(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(service, "conversation_store", ConversationStore())
+    conversation_id = client.post("/conversations").json()["conversation_id"]
+    body = {"question": "What is LangChain?", "conversation_id": conversation_id}
+    client.post("/chat/stream_log", params={"final_only": "true"}, json=body)
+    history = service.conversation_store.load(conversation_id)
+    assert [role for role, _ in history] == ["human", "ai"]
+    assert history[1][1].startswith("token0")
+
+    client.post("/chat/stream_log", json=dict(body, question="Who maintains it?"))
+    assert len(service.conversation_store.load(conversation_id)) == 4
+    assert client.delete(f"/conversations/{conversation_id}").json()["code"] == 200
+    assert client.delete(f"/conversations/{conversation_id}").status_code == 404
+    res = client.post("/chat/stream_log", json=body)
+    assert res.status_code == 404
+
+
+def test_unissued_conversation_ids_are_rejected(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(service, "conversation_store", ConversationStore())
+    body = {"question": "What is LangChain?", "conversation_id": "c1"}
+    res = client.post("/chat/stream_log", json=body)
+    assert res.status_code == 404
+    assert res.json() == {"error": "Conversation not found", "code": 404}
+    assert service.conversation_store.load("c1") == []
+    assert client.delete("/conversations/c1").status_code == 404
+
+
+def test_batch_streams_jsonl_results(client: TestClient) -> None:
+    body = "\n".join(
+        [
+            json.dumps({"id": "a", "question": "What is LangChain?"}),
+            json.dumps({"question": "Who maintains it?", "chat_history": [["human", "hi"], ["ai", "hello"]]}),
+            json.dumps({"chat_history": []}),
+        ]
+    )
+    res = client.post("/chat/batch", content=body)
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in res.text.splitlines()]
+    assert records[-1] == {"checkpoint": {"offset": 3}}
+    by_id = {record.get("id"): record for record in records[:-1]}
+    assert by_id["a"]["answer"].startswith("token0 token1")
+    assert by_id[1]["answer"].startswith("token0 token1")
+    assert by_id[2]["code"] == 400
+    assert service.admission.stats()["active"] == 0
+
+    resumed = client.post("/chat/batch", params={"offset": 2}, content=body)
+    assert [json.loads(line)["id"] for line in resumed.text.splitlines()[:-1]] == [2]
+
+
+class _TopicRetriever(service.BaseRetriever):
+    texts: List[str]
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[service.Document]:
+        return [
+            service.Document(page_content=text, metadata={"source": f"https://{i}"})
+            for i, text in enumerate(self.texts)
+        ]
+
+
+def test_sources_are_the_reranked_documents_the_prompt_gets(
+    app: FastAPI, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    llm = FakeStreamingChatModel(first_token_latency=0, tokens_per_second=10_000)
+    retriever = _TopicRetriever(
+        texts=["cats purr", "langchain chains llms", "dogs bark"]
+    ).configurable_alternatives(
+        service.ConfigurableField(id="retriever"),
+        default_key="tavily",
+        you=_TopicRetriever(texts=["langchain agents", "weather", "langchain llms"]),
+    )
+    monkeypatch.setattr(
+        service,
+        "chain",
+        service.create_chain(
+            llm,
+            retriever.with_config(run_name="FinalSourceRetriever"),
+            condense_llm=llm,
+            reranker=service.HybridReranker(top_k=2),
+        ),
+    )
+    AppStatus.should_exit_event = None
+    client = TestClient(app)
+
+    def sources(**params: str) -> List[str]:
+        res = client.post(
+            "/chat/stream_log", params=params, json={"question": "langchain llms"}
+        )
+        (documents,) = [
+            op["value"]["documents"]
+            for op in _ops(res.text)
+            if op["path"] == "/logs/FinalSourceRetriever/final_output"
+        ]
+        return [doc["page_content"] for doc in documents]
+
+    assert sources() == ["langchain chains llms", "cats purr"]
+    # the configured alternative is still the one searched
+    assert sources(retriever="you") == ["langchain llms", "langchain agents"]
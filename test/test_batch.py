@@ -0,0 +1,149 @@
+import asyncio
+from typing import Dict, List
+
+import orjson
+from langchain.schema.runnable import RunnableLambda
+
+from batch import answered_ids, pending_lines
+from utils.admission import AdmissionController, ProviderThrottled
+from utils.batch import BatchRunner
+
+
+def _run(runner: BatchRunner, chain, lines: List[str], offset: int = 0) -> List[Dict]:
+    async def collect() -> List[Dict]:
+        return [record async for record in runner.run(chain, lines, offset=offset)]
+
+    return asyncio.run(collect())
+
+
+def test_results_stream_in_completion_order_with_checkpoints() -> None:
+    async def answer(inputs: Dict) -> str:
+        await asyncio.sleep(0.05 if inputs["question"] == "slow" else 0)
+        return inputs["question"].upper()
+
+    calls: List[str] = []
+    chain = RunnableLambda(lambda x: x, afunc=answer)
+    runner = BatchRunner(
+        on_answer=lambda inputs, answer: calls.append(answer),
+        concurrency=3,
+        window=4,
+    )
+    lines = [
+        '{"id": "a", "question": "slow"}',
+        '{"question": "fast"}',
+        "",
+        '{"id": "c", "question": "fast"}',
+        "not json",
+    ]
+    records = _run(runner, chain, lines)
+    assert records == [
+        {"id": 3, "error": records[0]["error"], "code": 400},
+        {"id": 1, "answer": "FAST"},
+        {"id": "c", "answer": "FAST"},
+        {"id": "a", "answer": "SLOW"},
+        {"checkpoint": {"offset": 4}},
+    ]
+    # the identical requests in flight together were answered once
+    assert sorted(calls) == ["FAST", "SLOW"]
+
+    resumed = _run(runner, chain, lines[:4], offset=2)
+    assert resumed == [{"id": "c", "answer": "FAST"}, {"checkpoint": {"offset": 3}}]
+
+
+def test_a_slow_request_does_not_hold_back_later_lines() -> None:
+    async def answer(inputs: Dict) -> str:
+        await asyncio.sleep(0.2 if inputs["question"] == "slow" else 0.01)
+        return inputs["question"]
+
+    runner = BatchRunner(concurrency=2, window=2)
+    lines = ['{"question": "slow"}'] + [f'{{"question": "q{i}"}}' for i in range(5)]
+    records = _run(runner, RunnableLambda(lambda x: x, afunc=answer), lines)
+    assert [record.get("id") for record in records] == [1, 2, 3, 4, 5, 0, None]
+    # nothing before the slow line was answered until it was
+    assert records[-1] == {"checkpoint": {"offset": 6}}
+
+
+def test_invalid_lines_keep_their_own_id() -> None:
+    def prepare(payload: Dict) -> Dict:
+        if "question" not in payload:
+            raise ValueError("question is required")
+        return payload
+
+    records = _run(
+        BatchRunner(prepare=prepare),
+        RunnableLambda(lambda x: "ok"),
+        ['{"id": "x"}', "[1]", '{"id": "y", "question": "q"}'],
+    )
+    assert {"id": "x", "error": "question is required", "code": 400} in records
+    assert {"id": 1, "error": "Each line must be a JSON object", "code": 400} in records
+    assert {"id": "y", "answer": "ok"} in records
+
+
+def test_failures_are_reported_per_request() -> None:
+    def answer(inputs: Dict) -> str:
+        if inputs["question"] == "throttled":
+            raise ProviderThrottled("openai", retry_after=2.2)
+        if inputs["question"] == "broken":
+            raise RuntimeError("boom")
+        return "ok"
+
+    records = _run(
+        BatchRunner(),
+        RunnableLambda(answer),
+        ['{"question": "throttled"}', '{"question": "broken"}', '{"question": "x"}'],
+    )
+    by_id = {record.get("id"): record for record in records}
+    assert by_id[0] == {
+        "id": 0,
+        "error": "Service Unavailable",
+        "code": 503,
+        "retry_after": 2,
+    }
+    assert by_id[1] == {"id": 1, "error": "Internal Server Error", "code": 500}
+    assert by_id[2] == {"id": 2, "answer": "ok"}
+
+
+def test_each_chain_takes_an_admission_slot() -> None:
+    running: List[int] = [0]
+    peak: List[int] = [0]
+
+    async def answer(inputs: Dict) -> str:
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.02)
+        running[0] -= 1
+        return "ok"
+
+    admission = AdmissionController(max_concurrent=2, max_waiting=3, max_wait=5)
+    runner = BatchRunner(concurrency=8, admission=admission)
+    lines = [f'{{"question": "q{i}"}}' for i in range(8)]
+    records = _run(runner, RunnableLambda(lambda x: x, afunc=answer), lines)
+    answers = [record for record in records if "answer" in record]
+    rejected = [record for record in records if record.get("code") == 429]
+    # two run, three wait, and the rest find the queue full
+    assert peak[0] == 2
+    assert len(answers) == 5 and len(rejected) == 3
+    assert admission.stats()["active"] == 0
+
+
+def test_cli_skips_requests_already_answered(tmp_path) -> None:
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text(
+        '{"question": "one"}\n\n{"id": "two", "question": "two"}\nnot json\n'
+        '{"question": "three"}\n'
+    )
+    answers = tmp_path / "answers.jsonl"
+    answers.write_text(
+        '{"id": 0, "answer": "1"}\n{"id": "two", "error": "Internal Server Error", "code": 500}\n{"id": 3, "ans'
+    )
+    rejected: List[Dict] = []
+    pending = [
+        orjson.loads(line)
+        for line in pending_lines(str(questions), answered_ids(str(answers)), rejected)
+    ]
+    assert pending == [
+        {"id": "two", "question": "two"},
+        {"question": "three", "id": 3},
+    ]
+    # the unparseable line is reported under its own line number
+    assert rejected == [{"id": 2, "error": rejected[0]["error"], "code": 400}]
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+from langchain.schema.messages import AIMessage, HumanMessage
+from langchain.schema.runnable import RunnableLambda
+
+from utils.condense import is_standalone, QuestionCondenser
+
+HISTORY = [HumanMessage(content="Who founded Anthropic?"), AIMessage(content="...")]
+
+
+def test_is_standalone() -> None:
+    assert is_standalone("What is the population of Tokyo in 2024?")
+    assert not is_standalone("What about its population?")
+    assert not is_standalone("and in 2023?")
+    assert not is_standalone("Tell me more")
+
+
+def test_standalone_follow_up_skips_the_llm() -> None:
+    calls = []
+    condenser = QuestionCondenser(RunnableLambda(lambda x: calls.append(x) or "x"))
+    inputs = {"question": "What is the capital city of France?", "chat_history": HISTORY}
+    assert condenser.condense(inputs, {}) == inputs["question"]
+    assert calls == []
+
+
+def test_rephrasings_are_memoized_per_history() -> None:
+    calls = []
+    condenser = QuestionCondenser(
+        RunnableLambda(lambda x: calls.append(x) or " Who are its founders? ")
+    )
+    inputs = {"question": "Who founded it?", "chat_history": HISTORY}
+    assert condenser.condense(inputs, {}) == "Who are its founders?"
+    assert condenser.condense(inputs, {}) == "Who are its founders?"
+    assert len(calls) == 1
+    condenser.condense({"question": "Who founded it?", "chat_history": []}, {})
+    assert len(calls) == 2
+
+
+def test_slow_condense_falls_back_to_the_question() -> None:
+    def slow(x: dict) -> str:
+        time.sleep(0.5)
+        return "rephrased"
+
+    condenser = QuestionCondenser(RunnableLambda(slow), timeout=0.05)
+    inputs = {"question": "Who founded it?", "chat_history": HISTORY}
+    assert asyncio.run(condenser.acondense(inputs, {})) == "Who founded it?"
@@ -0,0 +1,47 @@
+from langchain.schema import Document
+
+from utils.context import ContextPacker, parse_budgets
+from utils.tokens import count_tokens
+
+
+def test_parse_budgets() -> None:
+    assert parse_budgets("openai=6000, anthropic=8000") == {
+        "openai": 6000,
+        "anthropic": 8000,
+    }
+
+
+def test_budget_is_filled_in_relevance_order() -> None:
+    packer = ContextPacker(budgets={}, max_doc_tokens=10_000, passage_tokens=50)
+    docs = [
+        Document(
+            page_content=" ".join(f"first{i}" for i in range(100)),
+            metadata={"source": "1"},
+        ),
+        Document(
+            page_content=" ".join(f"second{i}" for i in range(100)),
+            metadata={"source": "2"},
+        ),
+    ]
+    packed = packer.pack(docs, "anything", budget=150)
+    assert packed[0].metadata["source"] == "1"
+    assert packed[0].page_content.count("first") > 40
+    assert sum(count_tokens(doc.page_content) for doc in packed) <= 150
+
+
+def test_documents_are_trimmed_to_matching_passages() -> None:
+    packer = ContextPacker(budgets={}, max_doc_tokens=20, passage_tokens=20)
+    text = "\n\n".join(
+        ["Bananas are yellow fruit grown in the tropics."]
+        + [f"Unrelated filler paragraph number {i} about nothing." for i in range(10)]
+    )
+    packed = packer.pack([Document(page_content=text)], "why are bananas yellow", 1000)
+    assert packed[0].page_content.startswith("Bananas are yellow")
+    assert "filler" not in packed[0].page_content
+
+
+def test_near_duplicate_passages_are_dropped() -> None:
+    packer = ContextPacker(budgets={})
+    article = "The central bank raised interest rates by a quarter point on Tuesday."
+    docs = [Document(page_content=article), Document(page_content=article + " ")]
+    assert len(packer.pack(docs, "interest rates", 1000)) == 1
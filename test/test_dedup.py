@@ -0,0 +1,52 @@
+import random
+
+from langchain.schema import Document
+
+from utils.dedup import NearDuplicateFilter, SimHashIndex
+
+random.seed(7)
+VOCABULARY = [f"word{i}" for i in range(3000)]
+
+
+def article(words: int) -> str:
+    return " ".join(random.choice(VOCABULARY) for _ in range(words))
+
+
+def test_index_finds_fingerprints_within_the_distance() -> None:
+    index = SimHashIndex(max_distance=3)
+    index.add(0b1011 << 40, 0)
+    assert index.find((0b1011 << 40) ^ 0b111) == 0
+    assert index.find((0b1011 << 40) ^ 0b1111) is None
+
+
+def test_syndicated_copies_collapse_and_keep_their_urls() -> None:
+    story, other = article(600), article(600)
+    docs = [
+        Document(page_content=story, metadata={"source": "https://wire.com/story"}),
+        Document(page_content=other, metadata={"source": "https://other.com/a"}),
+        # the same story inside another site's navigation and footer, lightly edited
+        Document(
+            page_content="Home World Business Subscribe Sign in " * 8
+            + story.replace("word1 ", "word2 ", 2)
+            + " Copyright 2024 All rights reserved",
+            metadata={"source": "https://paper.com/reprint"},
+        ),
+        Document(page_content=story, metadata={"url": "https://mirror.com/story"}),
+        Document(page_content=story, metadata={"source": "https://wire.com/story"}),
+    ]
+    deduplicated = NearDuplicateFilter().deduplicate(docs)
+    assert [doc.page_content for doc in deduplicated] == [story, other]
+    assert deduplicated[0].metadata == {
+        "source": "https://wire.com/story",
+        "duplicate_sources": ["https://paper.com/reprint", "https://mirror.com/story"],
+    }
+    assert deduplicated[1] is docs[1]
+
+
+def test_documents_sharing_a_passage_are_kept() -> None:
+    quote = article(60)
+    docs = [
+        Document(page_content=f"{article(400)} {quote} {article(400)}"),
+        Document(page_content=f"{article(400)} {quote} {article(400)}"),
+    ]
+    assert len(NearDuplicateFilter().deduplicate(docs)) == 2
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import List, Optional
+
+import app as service
+from utils.early import ranked_prefix_ready, wait_good_enough
+
+
+async def _after(delay: float, value: Optional[str]) -> Optional[str]:
+    await asyncio.sleep(delay)
+    return value
+
+
+def test_ranked_prefix_waits_for_the_top_results() -> None:
+    async def scenario() -> tuple:
+        tasks = [
+            asyncio.ensure_future(_after(delay, value))
+            for delay, value in [
+                (0.01, "a"),
+                (0.05, None),
+                (0.02, "c"),
+                (0.03, "d"),
+                (1, "e"),
+            ]
+        ]
+        started = time.perf_counter()
+        await wait_good_enough(tasks, deadline=5, ready=ranked_prefix_ready(tasks, 3))
+        waited = time.perf_counter() - started
+        done = [task.done() for task in tasks]
+        for task in tasks:
+            task.cancel()
+        return waited, done
+
+    waited, done = asyncio.run(scenario())
+    # "b" yields nothing, so the top three results are a, c and d
+    assert done == [True, True, True, True, False]
+    assert waited < 0.5
+
+
+def test_deadline_returns_once_something_is_done() -> None:
+    async def scenario(delays: List[float]) -> float:
+        tasks = [asyncio.ensure_future(_after(delay, "x")) for delay in delays]
+        started = time.perf_counter()
+        await wait_good_enough(tasks, deadline=0.05)
+        for task in tasks:
+            task.cancel()
+        return time.perf_counter() - started
+
+    assert 0.05 <= asyncio.run(scenario([0.01, 1.0])) < 0.5
+    # nothing was ready at the deadline, so it waits for the first result
+    assert 0.2 <= asyncio.run(scenario([0.2, 1.0])) < 0.5
+
+
+class _SlowLastPage(service.GoogleCustomSearchRetriever):
+    def _ensure_search(self) -> None:
+        return None
+
+    def search_tool(self, query: str, num_search_results: int = 1) -> List[dict]:
+        return [
+            {
+                "link": f"https://example.com/{i}",
+                "title": f"Page {i}",
+                "snippet": f"About {i}",
+            }
+            for i in range(4)
+        ]
+
+    async def _load_document(self, url: str, result: dict):
+        await asyncio.sleep(1.0 if url.endswith("/3") else 0.01)
+        return self._to_document(url, f"text of {url}", None, result)
+
+
+def test_google_retriever_answers_without_the_slowest_page() -> None:
+    retriever = _SlowLastPage(min_documents=3, soft_deadline=5)
+    started = time.perf_counter()
+    docs = asyncio.run(retriever.ainvoke("question"))
+    assert time.perf_counter() - started < 0.5
+    assert [d.page_content for d in docs[:3]] == [
+        f"text of https://example.com/{i}" for i in range(3)
+    ]
+    assert docs[3].page_content == "About 3" and docs[3].metadata["snippet_only"]
+
+
+def test_results_with_snippets_are_not_cached() -> None:
+    cache = service.SearchResultCache()
+    retriever = service.CachedRetriever(
+        retriever=_SlowLastPage(min_documents=3, soft_deadline=5),
+        namespace="google",
+        cache=cache,
+    )
+    asyncio.run(retriever.ainvoke("question"))
+    assert cache.stats()["entries"] == 0
+
+    complete = service.CachedRetriever(
+        retriever=_SlowLastPage(), namespace="google", cache=cache
+    )
+    asyncio.run(complete.ainvoke("question"))
+    assert cache.stats()["entries"] == 1
@@ -0,0 +1,78 @@
+import asyncio
+from typing import List
+
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+from utils.embeddings import CachedEmbeddings, VectorizedEmbeddingsFilter
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self) -> None:
+        self.calls: List[List[str]] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls.append([text])
+        return [float(len(text)), 1.0]
+
+
+def test_repeated_chunks_hit_the_cache(tmp_path) -> None:
+    underlying = CountingEmbeddings()
+    path = str(tmp_path / "embeddings.sqlite3")
+    cached = CachedEmbeddings(underlying, namespace="test", path=path)
+    assert cached.embed_documents(["a", "bb", "a"]) == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]]
+    assert underlying.calls == [["a", "bb"]]
+    cached.embed_documents(["bb", "ccc"])
+    assert underlying.calls[-1] == ["ccc"]
+
+    reopened = CachedEmbeddings(underlying, namespace="test", path=path)
+    asyncio.run(reopened.aembed_documents(["a", "bb", "ccc"]))
+    assert len(underlying.calls) == 2
+    assert reopened.stats()["disk_hits"] == 3
+
+
+def test_misses_are_split_by_batch_size() -> None:
+    underlying = CountingEmbeddings()
+    cached = CachedEmbeddings(underlying, namespace="test", max_batch_size=2)
+    cached.embed_documents(["a", "b", "c", "d", "e"])
+    assert [len(call) for call in underlying.calls] == [2, 2, 1]
+
+
+def test_filter_keeps_similar_documents_in_order() -> None:
+    class AxisEmbeddings(CountingEmbeddings):
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return [[1.0, 0.0] if "cat" in text else [0.0, 1.0] for text in texts]
+
+        def embed_query(self, text: str) -> List[float]:
+            return [1.0, 0.1]
+
+    docs = [Document(page_content=t) for t in ["cat one", "dog", "cat two"]]
+    relevance_filter = VectorizedEmbeddingsFilter(embeddings=AxisEmbeddings())
+    kept = relevance_filter.compress_documents(docs, "cats")
+    assert [doc.page_content for doc in kept] == ["cat one", "cat two"]
+
+
+def test_disk_tier_is_bounded_and_shared(tmp_path) -> None:
+    path = str(tmp_path / "embeddings.sqlite3")
+    # each vector is two float32s, 8 bytes
+    first = CachedEmbeddings(CountingEmbeddings(), namespace="test", path=path, max_bytes=24)
+    second = CachedEmbeddings(CountingEmbeddings(), namespace="test", path=path, max_bytes=24)
+    first.embed_documents(["a", "bb"])
+    second.embed_documents(["ccc", "dddd"])
+    # the size is kept in the file, so both workers count each other's writes
+    assert first.stats()["size_bytes"] == second.stats()["size_bytes"] <= 24
+    assert second.stats()["evictions"] == 1
+
+
+def test_locked_database_is_a_miss(tmp_path) -> None:
+    path = str(tmp_path / "embeddings.sqlite3")
+    underlying = CountingEmbeddings()
+    cached = CachedEmbeddings(underlying, namespace="test", path=path)
+    cached._conn.close()
+    assert asyncio.run(cached.aembed_documents(["a"])) == [[1.0, 1.0]]
+    assert cached.embed_query("bb") == [2.0, 1.0]
+    assert cached.stats()["disk_errors"] == 4
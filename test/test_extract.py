@@ -0,0 +1,52 @@
+import asyncio
+
+from test.fakes import fake_page
+from utils.extract import extract_text, ExtractionPool, TextExtractor
+
+PAGE = """<html><head><title>Solar &amp; wind</title><style>p {}</style></head>
+<body><header><a href="/">Home</a></header><nav><ul><li>Menu</li></ul></nav>
+<div role="navigation">Skip links</div>
+<main><h1>Renewables</h1><p>Solar output <b>doubled</b> in 2023.</p>
+<div><div>Wind grew too.</div></div><input hidden><p>Batteries followed.</p></main>
+<aside><aside>Related</aside> more related</aside>
+<footer>Copyright</footer><script>track()</script></body></html>"""
+
+
+def test_boilerplate_is_stripped() -> None:
+    text, title = extract_text(PAGE)
+    assert title == "Solar & wind"
+    assert text == (
+        "Renewables\nSolar output doubled in 2023.\nWind grew too.\nBatteries followed."
+    )
+
+
+def test_forms_and_article_headers_are_kept() -> None:
+    html = """<body><form id="aspnetForm"><header><a href="/">Home</a></header>
+<article><header><h1>Grid storage</h1><p>By A. Writer</p></header>
+<p>Pumped hydro dominates.</p></article></form></body>"""
+    text, _ = extract_text(html)
+    assert text == "Grid storage\nBy A. Writer\nPumped hydro dominates."
+
+
+def test_extraction_stops_at_the_character_cap() -> None:
+    html = f"<p>{fake_page(0, 5_000_000)}</p>"
+    extractor = TextExtractor(max_chars=1000)
+    fed = 0
+    for start in range(0, len(html), 64 * 1024):
+        extractor.feed(html[start : start + 64 * 1024])
+        fed += 1
+        if extractor.done:
+            break
+    assert fed == 1
+    assert len(extractor.text) == 1000
+    assert extract_text(html, max_chars=1000)[0] == extractor.text
+
+
+def test_pool_extracts_in_another_process() -> None:
+    pool = ExtractionPool(processes=1, max_chars=100)
+    try:
+        text, title = asyncio.run(pool.extract(PAGE))
+    finally:
+        pool.shutdown()
+    assert title == "Solar & wind"
+    assert text.startswith("Renewables\nSolar output")
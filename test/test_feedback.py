@@ -0,0 +1,39 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.feedback import FeedbackQueue
+
+
+def test_writes_are_retried_then_flushed_on_stop() -> None:
+    attempts = []
+
+    def flaky(value: int) -> None:
+        attempts.append(value)
+        if attempts.count(value) < 2:
+            raise ConnectionError("try again")
+
+    async def scenario() -> None:
+        queue = FeedbackQueue(ThreadPoolExecutor(1), backoff=0.01)
+        assert queue.submit(flaky, 1)
+        assert queue.submit(flaky, 2)
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert sorted(attempts) == [1, 1, 2, 2]
+
+
+def test_full_queue_rejects_and_failed_writes_are_dropped() -> None:
+    attempts = []
+
+    def failing() -> None:
+        attempts.append(1)
+        raise ConnectionError("down")
+
+    async def scenario() -> list:
+        queue = FeedbackQueue(ThreadPoolExecutor(1), max_size=1, max_retries=2, backoff=0)
+        accepted = [queue.submit(failing), queue.submit(failing)]
+        await queue.stop()
+        return accepted
+
+    assert asyncio.run(scenario()) == [True, False]
+    assert len(attempts) == 2
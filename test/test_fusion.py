@@ -0,0 +1,23 @@
+from langchain.schema import Document
+
+from utils.fusion import normalize_url, reciprocal_rank_fusion
+
+
+def test_normalize_url() -> None:
+    assert normalize_url("HTTPS://Example.com/a/#top") == "https://example.com/a"
+    assert normalize_url("https://example.com") == "https://example.com/"
+
+
+def test_rrf_prefers_documents_ranked_by_several_providers() -> None:
+    shared = Document(page_content="shared", metadata={"source": "https://a.com/x"})
+    first = [Document(page_content="only first"), shared]
+    second = [Document(page_content="shared copy", metadata={"url": "https://a.com/x/"})]
+    fused = reciprocal_rank_fusion([first, second])
+    assert [doc.page_content for doc in fused] == ["shared", "only first"]
+
+
+def test_rrf_collapses_identical_content_and_limits() -> None:
+    a = [Document(page_content="Same  text"), Document(page_content="other")]
+    b = [Document(page_content="same text")]
+    fused = reciprocal_rank_fusion([a, b], limit=1)
+    assert [doc.page_content for doc in fused] == ["Same  text"]
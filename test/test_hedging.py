@@ -0,0 +1,164 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, List, Optional
+
+from langchain.schema.messages import BaseMessage, HumanMessage
+from langchain.schema.output import ChatGenerationChunk
+
+from test.fakes import FakeStreamingChatModel
+from utils.admission import ProviderThrottled
+from utils.hedging import CircuitBreaker, HedgedChatModel
+
+MESSAGES = [HumanMessage(content="What is LangChain?")]
+
+
+class FailingChatModel(FakeStreamingChatModel):
+    async def _astream(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None, **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        raise ConnectionError("provider is down")
+        yield
+
+
+def _fake(prefix: str, latency: float) -> FakeStreamingChatModel:
+    return FakeStreamingChatModel(
+        token_prefix=prefix, first_token_latency=latency, answer_tokens=3
+    )
+
+
+def _answer(model: HedgedChatModel) -> str:
+    async def collect() -> str:
+        return "".join([chunk.content async for chunk in model.astream(MESSAGES)])
+
+    return asyncio.run(collect())
+
+
+def test_slow_primary_is_hedged_and_cancelled() -> None:
+    model = HedgedChatModel(
+        primary="openai",
+        backups=["anthropic"],
+        models={"openai": _fake("slow", 1.0), "anthropic": _fake("fast", 0)},
+        hedge_after=0.05,
+    )
+    assert _answer(model) == "fast0 fast1 fast2 "
+
+
+def test_fast_primary_is_not_hedged() -> None:
+    started = []
+
+    def backup() -> FakeStreamingChatModel:
+        started.append("anthropic")
+        return _fake("backup", 0)
+
+    model = HedgedChatModel(
+        primary="openai",
+        backups=["anthropic"],
+        models={"openai": _fake("primary", 0), "anthropic": backup},
+        hedge_after=0.5,
+    )
+    assert _answer(model) == "primary0 primary1 primary2 "
+    assert started == []
+
+
+def test_failures_fail_over_and_open_the_breaker() -> None:
+    breakers = {
+        "openai": CircuitBreaker("openai", min_calls=2, cooldown=60),
+        "anthropic": CircuitBreaker("anthropic"),
+    }
+    model = HedgedChatModel(
+        primary="openai",
+        backups=["anthropic"],
+        models={"openai": FailingChatModel(), "anthropic": _fake("backup", 0)},
+        hedge_after=1.0,
+        breakers=breakers,
+    )
+    for _ in range(2):
+        assert _answer(model) == "backup0 backup1 backup2 "
+    assert breakers["openai"].state == "open"
+    assert model._candidates() == ["anthropic"]
+
+
+def test_breaker_probes_after_cooldown() -> None:
+    breaker = CircuitBreaker("openai", min_calls=2, cooldown=0, slow_after=1.0)
+    breaker.record(True, latency=5.0)
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record(True, latency=0.1)
+    assert breaker.state == "closed"
+
+
+def test_backup_probe_is_only_taken_when_the_backup_starts() -> None:
+    breakers = {
+        "openai": CircuitBreaker("openai"),
+        "anthropic": CircuitBreaker("anthropic", min_calls=1, cooldown=0),
+    }
+    breakers["anthropic"].record(False)
+    model = HedgedChatModel(
+        primary="openai",
+        backups=["anthropic"],
+        models={"openai": _fake("primary", 0), "anthropic": _fake("backup", 0)},
+        hedge_after=0.5,
+        breakers=breakers,
+    )
+    for _ in range(3):
+        assert _answer(model) == "primary0 primary1 primary2 "
+    # the primary answered every time, so the backup's probe is still there
+    assert breakers["anthropic"].state == "open"
+    assert breakers["anthropic"].allow()
+
+
+def test_cancelled_loser_is_judged_by_its_breakers_slow_after() -> None:
+    def model(slow_after: float) -> HedgedChatModel:
+        return HedgedChatModel(
+            primary="openai",
+            backups=["anthropic"],
+            models={"openai": _fake("slow", 1.0), "anthropic": _fake("fast", 0)},
+            hedge_after=0.05,
+            breakers={
+                "openai": CircuitBreaker("openai", min_calls=2, slow_after=slow_after),
+                "anthropic": CircuitBreaker("anthropic"),
+            },
+        )
+
+    patient, impatient = model(slow_after=10.0), model(slow_after=0.01)
+    for _ in range(2):
+        assert _answer(patient) == "fast0 fast1 fast2 "
+        assert _answer(impatient) == "fast0 fast1 fast2 "
+    assert patient.breakers["openai"].state == "closed"
+    assert impatient.breakers["openai"].state == "open"
+
+
+def test_sync_stream_fails_over_when_acquiring_or_building_fails() -> None:
+    def acquire_sync(name: str) -> None:
+        if name == "openai":
+            raise ProviderThrottled("openai", retry_after=1.0)
+
+    def broken() -> FakeStreamingChatModel:
+        raise ValueError("missing API key")
+
+    model = HedgedChatModel(
+        primary="openai",
+        backups=["anthropic", "google"],
+        models={
+            "openai": _fake("primary", 0),
+            "anthropic": broken,
+            "google": _fake("backup", 0),
+        },
+        acquire_sync=acquire_sync,
+    )
+    answer = "".join(chunk.content for chunk in model.stream(MESSAGES))
+    assert answer == "backup0 backup1 backup2 "
+
+
+def test_unreported_probe_expires() -> None:
+    breaker = CircuitBreaker("openai", min_calls=1, cooldown=0, slow_after=0.05)
+    breaker.record(False)
+    assert breaker.allow()
+    assert not breaker.allow() and not breaker.available()
+    time.sleep(0.06)
+    assert breaker.available() and breaker.allow()
+    breaker.record(True, latency=0.01)
+    assert breaker.state == "closed"
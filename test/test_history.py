@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from langchain.schema.messages import AIMessage, HumanMessage
+from langchain.schema.runnable import RunnableLambda
+
+from utils.history import ConversationStore, HistoryWindow, prefix_hashes
+
+# each turn is 25 tokens by the 4-characters-per-token estimate or fewer
+TURNS = [
+    ("human" if i % 2 == 0 else "ai", f"turn {i} " + "word " * 18) for i in range(10)
+]
+
+
+def test_short_history_is_kept_without_summarizing() -> None:
+    calls = []
+    window = HistoryWindow(RunnableLambda(lambda x: calls.append(x) or "s"))
+    messages = window.window({"chat_history": TURNS[:4]})
+    assert [type(m) for m in messages] == [HumanMessage, AIMessage] * 2
+    assert calls == []
+
+
+def test_older_turns_are_summarized_and_rolled_forward() -> None:
+    calls = []
+
+    def summarize(inputs: dict) -> str:
+        calls.append(inputs)
+        return f"summary {len(calls)}"
+
+    window = HistoryWindow(RunnableLambda(summarize), max_tokens=60)
+    messages = window.window({"chat_history": TURNS[:6]})
+    assert messages[0] == HumanMessage(content="Summary of our conversation so far: summary 1")
+    # the summary stands in for a human turn, so the kept turns start with the ai
+    assert isinstance(messages[1], AIMessage) and len(messages) <= 4
+    covered = calls[0]["turns"]
+    assert covered.startswith("Human: turn 0") and "turn 5" not in covered
+
+    # the same prefix is served from the cache
+    assert window.window({"chat_history": TURNS[:6]}) == messages
+    assert len(calls) == 1
+
+    # a longer conversation only summarizes the turns after the cached prefix
+    asyncio.run(window.awindow({"chat_history": TURNS}))
+    assert calls[1]["summary"] == "summary 1"
+    assert "turn 0" not in calls[1]["turns"]
+
+
+def test_slow_summary_drops_older_turns_and_finishes_in_the_background() -> None:
+    async def slow(inputs: dict) -> str:
+        await asyncio.sleep(0.2)
+        return "late summary"
+
+    window = HistoryWindow(
+        RunnableLambda(lambda x: "", afunc=slow), max_tokens=60, timeout=0.01
+    )
+
+    async def two_requests() -> tuple:
+        first = await window.awindow({"chat_history": TURNS})
+        await asyncio.sleep(0.3)
+        return first, await window.awindow({"chat_history": TURNS})
+
+    first, second = asyncio.run(two_requests())
+    assert isinstance(first[0], HumanMessage) and "Summary" not in first[0].content
+    assert second[0].content.endswith("late summary")
+
+
+def test_prefix_hashes_identify_every_prefix() -> None:
+    hashes = prefix_hashes(TURNS[:3])
+    assert len(hashes) == 4
+    assert prefix_hashes(TURNS[:2]) == hashes[:3]
+
+
+def test_conversation_store_keeps_recent_turns(tmp_path) -> None:
+    store = ConversationStore(str(tmp_path / "conversations.sqlite3"), max_turns=3)
+    c1 = store.create()
+    store.append(c1, [("human", "q1"), ("ai", "a1")])
+    store.append(c1, [("human", "q2"), ("ai", "a2")])
+    assert store.load(c1) == [("ai", "a1"), ("human", "q2"), ("ai", "a2")]
+    assert store.load(store.create()) == []
+    assert store.delete(c1) and store.load(c1) == []
+    assert not store.append(c1, [("human", "q3"), ("ai", "a3")])
+
+    expired = ConversationStore(str(tmp_path / "conversations.sqlite3"), ttl=0.01)
+    c3 = expired.create()
+    expired.append(c3, [("human", "q"), ("ai", "a")])
+    time.sleep(0.02)
+    assert expired.load(c3) == []
+    assert not expired.append(c3, [("human", "again"), ("ai", "b")])
+
+
+def test_conversation_store_only_accepts_issued_ids() -> None:
+    store = ConversationStore()
+    assert not store.exists("c1")
+    assert not store.append("c1", [("human", "injected"), ("ai", "a")])
+    assert store.load("c1") == []
+    assert not store.delete("c1")
+
+
+def test_conversation_store_async_methods(tmp_path) -> None:
+    store = ConversationStore(str(tmp_path / "conversations.sqlite3"))
+
+    async def scenario() -> None:
+        conversation_id = await store.acreate()
+        assert await store.aexists(conversation_id)
+        assert await store.aappend(conversation_id, [("human", "q"), ("ai", "a")])
+        assert await store.aload(conversation_id) == [("human", "q"), ("ai", "a")]
+        assert await store.adelete(conversation_id)
+        assert not await store.aexists(conversation_id)
+
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+import io
+import logging
+import queue
+import sys
+
+import orjson
+
+from utils.logging import (
+    BackgroundLogging,
+    JSONFormatter,
+    NonBlockingQueueHandler,
+    ProjectId,
+    trace_context,
+)
+
+
+def test_records_are_written_as_json_by_the_background_thread(monkeypatch) -> None:
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "demo")
+    stream = io.StringIO()
+    background = BackgroundLogging(stream=stream, max_field_chars=10).start()
+    try:
+        token = trace_context.set("abc123/1;o=1")
+        try:
+            logging.getLogger("test.logging").info(
+                "Received %s", "chat request", extra={"question": "x" * 50}
+            )
+        finally:
+            trace_context.reset(token)
+    finally:
+        background.stop()
+        logging.getLogger().removeHandler(background.handler)
+
+    (line,) = stream.getvalue().splitlines()
+    entry = orjson.loads(line)
+    assert entry["severity"] == "INFO"
+    assert entry["logger"] == "test.logging"
+    assert entry["message"] == "Received c... [11 more characters]"
+    assert entry["question"] == "x" * 10 + "... [40 more characters]"
+    assert entry["logging.googleapis.com/trace"] == "projects/demo/traces/abc123"
+
+
+def test_project_id_is_resolved_once(monkeypatch) -> None:
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "first")
+    project = ProjectId()
+    assert project.get() == "first"
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "second")
+    assert project.get() == "first"
+
+
+def test_full_queue_drops_records_instead_of_blocking() -> None:
+    handler = NonBlockingQueueHandler(queue.Queue(2))
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "hi", (), None)
+    for _ in range(5):
+        handler.handle(record)
+    assert handler.queue.qsize() == 2 and handler.dropped == 3
+
+
+def test_exceptions_keep_their_stack_trace() -> None:
+    formatter = JSONFormatter(project=ProjectId())
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.getLogger("test").makeRecord(
+            "test", logging.ERROR, __file__, 1, "failed", (), sys.exc_info()
+        )
+    entry = orjson.loads(formatter.format(record))
+    assert entry["severity"] == "ERROR" and "ValueError: boom" in entry["stack_trace"]
+
+
+def test_records_are_snapshotted_before_they_are_queued() -> None:
+    handler = NonBlockingQueueHandler(queue.Queue())
+    question = ["first"]
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.getLogger("test").makeRecord(
+            "test", logging.ERROR, __file__, 1, "question %s", (question,), sys.exc_info()
+        )
+    handler.handle(record)
+    question.append("second")
+    queued = handler.queue.get_nowait()
+    assert queued.args is None and queued.exc_info is None
+    entry = orjson.loads(JSONFormatter(project=ProjectId()).format(queued))
+    assert entry["message"] == "question ['first']"
+    assert "ValueError: boom" in entry["stack_trace"]
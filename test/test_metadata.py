@@ -0,0 +1,182 @@
+import asyncio
+import base64
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Tuple
+
+import orjson
+import aiohttp
+import pytest
+from aiohttp import web
+
+from utils.logging import ProjectId
+from utils.metadata import MetadataClient, token_expiry
+
+
+def fake_token(expires_in: float, serial: int) -> str:
+    payload = orjson.dumps({"exp": round(time.time() + expires_in, 3), "serial": serial})
+    return ".".join(
+        [
+            "eyJhbGciOiJSUzI1NiJ9",
+            base64.urlsafe_b64encode(payload).decode().rstrip("="),
+            "signature",
+        ]
+    )
+
+
+class FakeMetadataServer:
+    """Serves project metadata and ID tokens, counting requests by path, and
+    a protected service at /service that echoes its Authorization header"""
+
+    def __init__(self, token_lifetime: float = 3600) -> None:
+        self.token_lifetime = token_lifetime
+        self.requests: List[str] = []
+        self.service_headers: List[Dict[str, str]] = []
+
+    async def metadata(self, request: web.Request) -> web.Response:
+        assert request.headers["Metadata-Flavor"] == "Google"
+        path = request.match_info["path"]
+        self.requests.append(path)
+        await asyncio.sleep(0.01)
+        if path == "project/project-id":
+            return web.Response(text="demo-project")
+        if path == "instance/service-accounts/default/identity":
+            return web.Response(
+                text=fake_token(self.token_lifetime, len(self.requests))
+            )
+        return web.Response(status=404)
+
+    async def service(self, request: web.Request) -> web.Response:
+        self.service_headers.append(dict(request.headers))
+        if request.query.get("status"):
+            return web.Response(status=int(request.query["status"]), body=b"failed")
+        await asyncio.sleep(float(request.query.get("delay", 0)))
+        return web.Response(body=b"ok")
+
+    async def start(self) -> Tuple[web.AppRunner, str]:
+        app = web.Application()
+        app.router.add_get("/computeMetadata/v1/{path:.*}", self.metadata)
+        app.router.add_get("/service", self.service)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        return runner, f"http://127.0.0.1:{port}"
+
+
+@asynccontextmanager
+async def _serve(
+    server: FakeMetadataServer, **kwargs
+) -> AsyncIterator[Tuple[MetadataClient, str]]:
+    runner, url = await server.start()
+    client = MetadataClient(base_url=f"{url}/computeMetadata/v1/", **kwargs)
+    try:
+        yield client, url
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+def test_values_are_fetched_once_and_concurrent_lookups_share_it() -> None:
+    server = FakeMetadataServer()
+
+    async def scenario() -> None:
+        async with _serve(server) as (client, _):
+            ids = await asyncio.gather(*(client.project_id() for _ in range(5)))
+            assert ids == ["demo-project"] * 5
+            assert await client.project_id() == "demo-project"
+
+    asyncio.run(scenario())
+    assert server.requests == ["project/project-id"]
+
+
+def test_log_project_is_resolved_with_the_client(monkeypatch) -> None:
+    monkeypatch.delenv("GOOGLE_CLOUD_PROJECT", raising=False)
+    server = FakeMetadataServer()
+    project = ProjectId()
+
+    async def scenario() -> None:
+        async with _serve(server) as (client, _):
+            assert await project.aresolve(client) == "demo-project"
+            assert await project.aresolve(client) == "demo-project"
+
+    asyncio.run(scenario())
+    assert project.get() == "demo-project"
+    assert server.requests == ["project/project-id"]
+
+
+def test_id_tokens_are_cached_then_refreshed_in_the_background() -> None:
+    server = FakeMetadataServer(token_lifetime=120)
+
+    async def scenario() -> None:
+        async with _serve(server, refresh_margin=60, expiry_skew=10) as (client, url):
+            first = await client.id_token(url)
+            assert await client.id_token(url) == first
+            assert len(server.requests) == 1
+
+            # inside the refresh margin the cached token is still returned
+            # while a new one is fetched in the background
+            client.refresh_margin = 300
+            assert await client.id_token(url) == first
+            await asyncio.sleep(0.05)
+            client.refresh_margin = 60
+            second = await client.id_token(url)
+            assert second != first and len(server.requests) == 2
+
+            # once a token is within the expiry skew, callers wait for a new one
+            client.expiry_skew = 300
+            third = await client.id_token(url)
+            assert third != second and len(server.requests) == 3
+            assert token_expiry(third) > time.time() + 100
+
+    asyncio.run(scenario())
+
+
+def test_authenticated_request_sends_the_token_but_no_metadata_header() -> None:
+    server = FakeMetadataServer()
+
+    async def scenario() -> None:
+        async with _serve(server) as (client, url):
+            for _ in range(2):
+                assert await client.authenticated_request(f"{url}/service") == b"ok"
+            token = await client.id_token(f"{url}/service")
+            assert server.requests == ["instance/service-accounts/default/identity"]
+            for headers in server.service_headers:
+                assert headers["Authorization"] == f"Bearer {token}"
+                assert "Metadata-Flavor" not in headers
+
+    asyncio.run(scenario())
+
+
+def test_authenticated_request_raises_on_errors_and_times_out() -> None:
+    server = FakeMetadataServer()
+
+    async def scenario() -> None:
+        async with _serve(server, timeout=0.2) as (client, url):
+            with pytest.raises(aiohttp.ClientResponseError) as failed:
+                await client.authenticated_request(f"{url}/service?status=503")
+            assert failed.value.status == 503
+            with pytest.raises(asyncio.TimeoutError):
+                await client.authenticated_request(f"{url}/service?delay=0.5")
+
+    asyncio.run(scenario())
+
+
+def test_used_id_tokens_are_refreshed_before_they_expire() -> None:
+    server = FakeMetadataServer(token_lifetime=1.0)
+
+    async def scenario() -> None:
+        async with _serve(server, refresh_margin=0.7, expiry_skew=0.1) as (client, url):
+            first = await client.id_token(url)
+            # refreshed in the background at exp - refresh_margin
+            await asyncio.sleep(0.5)
+            assert len(server.requests) == 2
+            second = await client.id_token(url)
+            assert second != first and len(server.requests) == 2
+            # the second token is refreshed too, but not the third, which
+            # nobody has used
+            await asyncio.sleep(0.8)
+            assert len(server.requests) == 3
+
+    asyncio.run(scenario())
@@ -0,0 +1,56 @@
+from utils.page_cache import PageCache
+
+
+def test_hit_uses_normalized_url() -> None:
+    cache = PageCache()
+    cache.put("https://Example.com/page/", "text", title="Title", etag='"v1"')
+    page = cache.get("https://example.com/page#section")
+    assert page is not None
+    assert page.title == "Title"
+    assert page.revalidation_headers() == {"If-None-Match": '"v1"'}
+    assert cache.stats()["hits"] == 1
+
+
+def test_stale_entries_are_returned_for_revalidation() -> None:
+    cache = PageCache(ttl=0)
+    cache.put("https://example.com", "text")
+    page = cache.get("https://example.com")
+    assert page is not None and not page.is_fresh(cache.ttl)
+    cache.mark_revalidated("https://example.com")
+    stats = cache.stats()
+    assert stats["stale_hits"] == 1
+    assert stats["revalidated"] == 1
+
+
+def test_lru_eviction_respects_max_bytes() -> None:
+    cache = PageCache(max_bytes=10)
+    cache.put("https://a.com", "aaaaa")
+    cache.put("https://b.com", "bbbbb")
+    cache.get("https://a.com")
+    cache.put("https://c.com", "ccccc")
+    assert cache.get("https://b.com") is None
+    assert cache.get("https://a.com") is not None
+    assert cache.stats()["size_bytes"] == 10
+
+
+def test_size_limit_is_shared_by_workers(tmp_path) -> None:
+    path = str(tmp_path / "pages.sqlite3")
+    first = PageCache(path, max_bytes=10)
+    second = PageCache(path, max_bytes=10)
+    first.put("https://a.com", "aaaaa")
+    second.put("https://b.com", "bbbbb")
+    second.put("https://b.com", "bbbbb")
+    first.put("https://c.com", "ccccc")
+    assert first.get("https://a.com") is None
+    assert first.stats()["size_bytes"] == second.stats()["size_bytes"] == 10
+
+
+def test_database_errors_are_misses(tmp_path) -> None:
+    cache = PageCache(str(tmp_path / "pages.sqlite3"))
+    cache._conn.close()
+    cache.put("https://a.com", "aaaaa")
+    assert cache.get("https://a.com") is None
+    cache.mark_revalidated("https://a.com")
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["disk_errors"] == 3
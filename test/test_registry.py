@@ -0,0 +1,36 @@
+from langchain.schema.output_parser import StrOutputParser
+from langchain.schema.runnable import ConfigurableField, RunnableLambda
+
+from utils.registry import LazyComponents
+
+
+def test_alternatives_are_built_once_on_first_use() -> None:
+    components = LazyComponents()
+    built = []
+
+    def shout() -> RunnableLambda:
+        built.append("shout")
+        return RunnableLambda(lambda x: x.upper())
+
+    runnable = StrOutputParser().configurable_alternatives(
+        ConfigurableField(id="style"),
+        default_key="plain",
+        shout=components.register("style:shout", shout),
+    )
+    assert runnable.invoke("hi") == "hi"
+    assert built == []
+    assert components.stats()["pending"] == ["style:shout"]
+
+    shouting = runnable.with_config(configurable={"style": "shout"})
+    assert shouting.invoke("hi") == "HI"
+    assert shouting.invoke("hey") == "HEY"
+    assert built == ["shout"]
+    assert list(components.stats()["built"]) == ["style:shout"]
+
+
+def test_service_only_builds_the_default_path() -> None:
+    import app as service
+
+    assert "retriever:kay" in service.components.names()
+    assert "llm:anthropic" in service.components.names()
+    assert service.components.stats()["built"] == {}
@@ -0,0 +1,67 @@
+import asyncio
+from typing import List
+
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+from utils.rerank import HybridReranker
+
+DOCS = [
+    Document(page_content="Company history and the founders' early years."),
+    Document(page_content="Quarterly revenue grew 12% as revenue from cloud rose."),
+    Document(page_content="The lawsuit over the merger was settled last week."),
+    Document(page_content="Analysts expect revenue guidance to be raised."),
+]
+
+
+class SlowEmbeddings(Embeddings):
+    """Ranks the lawsuit document first, after `latency` seconds"""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.finished = 0
+
+    def _vector(self, text: str) -> List[float]:
+        return [float("lawsuit" in text), 1.0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [1.0, 0.0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        self.finished += 1
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return self.embed_query(text)
+
+
+def test_bm25_keeps_the_top_k_in_relevance_order() -> None:
+    reranker = HybridReranker(top_k=2)
+    ranked = reranker.rerank(DOCS, "How did revenue grow?")
+    assert ranked == [DOCS[1], DOCS[3]]
+    # nothing matches: retrieval order is kept
+    assert reranker.rerank(DOCS, "weather") == DOCS[:2]
+
+
+def test_embeddings_join_the_score_when_they_arrive_in_time() -> None:
+    embeddings = SlowEmbeddings(latency=0)
+    reranker = HybridReranker(embeddings, top_k=2, bm25_weight=0.3)
+    ranked = asyncio.run(reranker.arerank(DOCS, "revenue"))
+    assert ranked[0] == DOCS[2]
+
+
+def test_slow_embeddings_fall_back_to_bm25_and_finish_in_the_background() -> None:
+    embeddings = SlowEmbeddings(latency=0.05)
+    reranker = HybridReranker(embeddings, top_k=2, embedding_timeout=0.01)
+
+    async def scenario() -> List[Document]:
+        ranked = await reranker.arerank(DOCS, "revenue")
+        await asyncio.sleep(0.1)
+        return ranked
+
+    assert asyncio.run(scenario()) == [DOCS[1], DOCS[3]]
+    assert embeddings.finished == 1
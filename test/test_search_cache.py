@@ -0,0 +1,78 @@
+import asyncio
+from typing import List
+
+from utils.search_cache import normalize_query, SearchResultCache
+
+
+def test_key_normalizes_query_and_separates_namespaces() -> None:
+    assert normalize_query("  What is  LangChain? ") == "what is langchain"
+    key = SearchResultCache.key("tavily", "What is LangChain?")
+    assert key == SearchResultCache.key("tavily", "what is langchain")
+    assert key != SearchResultCache.key("you", "what is langchain")
+
+
+def test_concurrent_lookups_are_coalesced() -> None:
+    cache = SearchResultCache()
+    calls = []
+
+    async def search() -> List[dict]:
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return [{"page_content": "result"}]
+
+    async def burst() -> list:
+        key = cache.key("tavily", "question")
+        return await asyncio.gather(
+            *(cache.aget_or_compute(key, search) for _ in range(5))
+        )
+
+    results = asyncio.run(burst())
+    assert len(calls) == 1
+    assert all(result == [{"page_content": "result"}] for result in results)
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_lru_bound_and_empty_results_not_cached() -> None:
+    cache = SearchResultCache(max_entries=1)
+    cache.get_or_compute("a", lambda: [1])
+    cache.get_or_compute("b", lambda: [2])
+    cache.get_or_compute("empty", lambda: [])
+    assert cache.get_local("a") is None
+    assert cache.get_local("b") == [2]
+    assert cache.get_local("empty") is None
+
+
+def test_byte_bound_evicts_oldest_results() -> None:
+    cache = SearchResultCache(max_bytes=100)
+    cache.put_local("a", [{"page_content": "x" * 40}])
+    cache.put_local("b", [{"page_content": "y" * 40}])
+    cache.put_local("huge", [{"page_content": "z" * 200}])
+    assert cache.get_local("a") is None and cache.get_local("huge") is None
+    assert cache.get_local("b") is not None
+    assert cache.stats()["bytes"] <= 100
+
+
+def test_waiters_survive_the_first_lookup_being_cancelled() -> None:
+    cache = SearchResultCache()
+    calls = []
+
+    async def search() -> List[dict]:
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return [{"page_content": "result"}]
+
+    async def scenario() -> list:
+        key = cache.key("tavily", "question")
+        first = asyncio.ensure_future(cache.aget_or_compute(key, search))
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.ensure_future(cache.aget_or_compute(key, search)) for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await asyncio.gather(*waiters)
+
+    results = asyncio.run(scenario())
+    assert all(result == [{"page_content": "result"}] for result in results)
+    # one of the waiters took over the search for the others
+    assert len(calls) == 2
@@ -0,0 +1,52 @@
+import asyncio
+from typing import List
+
+from langchain.schema.embeddings import Embeddings
+
+from utils.semantic_cache import SemanticAnswerCache
+
+
+class KeywordEmbeddings(Embeddings):
+    """Embeds text as counts of a few fixed keywords"""
+
+    keywords = ["langchain", "python", "weather", "paris"]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        words = text.lower().split()
+        return [float(words.count(k)) for k in self.keywords]
+
+
+def _lookup(cache: SemanticAnswerCache, question: str, namespace: str = ""):
+    return asyncio.run(cache.alookup(question, namespace))
+
+
+def test_near_duplicate_question_hits() -> None:
+    cache = SemanticAnswerCache(KeywordEmbeddings(), threshold=0.9)
+    cached, vector = _lookup(cache, "what is langchain python")
+    assert cached is None
+    cache.store(vector, "what is langchain python", "An answer", [])
+    cached, _ = _lookup(cache, "langchain python ?")
+    assert cached is not None and cached.answer == "An answer"
+    assert _lookup(cache, "weather in paris")[0] is None
+
+
+def test_namespaces_and_ttl_are_respected() -> None:
+    cache = SemanticAnswerCache(KeywordEmbeddings(), ttl=0)
+    _, vector = _lookup(cache, "langchain")
+    cache.store(vector, "langchain", "An answer", [], namespace="openai:tavily")
+    assert _lookup(cache, "langchain", "openai:tavily")[0] is None
+    assert _lookup(cache, "langchain", "anthropic:you")[0] is None
+
+
+def test_lru_eviction_when_full() -> None:
+    cache = SemanticAnswerCache(KeywordEmbeddings(), max_entries=1)
+    _, first = _lookup(cache, "langchain")
+    _, second = _lookup(cache, "weather")
+    cache.store(first, "langchain", "first", [])
+    cache.store(second, "weather", "second", [])
+    assert _lookup(cache, "langchain")[0] is None
+    assert _lookup(cache, "weather")[0].answer == "second"
+    assert cache.stats()["evictions"] == 1
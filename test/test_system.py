@@ -14,12 +14,10 @@
 
 import os
 
-import flask
-from flask.testing import FlaskClient
 import requests
 
 
-def test_system(app: flask.app.Flask, client: FlaskClient) -> None:
+def test_system() -> None:
 
     BASE_URL = os.environ.get("BASE_URL")
     assert BASE_URL, "Cloud Run service URL not found"
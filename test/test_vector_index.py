@@ -0,0 +1,124 @@
+import asyncio
+import json
+import sys
+from typing import List
+
+import numpy as np
+from langchain.schema import BaseRetriever, Document
+from langchain.schema.embeddings import Embeddings
+
+from utils import embeddings as cached_embeddings
+from utils.embeddings import CachedEmbeddings
+from utils.vector_index import (
+    ChunkSpool,
+    ingest,
+    LocalFirstRetriever,
+    main,
+    open_kay_index,
+    read_chunks,
+    VectorIndex,
+)
+
+
+class TopicEmbeddings(Embeddings):
+    """One axis per topic word, so similarity is easy to predict"""
+
+    topics = ["revenue", "lawsuit", "merger"]
+
+    def __init__(self) -> None:
+        self.queries: List[str] = []
+
+    def _vector(self, text: str) -> List[float]:
+        return [float(topic in text) for topic in self.topics] + [0.1]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.queries.append(text)
+        return self._vector(text)
+
+
+class KayStub(BaseRetriever):
+    calls: List[str] = []
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        self.calls.append(query)
+        return [
+            Document(
+                page_content=f"{query} filing {i}", metadata={"source": f"kay/{i}"}
+            )
+            for i in range(3)
+        ]
+
+
+def test_index_appends_deduplicates_and_is_shared_on_disk(tmp_path) -> None:
+    embeddings = TopicEmbeddings()
+    index = VectorIndex(str(tmp_path), namespace="topics")
+    docs = [
+        Document(page_content="revenue grew", metadata={"source": "a"}),
+        Document(page_content="lawsuit settled", metadata={"source": "b"}),
+        Document(page_content="revenue grew", metadata={"source": "dup"}),
+    ]
+    assert (
+        index.add(docs, embeddings.embed_documents([d.page_content for d in docs])) == 2
+    )
+    assert index.add(docs[:1], embeddings.embed_documents(["revenue grew"])) == 0
+
+    # a reader in another process maps the same files and sees later additions
+    reader = VectorIndex(str(tmp_path), namespace="topics")
+    (hit,) = reader.search(embeddings.embed_query("revenue"), k=1)
+    assert hit[0] == docs[0] and hit[1] > 0.9
+    index.add([Document(page_content="merger talks")], [embeddings._vector("merger")])
+    hits = reader.search(embeddings.embed_query("merger"), k=3, min_score=0.5)
+    assert [doc.page_content for doc, _ in hits] == ["merger talks"]
+
+    # rows written by an add that never committed are ignored, then overwritten
+    with open(tmp_path / "vectors.f32", "ab") as f:
+        f.write(np.ones(4, dtype=np.float32).tobytes())
+    assert len(reader.search([1.0, 1.0, 1.0, 1.0], k=10)) == 3
+    index.add([Document(page_content="revenue lawsuit")], [[1.0, 1.0, 0.0, 0.1]])
+    assert len(reader) == 4 and len(reader.search([1.0, 1.0, 1.0, 1.0], k=10)) == 4
+
+
+def test_local_first_falls_back_spools_and_then_answers_locally(tmp_path) -> None:
+    embeddings = TopicEmbeddings()
+    index = VectorIndex(str(tmp_path / "kay"), namespace="topics")
+    spool = ChunkSpool(str(tmp_path / "kay" / "spool"))
+    kay = KayStub(calls=[])
+    retriever = LocalFirstRetriever(
+        index=index, embeddings=embeddings, fallback=kay, spool=spool, min_results=2
+    )
+
+    first = asyncio.run(retriever.ainvoke("revenue"))
+    assert len(kay.calls) == 1 and len(first) == 3
+    # nothing was indexed yet, so the query was not embedded
+    assert embeddings.queries == []
+
+    (claimed,) = spool.claim()
+    assert ingest(index, embeddings, read_chunks(claimed)) == 3
+    # a claimed file stays until the job removes it, so a failed run is retried
+    assert spool.claim() == [claimed]
+
+    local = retriever.invoke("revenue")
+    assert len(kay.calls) == 1
+    assert sorted(d.metadata["source"] for d in local) == ["kay/0", "kay/1", "kay/2"]
+
+    asyncio.run(retriever.ainvoke("merger"))
+    assert len(kay.calls) == 2
+
+
+def test_ingestion_job_builds_only_the_index(tmp_path, monkeypatch) -> None:
+    monkeypatch.setenv("KAY_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        cached_embeddings,
+        "cached_openai_embeddings",
+        lambda: CachedEmbeddings(TopicEmbeddings(), namespace="topics"),
+    )
+    monkeypatch.delitem(sys.modules, "app", raising=False)
+    chunks = tmp_path / "chunks.jsonl"
+    chunks.write_text(json.dumps({"page_content": "revenue grew", "metadata": {}}) + "\n")
+    main(["--index", "kay", "--from-file", str(chunks)])
+    assert "app" not in sys.modules
+    index, _ = open_kay_index("kay", "topics")
+    assert len(index) == 1
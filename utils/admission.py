@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted.
+
+    `status_code` is 429 when the wait queue is already full, so clients back
+    off immediately, and 503 when the request waited `max_wait` seconds
+    without getting a slot."""
+
+    def __init__(self, status_code: int, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounds how many chains run at once.
+
+    Up to `max_concurrent` requests run; up to `max_waiting` more wait in FIFO
+    order for at most `max_wait` seconds, and anything beyond that is
+    rejected straight away rather than slowing every request down. Waiters
+    are plain futures, so the controller is not tied to one event loop."""
+
+    def __init__(
+        self, max_concurrent: int = 32, max_waiting: int = 64, max_wait: float = 5.0
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._counters = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0}
+
+    async def acquire(self) -> None:
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self._counters["admitted"] += 1
+            return
+        if len(self._waiters) >= self.max_waiting:
+            self._counters["rejected_full"] += 1
+            raise AdmissionRejected(429, "Too many requests are queued", retry_after=1)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._counters["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # release() handed us its slot just as we gave up
+                self.release()
+                raise
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            if isinstance(e, asyncio.TimeoutError):
+                self._counters["rejected_timeout"] += 1
+                raise AdmissionRejected(
+                    503, "The server is overloaded", retry_after=max(1, round(self.max_wait))
+                ) from None
+            raise
+        self._counters["admitted"] += 1
+
+    def release(self) -> None:
+        # hand the slot straight to the oldest waiter so it cannot be taken
+        # by a request that arrives in between
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._counters, active=self._active, waiting=len(self._waiters))
+
+
+class ProviderThrottled(Exception):
+    """Raised when a provider's token bucket cannot grant a request within
+    the bucket's `max_wait`"""
+
+    def __init__(self, provider: str, retry_after: float) -> None:
+        super().__init__(f"{provider} is rate limited, retry in {retry_after:.1f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second with bursts of up to
+    `capacity`.
+
+    Callers reserve a token and sleep until it is theirs, so waiters are
+    served in order without polling. A reservation that would take longer
+    than `max_wait` is refused with ProviderThrottled instead."""
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        capacity: Optional[float] = None,
+        max_wait: float = 10.0,
+    ) -> None:
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.max_wait = max_wait
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            if delay > self.max_wait:
+                raise ProviderThrottled(self.name, delay)
+            self._tokens -= 1
+            return delay
+
+    def wait(self) -> float:
+        """Blocks until a token is available; returns the time waited"""
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def acquire(self) -> float:
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    """Parses "openai=20,tavily=5" into requests per second per provider"""
+    rates = {}
+    for item in spec.split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            rates[key.strip()] = float(value)
+    return rates
+
+
+class ProviderLimits:
+    """One TokenBucket per upstream provider; providers without a configured
+    rate are not limited"""
+
+    def __init__(self, rates: Dict[str, float], max_wait: float = 10.0) -> None:
+        self.buckets = {
+            name: TokenBucket(name, rate, max_wait=max_wait)
+            for name, rate in rates.items()
+            if rate > 0
+        }
+
+    def get(self, provider: Optional[str]) -> Optional[TokenBucket]:
+        return self.buckets.get(provider) if provider else None
+
+    def wait(self, provider: Optional[str]) -> float:
+        bucket = self.get(provider)
+        return bucket.wait() if bucket is not None else 0.0
+
+    async def acquire(self, provider: Optional[str]) -> float:
+        bucket = self.get(provider)
+        return await bucket.acquire() if bucket is not None else 0.0
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import orjson
+from langchain.schema.runnable import Runnable, RunnableConfig, RunnableLambda
+
+from utils.admission import AdmissionController, AdmissionRejected, ProviderThrottled
+from utils.telemetry import admission_rejections, batch_requests
+
+logger = logging.getLogger(__name__)
+
+
+def dumps_line(record: Dict) -> bytes:
+    return orjson.dumps(record) + b"\n"
+
+
+class BatchRunner:
+    """Answers JSONL chat requests, keeping up to `concurrency` chains
+    running.
+
+    Lines are read ahead as chains finish, at most `window` of them in
+    flight, so a slow request holds back no one but itself. Results are
+    yielded in completion order as `{"id", "answer"}` or
+    `{"id", "error", "code"}` records. A request's id is its "id" field, or
+    else its (0-based) index among the non-blank lines, and identical
+    requests in flight together are answered once. Whenever every line
+    before `n` has been answered, and at least `window` lines since the
+    last one, a `{"checkpoint": {"offset": n}}` record is written, and a
+    last one at the end, so an interrupted batch can be resumed from there.
+
+    `prepare` turns a parsed line into the chain's input, raising ValueError
+    if it is invalid, and `on_answer` is called with each input and answer.
+    Both run in a thread, so they may block on I/O.
+    With an `admission` controller every chain takes its own slot, so a
+    batch counts against the same limit as interactive requests."""
+
+    def __init__(
+        self,
+        prepare: Callable[[Dict], Dict] = dict,
+        on_answer: Optional[Callable[[Dict, str], None]] = None,
+        concurrency: int = 8,
+        window: int = 64,
+        admission: Optional[AdmissionController] = None,
+    ) -> None:
+        self.prepare = prepare
+        self.on_answer = on_answer
+        self.admission = admission
+        self.concurrency = concurrency
+        self.window = max(window, concurrency)
+
+    async def run(
+        self,
+        chain: Runnable,
+        lines: Iterable[str],
+        config: Optional[RunnableConfig] = None,
+        offset: int = 0,
+    ) -> AsyncIterator[Dict]:
+        if self.admission is not None:
+            chain = self._admitted(chain)
+        numbered = (
+            (index, line)
+            for index, line in enumerate(line for line in lines if line.strip())
+            if index >= offset
+        )
+        # each running chain's input key and the (index, id) of every line
+        # waiting on it
+        running: Dict[asyncio.Future, Tuple[bytes, Dict, List[Tuple[int, Any]]]] = {}
+        by_key: Dict[bytes, asyncio.Future] = {}
+        unfinished: Set[int] = set()
+        next_index = checkpoint = offset
+        exhausted = False
+        try:
+            while True:
+                while (
+                    not exhausted
+                    and len(running) < self.concurrency
+                    and len(unfinished) < self.window
+                ):
+                    item = next(numbered, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    index, line = item
+                    next_index = index + 1
+                    try:
+                        request_id, prepared = await asyncio.to_thread(
+                            self._parse, index, line
+                        )
+                    except ValueError as e:
+                        batch_requests.inc(outcome="invalid")
+                        yield {"id": self._line_id(index, line), "error": str(e), "code": 400}
+                        continue
+                    key = orjson.dumps(prepared, option=orjson.OPT_SORT_KEYS)
+                    task = by_key.get(key)
+                    if task is None:
+                        task = asyncio.ensure_future(self._invoke(chain, prepared, config))
+                        by_key[key] = task
+                        running[task] = (key, prepared, [])
+                    running[task][2].append((index, request_id))
+                    unfinished.add(index)
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key, prepared, waiting = running.pop(task)
+                    del by_key[key]
+                    output = task.result()
+                    result = self._result(output)
+                    if "answer" in result and self.on_answer is not None:
+                        await asyncio.to_thread(self.on_answer, prepared, output)
+                    for index, request_id in waiting:
+                        unfinished.discard(index)
+                        yield {"id": request_id, **result}
+                answered = min(unfinished, default=next_index)
+                if answered - checkpoint >= self.window:
+                    checkpoint = answered
+                    yield {"checkpoint": {"offset": answered}}
+        finally:
+            for task in running:
+                task.cancel()
+        if next_index > checkpoint:
+            yield {"checkpoint": {"offset": next_index}}
+
+    def _parse(self, index: int, line: str) -> Tuple[Any, Dict]:
+        payload = orjson.loads(line)
+        if not isinstance(payload, dict):
+            raise ValueError("Each line must be a JSON object")
+        return payload.pop("id", index), self.prepare(payload)
+
+    @staticmethod
+    def _line_id(index: int, line: str) -> Any:
+        """The id of a line that failed to parse or prepare: its own "id"
+        if it has one, else its index"""
+        try:
+            payload = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            return index
+        return payload.get("id", index) if isinstance(payload, dict) else index
+
+    @staticmethod
+    async def _invoke(chain: Runnable, inputs: Dict, config: Optional[RunnableConfig]) -> Any:
+        try:
+            return await chain.ainvoke(inputs, config)
+        except Exception as e:
+            return e
+
+    def _admitted(self, chain: Runnable) -> Runnable:
+        admission = self.admission
+
+        async def admitted(inputs: Dict, config: RunnableConfig) -> Any:
+            await admission.acquire()
+            try:
+                return await chain.ainvoke(inputs, config)
+            finally:
+                admission.release()
+
+        return RunnableLambda(admitted).with_config(run_name="AdmittedChain")
+
+    def _result(self, output: Any) -> Dict:
+        if isinstance(output, AdmissionRejected):
+            batch_requests.inc(outcome="rejected")
+            admission_rejections.inc(status=str(output.status_code))
+            return {
+                "error": output.message,
+                "code": output.status_code,
+                "retry_after": output.retry_after,
+            }
+        if isinstance(output, ProviderThrottled):
+            batch_requests.inc(outcome="throttled")
+            return {
+                "error": "Service Unavailable",
+                "code": 503,
+                "retry_after": round(output.retry_after),
+            }
+        if isinstance(output, Exception):
+            batch_requests.inc(outcome="error")
+            logger.error("A batched chat request failed", exc_info=output)
+            return {"error": "Internal Server Error", "code": 500}
+        batch_requests.inc(outcome="answered")
+        return {"answer": output}
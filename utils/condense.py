@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+
+from langchain.schema.messages import BaseMessage
+from langchain.schema.runnable import Runnable, RunnableConfig
+
+logger = logging.getLogger(__name__)
+
+_WORDS = re.compile(r"[a-z0-9']+")
+
+# Words that usually point back at something said earlier in the conversation
+_REFERENCE_WORDS = frozenset(
+    """it its it's itself this that these those they them their theirs he him
+    his she her hers there former latter above previous earlier same else
+    another again also""".split()
+)
+
+_FOLLOW_UP_OPENERS = (
+    "and ",
+    "but ",
+    "or ",
+    "so ",
+    "what about",
+    "how about",
+    "why",
+    "elaborate",
+    "explain more",
+    "continue",
+    "go on",
+    "tell me more",
+    "what else",
+)
+
+
+def is_standalone(question: str, min_words: int = 5) -> bool:
+    """Cheap check for follow-ups that already make sense on their own: long
+    enough, not opening like a continuation, and free of words that refer
+    back to earlier turns. Errs on the side of returning False."""
+    text = question.strip().lower()
+    words = _WORDS.findall(text)
+    if len(words) < min_words or text.startswith(_FOLLOW_UP_OPENERS):
+        return False
+    return not any(word in _REFERENCE_WORDS for word in words)
+
+
+def history_hash(chat_history: Sequence[BaseMessage]) -> str:
+    digest = hashlib.sha256()
+    for message in chat_history:
+        digest.update(message.type.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(str(message.content).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class QuestionCondenser:
+    """Turns a follow-up into a standalone question with as little LLM work as
+    possible: standalone follow-ups pass straight through, rephrasings are
+    memoized per (history, question), and a slow condense call falls back to
+    the raw question after `timeout` seconds."""
+
+    def __init__(
+        self, condense_chain: Runnable, timeout: float = 2.0, max_entries: int = 4096
+    ) -> None:
+        self.condense_chain = condense_chain
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._memo: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _memo_key(self, inputs: Dict) -> str:
+        return f"{history_hash(inputs.get('chat_history', []))}:{inputs['question'].strip()}"
+
+    def _lookup(self, inputs: Dict) -> Optional[str]:
+        if is_standalone(inputs["question"]):
+            return inputs["question"]
+        with self._lock:
+            key = self._memo_key(inputs)
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+        return None
+
+    def _remember(self, inputs: Dict, question: str) -> str:
+        question = question.strip()
+        if not question:
+            return inputs["question"]
+        with self._lock:
+            self._memo[self._memo_key(inputs)] = question
+            while len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return question
+
+    def condense(self, inputs: Dict, config: RunnableConfig) -> str:
+        question = self._lookup(inputs)
+        if question is not None:
+            return question
+        return self._remember(inputs, self.condense_chain.invoke(inputs, config))
+
+    async def acondense(self, inputs: Dict, config: RunnableConfig) -> str:
+        question = self._lookup(inputs)
+        if question is not None:
+            return question
+        try:
+            question = await asyncio.wait_for(
+                self.condense_chain.ainvoke(inputs, config), timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Condensing the question timed out, using it as asked")
+            return inputs["question"]
+        return self._remember(inputs, question)
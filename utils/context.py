@@ -0,0 +1,154 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, FrozenSet, List, Optional, Sequence
+
+from langchain.schema import Document
+
+from utils.tokens import count_tokens
+
+_WORDS = re.compile(r"[a-z0-9]+")
+_PARAGRAPHS = re.compile(r"\n\s*\n")
+
+_STOPWORDS = frozenset(
+    """a an and are as at be by for from has have how in is it of on or that
+    the this to was were what when where which who why will with""".split()
+)
+
+
+def parse_budgets(spec: str) -> Dict[str, int]:
+    """Parses "openai=6000,anthropic=8000" into a budget per llm alternative"""
+    budgets = {}
+    for item in spec.split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            budgets[key.strip()] = int(value)
+    return budgets
+
+
+def _terms(text: str) -> List[str]:
+    return [w for w in _WORDS.findall(text.lower()) if w not in _STOPWORDS]
+
+
+def _shingles(words: Sequence[str], size: int = 3) -> FrozenSet[str]:
+    if len(words) < size:
+        return frozenset([" ".join(words)])
+    return frozenset(" ".join(words[i : i + size]) for i in range(len(words) - size + 1))
+
+
+class _Passage:
+    __slots__ = ("doc_index", "position", "text", "terms", "tokens", "score")
+
+    def __init__(self, doc_index: int, position: int, text: str) -> None:
+        self.doc_index = doc_index
+        self.position = position
+        self.text = text
+        self.terms = _terms(text)
+        self.tokens = count_tokens(text)
+        self.score = 0.0
+
+
+class ContextPacker:
+    """Packs retrieved documents into a token budget.
+
+    Documents are split into passages of roughly `passage_tokens` tokens and
+    scored against the question (term overlap weighted by IDF across the
+    retrieved set). Documents are then filled in relevance (retrieval) order,
+    each contributing its best passages up to `max_doc_tokens`, until the
+    budget for the selected llm is spent. Passages that nearly duplicate an
+    already packed passage are skipped."""
+
+    def __init__(
+        self,
+        budgets: Dict[str, int],
+        default_budget: int = 6000,
+        max_doc_tokens: int = 1500,
+        passage_tokens: int = 200,
+        duplicate_threshold: float = 0.8,
+    ) -> None:
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.max_doc_tokens = max_doc_tokens
+        self.passage_tokens = passage_tokens
+        self.duplicate_threshold = duplicate_threshold
+
+    def budget_for(self, llm: Optional[str]) -> int:
+        return self.budgets.get(llm or "openai", self.default_budget)
+
+    def _split(self, doc_index: int, text: str) -> List[_Passage]:
+        max_chars = self.passage_tokens * 4
+        passages, current = [], ""
+        for block in _PARAGRAPHS.split(text):
+            block = block.strip()
+            while len(block) > max_chars:
+                cut = block.rfind(" ", 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                if current:
+                    passages.append(current)
+                    current = ""
+                passages.append(block[:cut])
+                block = block[cut:].strip()
+            if not block:
+                continue
+            if current and len(current) + len(block) > max_chars:
+                passages.append(current)
+                current = ""
+            current = f"{current}\n{block}" if current else block
+        if current:
+            passages.append(current)
+        return [_Passage(doc_index, i, p) for i, p in enumerate(passages)]
+
+    def _score(self, passages: List[_Passage], question: str) -> None:
+        query_terms = set(_terms(question))
+        if not query_terms or not passages:
+            return
+        document_frequency = Counter()
+        for passage in passages:
+            document_frequency.update(query_terms.intersection(passage.terms))
+        n = len(passages)
+        for passage in passages:
+            counts = Counter(passage.terms)
+            length_norm = 1 + math.log(1 + len(passage.terms))
+            passage.score = sum(
+                (1 + math.log(counts[term]))
+                * math.log(1 + n / document_frequency[term])
+                for term in query_terms
+                if counts[term]
+            ) / length_norm
+
+    def pack(
+        self, docs: Sequence[Document], question: str, budget: int
+    ) -> List[Document]:
+        """Returns trimmed copies of the documents that fit in the budget"""
+        by_doc = [self._split(i, doc.page_content) for i, doc in enumerate(docs)]
+        self._score([p for passages in by_doc for p in passages], question)
+
+        kept_shingles: List[FrozenSet[str]] = []
+        packed = []
+        remaining = budget
+        for doc, passages in zip(docs, by_doc):
+            chosen, doc_tokens = [], 0
+            for passage in sorted(passages, key=lambda p: (-p.score, p.position)):
+                if passage.tokens > remaining or doc_tokens + passage.tokens > self.max_doc_tokens:
+                    continue
+                shingles = _shingles(passage.terms)
+                if any(
+                    len(shingles & seen) / len(shingles | seen) >= self.duplicate_threshold
+                    for seen in kept_shingles
+                ):
+                    continue
+                kept_shingles.append(shingles)
+                chosen.append(passage)
+                doc_tokens += passage.tokens
+                remaining -= passage.tokens
+            if chosen:
+                chosen.sort(key=lambda p: p.position)
+                packed.append(
+                    Document(
+                        page_content="\n".join(p.text for p in chosen),
+                        metadata=doc.metadata,
+                    )
+                )
+            if remaining <= 0:
+                break
+        return packed
@@ -0,0 +1,182 @@
+import re
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from utils.fusion import document_url
+from utils.telemetry import near_duplicates
+
+_WORDS = re.compile(r"\w+")
+_MIX = (
+    np.uint64(0x9E3779B97F4A7C15),
+    np.uint64(0xC2B2AE3D27D4EB4F),
+    np.uint64(0x165667B19E3779F9),
+)
+
+
+def _word_hashes(words: Sequence[str]) -> np.ndarray:
+    # str hashes are salted per process, which is fine for fingerprints that
+    # are only ever compared within one call
+    return np.fromiter(map(hash, words), dtype=np.int64, count=len(words)).view(
+        np.uint64
+    )
+
+
+def _shingle_hashes(words: Sequence[str], size: int = 3) -> np.ndarray:
+    """64-bit hashes of the word `size`-grams, mixed from per-word hashes"""
+    hashes = _word_hashes(words)
+    if len(hashes) < size:
+        return hashes
+    mixed = np.zeros(len(hashes) - size + 1, dtype=np.uint64)
+    for i in range(size):
+        mixed ^= hashes[i : len(hashes) - size + 1 + i] * _MIX[i % len(_MIX)]
+    # splitmix64 finalizer, so every bit depends on every word
+    mixed ^= mixed >> np.uint64(30)
+    mixed *= np.uint64(0xBF58476D1CE4E5B9)
+    mixed ^= mixed >> np.uint64(27)
+    mixed *= np.uint64(0x94D049BB133111EB)
+    mixed ^= mixed >> np.uint64(31)
+    return mixed
+
+
+def simhash(shingles: np.ndarray) -> int:
+    """64-bit SimHash of a set of shingle hashes: bit i is set when most of
+    them have bit i set. Repeated shingles count once, so boilerplate
+    repeated across a page does not outvote its text.
+    https://www.cs.princeton.edu/courses/archive/spr04/cos598B/bib/CharikarEstim.pdf"""
+    shingles = np.unique(shingles)
+    if not len(shingles):
+        return 0
+    bits = np.unpackbits(
+        shingles.astype("<u8").view(np.uint8).reshape(-1, 8), axis=1, bitorder="little"
+    )
+    votes = bits.sum(axis=0, dtype=np.int32) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(votes, bitorder="little").tobytes(), "little")
+
+
+class SimHashIndex:
+    """Finds fingerprints within `max_distance` bits of each other.
+
+    Fingerprints are split into `max_distance + 1` bands, and two
+    fingerprints that differ in at most that many bits agree on at least
+    one band, so lookups only compare against fingerprints sharing a band."""
+
+    def __init__(self, max_distance: int = 3) -> None:
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        widths = [64 // bands + (i < 64 % bands) for i in range(bands)]
+        self._bands = [(sum(widths[:i]), width) for i, width in enumerate(widths)]
+        self._buckets: Dict[Tuple[int, int], List[Tuple[int, int]]] = {}
+
+    def _keys(self, fingerprint: int) -> List[Tuple[int, int]]:
+        return [
+            (band, (fingerprint >> start) & ((1 << width) - 1))
+            for band, (start, width) in enumerate(self._bands)
+        ]
+
+    def add(self, fingerprint: int, item: int) -> None:
+        for key in self._keys(fingerprint):
+            self._buckets.setdefault(key, []).append((fingerprint, item))
+
+    def find(self, fingerprint: int) -> Optional[int]:
+        """The first item added with a fingerprint close enough, if any"""
+        for key in self._keys(fingerprint):
+            for other, item in self._buckets.get(key, ()):
+                if bin(fingerprint ^ other).count("1") <= self.max_distance:
+                    return item
+        return None
+
+
+class NearDuplicateFilter:
+    """Collapses retrieved documents that repeat an earlier one, such as the
+    same syndicated article returned by several providers.
+
+    A document is a near-duplicate of a higher-ranked one when their SimHash
+    fingerprints differ in at most `max_distance` bits, or when chunks
+    holding at least `containment` of its text were already seen in that
+    document, which catches copies wrapped in different page boilerplate.
+    Chunks end at content-defined boundaries, about every `chunk_words`
+    words, so the same text is chunked the same way wherever it starts on
+    the page. The higher-ranked copy is kept, and the source URLs of the
+    copies dropped are listed in its `duplicate_sources` metadata so they
+    can still be cited. Lookups are banded or hashed, so the pass is linear
+    in the size of the retrieved set."""
+
+    def __init__(
+        self,
+        max_distance: int = 3,
+        containment: float = 0.5,
+        chunk_words: int = 32,
+        max_chars: int = 10_000,
+    ) -> None:
+        self.max_distance = max_distance
+        self.containment = containment
+        self.chunk_words = chunk_words
+        self.max_chars = max_chars
+
+    def _fingerprints(self, text: str) -> Tuple[int, List[Tuple[int, int]]]:
+        """The document's SimHash, and a hash and length for each chunk"""
+        words = _WORDS.findall(text[: self.max_chars].lower())
+        shingles = _shingle_hashes(words)
+        ends = np.flatnonzero(shingles % np.uint64(self.chunk_words) == 0) + 1
+        bounds = [0] + [int(end) for end in ends if end < len(shingles)]
+        bounds.append(len(shingles))
+        chunks = [
+            (hash(shingles[start:end].tobytes()), end - start)
+            for start, end in zip(bounds, bounds[1:])
+        ]
+        return simhash(shingles), chunks
+
+    def _duplicate_of(
+        self,
+        documents: SimHashIndex,
+        chunks: Dict[int, int],
+        fingerprints: Tuple[int, List[Tuple[int, int]]],
+    ) -> Optional[int]:
+        original = documents.find(fingerprints[0])
+        if original is not None:
+            return original
+        seen: Dict[int, int] = {}
+        for key, size in fingerprints[1]:
+            if key in chunks:
+                seen[chunks[key]] = seen.get(chunks[key], 0) + size
+        total = sum(size for _, size in fingerprints[1])
+        for item, size in seen.items():
+            if size >= self.containment * total:
+                return item
+        return None
+
+    def deduplicate(self, docs: Sequence[Document]) -> List[Document]:
+        documents = SimHashIndex(self.max_distance)
+        chunks: Dict[int, int] = {}
+        kept: List[Document] = []
+        sources: List[List[str]] = []
+        urls: List[Set[str]] = []
+        for doc in docs:
+            fingerprints = self._fingerprints(doc.page_content)
+            original = self._duplicate_of(documents, chunks, fingerprints)
+            url = document_url(doc)
+            if original is None:
+                documents.add(fingerprints[0], len(kept))
+                for key, _ in fingerprints[1]:
+                    chunks.setdefault(key, len(kept))
+                kept.append(doc)
+                sources.append([])
+                urls.append({url} if url else set())
+                continue
+            near_duplicates.inc()
+            if url and url not in urls[original]:
+                urls[original].add(url)
+                sources[original].append(url)
+        return [
+            (
+                Document(
+                    page_content=doc.page_content,
+                    metadata={**doc.metadata, "duplicate_sources": found},
+                )
+                if found
+                else doc
+            )
+            for doc, found in zip(kept, sources)
+        ]
@@ -0,0 +1,65 @@
+import asyncio
+from typing import Any, Callable, Optional, Sequence, Set
+
+# strong references to detached tasks, which the event loop only holds weakly
+_detached: Set[asyncio.Future] = set()
+
+
+def ranked_prefix_ready(
+    tasks: Sequence[asyncio.Future], enough: int
+) -> Callable[[], bool]:
+    """A readiness check for tasks in rank order: true once the highest-ranked
+    finished tasks, up to the first one still running, produced at least
+    `enough` results other than None"""
+
+    def ready() -> bool:
+        found = 0
+        for task in tasks:
+            if not task.done():
+                return False
+            if (
+                not task.cancelled()
+                and task.exception() is None
+                and task.result() is not None
+            ):
+                found += 1
+                if found >= enough:
+                    return True
+        return False
+
+    return ready
+
+
+async def wait_good_enough(
+    tasks: Sequence[asyncio.Future],
+    deadline: Optional[float] = None,
+    ready: Optional[Callable[[], bool]] = None,
+) -> None:
+    """Waits until every task is done, until `ready()` is true, or until
+    `deadline` seconds have passed and at least one task is done, whichever
+    comes first. Tasks still running are left alone."""
+    loop = asyncio.get_running_loop()
+    expires = loop.time() + deadline if deadline is not None else None
+    pending = {task for task in tasks if not task.done()}
+    while pending:
+        if ready is not None and ready():
+            return
+        timeout = None
+        if expires is not None:
+            remaining = expires - loop.time()
+            if remaining > 0:
+                timeout = remaining
+            elif len(pending) < len(tasks):
+                return
+            # past the deadline with nothing done yet: wait for the first one
+        _, pending = await asyncio.wait(
+            pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+
+
+def detach(task: asyncio.Future) -> Any:
+    """Lets a task finish in the background after its caller has moved on"""
+    _detached.add(task)
+    task.add_done_callback(_detached.discard)
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
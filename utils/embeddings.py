@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.callbacks.manager import Callbacks
+from langchain_core.documents.compressor import BaseDocumentCompressor
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+from utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# `usage` holds the total size of the stored vectors, kept by triggers so
+# every process sharing the file sees the same figure
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vectors (
+    key TEXT PRIMARY KEY,
+    vector BLOB NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vectors_accessed_at ON vectors (accessed_at);
+CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+INSERT OR IGNORE INTO usage VALUES (0, (SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors));
+CREATE TRIGGER IF NOT EXISTS vectors_added AFTER INSERT ON vectors
+BEGIN UPDATE usage SET size = size + LENGTH(NEW.vector); END;
+CREATE TRIGGER IF NOT EXISTS vectors_removed AFTER DELETE ON vectors
+BEGIN UPDATE usage SET size = size - LENGTH(OLD.vector); END;
+"""
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings model with a content-hash cache.
+
+    Vectors are kept as float32 in an in-process LRU and in a SQLite file, so
+    chunks seen by any earlier request are never sent upstream again. The
+    file is capped at `max_bytes` of vectors, evicting the least recently
+    used, and a failed read or write of it (a "database is locked" from
+    another worker, say) is treated as a miss. The async methods touch it
+    from a thread. Misses are deduplicated and grouped into as few upstream
+    calls as the `max_batch_tokens`/`max_batch_size` limits allow."""
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        namespace: str,
+        path: str = ":memory:",
+        max_memory_entries: int = 50_000,
+        max_batch_tokens: int = 100_000,
+        max_batch_size: int = 512,
+        max_bytes: int = 256 * 2**20,
+    ) -> None:
+        self.underlying = underlying
+        self.namespace = namespace
+        self.max_memory_entries = max_memory_entries
+        self.max_bytes = max_bytes
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "upstream_calls": 0,
+            "evictions": 0,
+            "disk_errors": 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def reopen(self) -> None:
+        """Opens a fresh connection after fork(); see `PageCache.reopen`"""
+        if self.path != ":memory:":
+            self._lock = threading.Lock()
+            self._conn = self._connect()
+
+    def _key(self, kind: str, text: str) -> str:
+        raw = f"{self.namespace}\0{kind}\0{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_error(self, action: str, e: Exception) -> None:
+        # called with the lock held
+        self._counters["disk_errors"] += 1
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            pass
+        logger.warning("Embedding cache %s failed: %s", action, e)
+
+    def _lookup_memory(self, keys: Sequence[str]) -> Tuple[Dict[str, np.ndarray], List[str]]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            self._counters["hits"] += sum(1 for key in keys if key in found)
+        return found, [key for key in set(keys) if key not in found]
+
+    def _lookup_disk(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            try:
+                for start in range(0, len(keys), 500):
+                    batch = keys[start : start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT key, vector FROM vectors WHERE key IN ({placeholders})",
+                        batch,
+                    ).fetchall()
+                    if rows:
+                        self._conn.execute(
+                            f"UPDATE vectors SET accessed_at = ? WHERE key IN ({placeholders})",
+                            [time.time(), *batch],
+                        )
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        found[key] = vector
+                        self._remember(key, vector)
+                    self._counters["disk_hits"] += len(rows)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._disk_error("read", e)
+        return found
+
+    def _lookup(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        found, missing = self._lookup_memory(keys)
+        if missing:
+            found.update(self._lookup_disk(missing))
+        return found
+
+    async def _alookup(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        found, missing = self._lookup_memory(keys)
+        if missing:
+            found.update(await asyncio.to_thread(self._lookup_disk, missing))
+        return found
+
+    def _store(self, vectors: Dict[str, np.ndarray]) -> None:
+        with self._lock:
+            for key, vector in vectors.items():
+                self._remember(key, vector)
+            try:
+                now = time.time()
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO vectors VALUES (?, ?, ?)",
+                    [(key, vector.tobytes(), now) for key, vector in vectors.items()],
+                )
+                self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._disk_error("write", e)
+
+    async def _astore(self, vectors: Dict[str, np.ndarray]) -> None:
+        await asyncio.to_thread(self._store, vectors)
+
+    def _evict(self) -> None:
+        (size,) = self._conn.execute("SELECT size FROM usage").fetchone()
+        while size > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, LENGTH(vector) FROM vectors ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not rows:
+                return
+            keys = []
+            for key, length in rows:
+                if size <= self.max_bytes:
+                    break
+                keys.append((key,))
+                size -= length
+            self._conn.executemany("DELETE FROM vectors WHERE key = ?", keys)
+            self._counters["evictions"] += len(keys)
+
+    def _batches(self, texts: Sequence[str]) -> Iterator[List[int]]:
+        """Groups text indexes into batches under the token and size limits"""
+        batch, tokens = [], 0
+        for i, text in enumerate(texts):
+            n = count_tokens(text)
+            if batch and (
+                tokens + n > self.max_batch_tokens or len(batch) >= self.max_batch_size
+            ):
+                yield batch
+                batch, tokens = [], 0
+            batch.append(i)
+            tokens += n
+        if batch:
+            yield batch
+
+    def _pending(
+        self, keys: List[str], texts: List[str], found: Dict[str, np.ndarray]
+    ) -> List[Tuple[str, str]]:
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                pending.setdefault(key, text)
+        with self._lock:
+            self._counters["misses"] += len(pending)
+        return list(pending.items())
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key("doc", text) for text in texts]
+        found = self._lookup(keys)
+        pending = self._pending(keys, texts, found)
+        for batch in self._batches([text for _, text in pending]):
+            vectors = self.underlying.embed_documents([pending[i][1] for i in batch])
+            self._count_upstream()
+            new = {pending[i][0]: np.asarray(v, dtype=np.float32) for i, v in zip(batch, vectors)}
+            self._store(new)
+            found.update(new)
+        return [found[key].tolist() for key in keys]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key("doc", text) for text in texts]
+        found = await self._alookup(keys)
+        pending = self._pending(keys, texts, found)
+        for batch in self._batches([text for _, text in pending]):
+            vectors = await self.underlying.aembed_documents(
+                [pending[i][1] for i in batch]
+            )
+            self._count_upstream()
+            new = {pending[i][0]: np.asarray(v, dtype=np.float32) for i, v in zip(batch, vectors)}
+            await self._astore(new)
+            found.update(new)
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key("query", text)
+        found = self._lookup([key])
+        if key not in found:
+            found[key] = np.asarray(self.underlying.embed_query(text), dtype=np.float32)
+            self._count_upstream()
+            self._store({key: found[key]})
+        return found[key].tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key("query", text)
+        found = await self._alookup([key])
+        if key not in found:
+            found[key] = np.asarray(
+                await self.underlying.aembed_query(text), dtype=np.float32
+            )
+            self._count_upstream()
+            await self._astore({key: found[key]})
+        return found[key].tolist()
+
+    def _count_upstream(self) -> None:
+        with self._lock:
+            self._counters["upstream_calls"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            try:
+                (size,) = self._conn.execute("SELECT size FROM usage").fetchone()
+            except sqlite3.Error:
+                size = -1
+            return dict(self._counters, memory_entries=len(self._memory), size_bytes=size)
+
+
+def cached_openai_embeddings(**kwargs: Any) -> CachedEmbeddings:
+    """OpenAI embeddings behind the cache file named by EMBEDDING_CACHE_PATH,
+    capped at EMBEDDING_CACHE_MAX_BYTES; `kwargs` go to OpenAIEmbeddings"""
+    from langchain_openai import OpenAIEmbeddings
+
+    underlying = OpenAIEmbeddings(**kwargs)
+    return CachedEmbeddings(
+        underlying,
+        namespace=underlying.model,
+        path=os.environ.get("EMBEDDING_CACHE_PATH", "/tmp/embedding_cache.sqlite3"),
+        max_bytes=int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", 256 * 2**20)),
+    )
+
+
+def cosine_similarity_to(matrix: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    """Cosine similarity of every row of `matrix` to `vector`"""
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    norms[norms == 0] = 1.0
+    return (matrix @ vector) / norms
+
+
+class VectorizedEmbeddingsFilter(BaseDocumentCompressor):
+    """Drops documents whose embedding is not similar enough to the query's.
+    Equivalent to EmbeddingsFilter with a similarity threshold, but scores
+    all chunks in a single float32 matrix-vector product and supports the
+    async embedding path."""
+
+    embeddings: Embeddings
+    similarity_threshold: float = 0.8
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _filter(
+        self,
+        documents: Sequence[Document],
+        doc_vectors: List[List[float]],
+        query_vector: List[float],
+    ) -> List[Document]:
+        similarity = cosine_similarity_to(
+            np.asarray(doc_vectors, dtype=np.float32),
+            np.asarray(query_vector, dtype=np.float32),
+        )
+        return [documents[i] for i in np.flatnonzero(similarity > self.similarity_threshold)]
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        if not documents:
+            return []
+        doc_vectors = self.embeddings.embed_documents([d.page_content for d in documents])
+        return self._filter(documents, doc_vectors, self.embeddings.embed_query(query))
+
+    async def acompress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        if not documents:
+            return []
+        doc_vectors = await self.embeddings.aembed_documents(
+            [d.page_content for d in documents]
+        )
+        query_vector = await self.embeddings.aembed_query(query)
+        return self._filter(documents, doc_vectors, query_vector)
@@ -0,0 +1,169 @@
+import asyncio
+import multiprocessing
+import re
+from concurrent.futures import Executor, ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+
+# Elements whose text is navigation, chrome or code rather than content.
+# `form` is not one: ASP.NET WebForms pages wrap the whole body in one.
+BOILERPLATE_TAGS = frozenset(
+    """script style noscript template svg canvas iframe object nav footer
+    aside button select dialog menu""".split()
+)
+# Site chrome outside the main content, but an article's own title and
+# byline inside it
+PAGE_CHROME_TAGS = frozenset(["header"])
+CONTENT_TAGS = frozenset(["main", "article"])
+BOILERPLATE_ROLES = frozenset(
+    ["navigation", "banner", "contentinfo", "complementary", "search", "menu", "dialog"]
+)
+BLOCK_TAGS = frozenset(
+    """p div br hr li ul ol dl dt dd h1 h2 h3 h4 h5 h6 tr table thead tbody
+    section article main blockquote pre figure figcaption caption""".split()
+)
+VOID_TAGS = frozenset(
+    "area base br col embed hr img input link meta param source track wbr".split()
+)
+_SPACES = re.compile(r"\s+")
+
+
+class TextExtractor(HTMLParser):
+    """Incremental HTML-to-text converter.
+
+    Text inside boilerplate elements is dropped, block elements become line
+    breaks, and once `max_chars` characters of text have been collected
+    `done` is set and further input is ignored, so the cost of a page is
+    bounded by the cap rather than by its size."""
+
+    def __init__(self, max_chars: int = 50_000) -> None:
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.title: Optional[str] = None
+        self.done = False
+        self._lines: List[str] = []
+        self._line: List[str] = []
+        self._chars = 0
+        self._skip_tag: Optional[str] = None
+        self._skip_depth = 0
+        self._content_depth = 0
+        self._in_title = False
+
+    def feed(self, data: str) -> None:
+        if not self.done:
+            super().feed(data)
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+        attributes = dict(attrs)
+        if tag not in VOID_TAGS and (
+            tag in BOILERPLATE_TAGS
+            or (tag in PAGE_CHROME_TAGS and not self._content_depth)
+            or attributes.get("role") in BOILERPLATE_ROLES
+            or "hidden" in attributes
+            or attributes.get("aria-hidden") == "true"
+        ):
+            self._skip_tag, self._skip_depth = tag, 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag in BLOCK_TAGS or tag in PAGE_CHROME_TAGS:
+            if tag in CONTENT_TAGS:
+                self._content_depth += 1
+            self._break()
+
+    def handle_startendtag(
+        self, tag: str, attrs: List[Tuple[str, Optional[str]]]
+    ) -> None:
+        if self._skip_tag is None and tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_endtag(self, tag: str) -> None:
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    self._skip_tag = None
+            return
+        if tag == "title":
+            self._in_title = False
+        elif tag in BLOCK_TAGS or tag in PAGE_CHROME_TAGS:
+            if tag in CONTENT_TAGS and self._content_depth:
+                self._content_depth -= 1
+            self._break()
+
+    def handle_data(self, data: str) -> None:
+        if self._skip_tag is not None or self.done:
+            return
+        if self._in_title:
+            self.title = _SPACES.sub(" ", (self.title or "") + data).strip() or None
+            return
+        text = _SPACES.sub(" ", data)
+        if text.strip():
+            self._line.append(text)
+            self._chars += len(text)
+            if self._chars >= self.max_chars:
+                self.done = True
+
+    def _break(self) -> None:
+        line = "".join(self._line).strip()
+        if line:
+            self._lines.append(line)
+        self._line = []
+
+    @property
+    def text(self) -> str:
+        self._break()
+        return "\n".join(self._lines)[: self.max_chars]
+
+
+def extract_text(
+    html: str, max_chars: int = 50_000, chunk_size: int = 64 * 1024
+) -> Tuple[str, Optional[str]]:
+    """Returns (text, title) for a page, feeding it to a TextExtractor in
+    chunks and stopping as soon as `max_chars` of text have been found"""
+    extractor = TextExtractor(max_chars)
+    for start in range(0, len(html), chunk_size):
+        extractor.feed(html[start : start + chunk_size])
+        if extractor.done:
+            break
+    if not extractor.done:
+        extractor.close()
+    return extractor.text, extractor.title
+
+
+class ExtractionPool:
+    """Runs `extract_text` in a process pool so parsing large pages neither
+    blocks the event loop nor holds the GIL.
+
+    The pool is started lazily with the "spawn" method, so it is safe to
+    create before a preloading server forks its workers. Spawned processes
+    re-run the main script before anything else, so the service must not
+    be it; app.py hands `python app.py` over to uvicorn for that reason.
+    With `processes=0` extraction runs on the default thread pool instead."""
+
+    def __init__(self, processes: int = 2, max_chars: int = 50_000) -> None:
+        self.processes = processes
+        self.max_chars = max_chars
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Optional[Executor]:
+        if self.processes > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def extract(self, html: str) -> Tuple[str, Optional[str]]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(), extract_text, html, self.max_chars
+        )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
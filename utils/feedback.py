@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class FeedbackQueue:
+    """Sends LangSmith feedback writes from a background task.
+
+    `submit` returns immediately and reports False when the queue is full so
+    callers can push back; the worker is started on first use. The worker
+    drains up to `batch_size` writes at a time, sends each batch in one
+    executor job, and retries failed writes up to `max_retries` times with
+    exponential backoff."""
+
+    def __init__(
+        self,
+        executor: Executor,
+        max_size: int = 1000,
+        batch_size: int = 20,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ) -> None:
+        self.executor = executor
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._retries: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flushes pending writes, then stops the worker"""
+        if self._worker is None:
+            return
+        await self._queue.join()
+        while self._retries:
+            await asyncio.gather(*self._retries)
+            await self._queue.join()
+        self._worker.cancel()
+        self._worker = None
+
+    def submit(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> bool:
+        # restart when called from a new event loop, e.g. under TestClient
+        if self._worker is None or self._loop is not asyncio.get_running_loop():
+            self.start()
+        try:
+            self._queue.put_nowait((func, args, kwargs, 0))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def _send_batch(
+        self, batch: List[Tuple[Callable, tuple, Dict, int]]
+    ) -> List[Tuple[Callable, tuple, Dict, int]]:
+        failed = []
+        for func, args, kwargs, attempt in batch:
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                if attempt + 1 < self.max_retries:
+                    failed.append((func, args, kwargs, attempt + 1))
+                else:
+                    logger.error("Dropping feedback write after %d attempts: %s", attempt + 1, e)
+        return failed
+
+    async def _retry_later(self, item: Tuple[Callable, tuple, Dict, int]) -> None:
+        await asyncio.sleep(self.backoff * 2 ** (item[3] - 1))
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.error("Dropping feedback retry, queue is full")
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                failed = await loop.run_in_executor(self.executor, self._send_batch, batch)
+                for item in failed:
+                    task = asyncio.create_task(self._retry_later(item))
+                    self._retries.add(task)
+                    task.add_done_callback(self._retries.discard)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
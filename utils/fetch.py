@@ -0,0 +1,92 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; GoogleCloudLangchain/1.0)",
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+}
+
+
+@dataclass
+class FetchedPage:
+    url: str
+    status: int
+    text: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    truncated: bool = False
+
+
+class PageFetcher:
+    """Fetches pages over one long-lived aiohttp connection pool.
+
+    The pool caps total and per-host connections, every request has its own
+    timeout, and bodies are cut off after `max_bytes`. The session is created
+    lazily on the running event loop and must be closed with `close()`."""
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        max_connections_per_host: int = 4,
+        max_bytes: int = 2_000_000,
+        timeout: float = 5.0,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.headers = headers or DEFAULT_HEADERS
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=self.headers
+            )
+        return self._session
+
+    async def _read_limited(self, resp: aiohttp.ClientResponse) -> Tuple[bytes, bool]:
+        body = bytearray()
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            body.extend(chunk)
+            if len(body) >= self.max_bytes:
+                return bytes(body[: self.max_bytes]), True
+        return bytes(body), False
+
+    async def fetch(
+        self, url: str, headers: Optional[Dict[str, str]] = None
+    ) -> Optional[FetchedPage]:
+        """Fetches a single URL, returning None on network errors or timeouts"""
+        session = self._get_session()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            async with session.get(url, headers=headers, timeout=timeout) as resp:
+                body, truncated = await self._read_limited(resp)
+                encoding = resp.get_encoding() if resp.charset else "utf-8"
+                return FetchedPage(
+                    url=str(resp.url),
+                    status=resp.status,
+                    text=body.decode(encoding, errors="replace"),
+                    headers={k.lower(): v for k, v in resp.headers.items()},
+                    truncated=truncated,
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, LookupError):
+            return None
+
+    async def fetch_all(self, urls: Sequence[str]) -> List[Optional[FetchedPage]]:
+        """Fetches URLs concurrently and returns them in the order given"""
+        return list(await asyncio.gather(*(self.fetch(url) for url in urls)))
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,59 @@
+import hashlib
+import re
+from typing import Dict, List, Optional, Sequence
+from urllib.parse import urlsplit, urlunsplit
+
+from langchain.schema import Document
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_url(url: str) -> str:
+    """Lowercases scheme and host, drops fragments and trailing slashes so the
+    same page reached through different providers compares equal"""
+    parts = urlsplit(url.strip())
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), path, parts.query, "")
+    )
+
+
+def document_url(doc: Document) -> Optional[str]:
+    """Returns the source URL of a document, whichever provider produced it"""
+    for key in ("source", "url", "link"):
+        value = doc.metadata.get(key)
+        if isinstance(value, str) and value.startswith(("http://", "https://")):
+            return value
+    return None
+
+
+def content_key(doc: Document, prefix_chars: int = 2000) -> str:
+    """Hash of the whitespace-normalized leading text of a document"""
+    text = _WHITESPACE.sub(" ", doc.page_content[:prefix_chars]).strip().lower()
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(
+    result_lists: Sequence[List[Document]], k: int = 60, limit: Optional[int] = None
+) -> List[Document]:
+    """Merges ranked result lists with reciprocal-rank fusion, collapsing
+    documents that share a normalized URL or identical content.
+    https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf"""
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    aliases: Dict[str, str] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            url = document_url(doc)
+            keys = [content_key(doc)]
+            if url:
+                keys.insert(0, normalize_url(url))
+            canonical = next((aliases[key] for key in keys if key in aliases), keys[0])
+            for key in keys:
+                aliases.setdefault(key, canonical)
+            scores[canonical] = scores.get(canonical, 0.0) + 1.0 / (k + rank + 1)
+            docs.setdefault(canonical, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    if limit is not None:
+        ranked = ranked[:limit]
+    return [docs[key] for key in ranked]
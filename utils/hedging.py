@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema.messages import BaseMessage
+from langchain.schema.output import ChatGenerationChunk, ChatResult
+from langchain_core.language_models.chat_models import (
+    agenerate_from_stream,
+    generate_from_stream,
+)
+
+from utils.telemetry import breaker_transitions, llm_failovers, llm_hedges
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Tracks a provider's recent calls and stops routing to it while too
+    many of them fail or are slow.
+
+    The breaker opens when, over the last `window` calls (and at least
+    `min_calls`), the share that failed or took longer than `slow_after`
+    seconds to produce a first token reaches `failure_rate`. After
+    `cooldown` seconds a single probe call is let through; its outcome
+    closes the breaker or opens it again. A probe that has not reported
+    back within `slow_after` seconds is given up on, and another is let
+    through.
+
+    `available()` only looks; `allow()` takes the probe, so call it just
+    before actually starting a call."""
+
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        min_calls: int = 5,
+        failure_rate: float = 0.5,
+        slow_after: float = 10.0,
+        cooldown: float = 30.0,
+    ) -> None:
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_after = slow_after
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._calls: Deque[bool] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str) -> None:
+        if state != self.state:
+            logger.warning("Circuit breaker for %s: %s -> %s", self.name, self.state, state)
+            breaker_transitions.inc(provider=self.name, state=state)
+            self.state = state
+
+    def _can_probe(self, now: float) -> bool:
+        if self.state == "open":
+            return now - self._opened_at >= self.cooldown
+        return self.state == "half_open" and now - self._probe_at >= self.slow_after
+
+    def available(self) -> bool:
+        with self._lock:
+            return self.state == "closed" or self._can_probe(time.monotonic())
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self._can_probe(now):
+                self._transition("half_open")
+                self._probe_at = now
+                return True
+            return self.state == "closed"
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        bad = not ok or (latency is not None and latency > self.slow_after)
+        with self._lock:
+            if self.state == "half_open":
+                self._calls.clear()
+                if bad:
+                    self._opened_at = time.monotonic()
+                    self._transition("open")
+                else:
+                    self._transition("closed")
+                return
+            self._calls.append(bad)
+            if (
+                self.state == "closed"
+                and len(self._calls) >= self.min_calls
+                and sum(self._calls) / len(self._calls) >= self.failure_rate
+            ):
+                self._opened_at = time.monotonic()
+                self._transition("open")
+
+
+class HedgedChatModel(BaseChatModel):
+    """Streams from `primary` and fails over or hedges to `backups`.
+
+    If the primary has not produced its first token after `hedge_after`
+    seconds, the next backup is started as well; whichever stream yields a
+    token first is kept and the other is cancelled. A model that fails
+    before its first token is replaced by the next backup. Providers whose
+    circuit breaker is open are skipped, unless every breaker is open.
+
+    `models` maps provider names to chat models, or to zero-argument
+    factories for ones that are built lazily. `acquire`/`acquire_sync`, if
+    given, are awaited with the provider name before each call, so
+    per-provider rate limits still apply."""
+
+    primary: str
+    backups: List[str]
+    models: Dict[str, Any]
+    hedge_after: float = 2.0
+    breakers: Dict[str, Any] = {}
+    acquire: Optional[Callable[[str], Any]] = None
+    acquire_sync: Optional[Callable[[str], Any]] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat-model"
+
+    def _model(self, name: str) -> BaseChatModel:
+        model = self.models[name]
+        return model if isinstance(model, BaseChatModel) else model()
+
+    def _candidates(self) -> List[str]:
+        names = [self.primary] + [b for b in self.backups if b in self.models]
+        allowed = [
+            name
+            for name in names
+            if name not in self.breakers or self.breakers[name].available()
+        ]
+        return allowed or names
+
+    def _claim(self, candidates: List[str], first: bool = False) -> Optional[str]:
+        """Takes the next candidate whose breaker lets a call through now,
+        claiming the probe of a half-open one. A request's `first` call goes
+        ahead even when every breaker refuses it."""
+        forced = all(
+            name in self.breakers and not self.breakers[name].available()
+            for name in candidates
+        )
+        refused = None
+        while candidates:
+            name = candidates.pop(0)
+            if forced or name not in self.breakers or self.breakers[name].allow():
+                return name
+            refused = refused or name
+        return refused if first else None
+
+    def _record(self, name: str, ok: bool, latency: Optional[float] = None) -> None:
+        if name in self.breakers:
+            self.breakers[name].record(ok, latency)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(
+            self._astream(messages, stop, run_manager, **kwargs)
+        )
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # Without an event loop there is nothing to race; fail over in order
+        error: Optional[BaseException] = None
+        config = {"callbacks": run_manager.get_child()} if run_manager else {}
+        candidates = self._candidates()
+        name = self._claim(candidates, first=True)
+        while name is not None:
+            started = time.perf_counter()
+            try:
+                # a throttled provider or a lazy model that fails to build
+                # fails over like a first-token error
+                if self.acquire_sync is not None:
+                    self.acquire_sync(name)
+                stream = self._model(name).stream(messages, config, stop=stop, **kwargs)
+                first = next(stream, None)
+            except Exception as e:
+                self._record(name, False)
+                logger.warning("%s failed before its first token: %s", name, e)
+                error = e
+                failed, name = name, self._claim(candidates)
+                if name is not None:
+                    llm_failovers.inc(provider=failed)
+                continue
+            self._record(name, True, time.perf_counter() - started)
+            for message in [first] if first is not None else []:
+                yield self._chunk(message, run_manager)
+            for message in stream:
+                yield self._chunk(message, run_manager)
+            return
+        raise error
+
+    @staticmethod
+    def _chunk(
+        message: Any, run_manager: Optional[CallbackManagerForLLMRun]
+    ) -> ChatGenerationChunk:
+        chunk = ChatGenerationChunk(message=message)
+        if run_manager is not None:
+            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        return chunk
+
+    @staticmethod
+    async def _achunk(
+        message: Any, run_manager: Optional[AsyncCallbackManagerForLLMRun]
+    ) -> ChatGenerationChunk:
+        chunk = ChatGenerationChunk(message=message)
+        if run_manager is not None:
+            await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        return chunk
+
+    async def _start(
+        self, name: str, messages: List[BaseMessage], config: dict, **kwargs: Any
+    ) -> Tuple[Any, Any]:
+        if self.acquire is not None:
+            await self.acquire(name)
+        stream = self._model(name).astream(messages, config, **kwargs)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        return stream, first
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        config = {"callbacks": run_manager.get_child()} if run_manager else {}
+        candidates = self._candidates()
+        racing: Dict[asyncio.Task, Tuple[str, float]] = {}
+        error: Optional[BaseException] = None
+
+        def start_next(first: bool = False) -> Optional[str]:
+            name = self._claim(candidates, first)
+            if name is None:
+                return None
+            task = asyncio.ensure_future(
+                self._start(name, messages, config, stop=stop, **kwargs)
+            )
+            racing[task] = (name, time.perf_counter())
+            return name
+
+        start_next(first=True)
+        try:
+            while racing:
+                # only hedge while a single request is in flight
+                timeout = self.hedge_after if len(racing) == 1 and candidates else None
+                done, _ = await asyncio.wait(
+                    racing, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    (slow,) = racing.values()
+                    logger.info(
+                        "%s has no first token after %ss, hedging", slow[0], self.hedge_after
+                    )
+                    backup = start_next()
+                    if backup is not None:
+                        llm_hedges.inc(provider=slow[0], backup=backup)
+                    continue
+                winner = None
+                for task in done:
+                    name, started = racing.pop(task)
+                    if task.exception() is not None:
+                        self._record(name, False)
+                        logger.warning(
+                            "%s failed before its first token: %s", name, task.exception()
+                        )
+                        error = task.exception()
+                        if not racing and start_next():
+                            llm_failovers.inc(provider=name)
+                    elif winner is None:
+                        winner = (name, started, task.result())
+                    else:
+                        # a tie; keep the first and drop this stream
+                        self._record(name, True, time.perf_counter() - started)
+                        await task.result()[0].aclose()
+                if winner is None:
+                    continue
+
+                name, started, (stream, first) = winner
+                self._record(name, True, time.perf_counter() - started)
+                for task, (loser, loser_started) in racing.items():
+                    task.cancel()
+                    # losing the race is no error; the breaker's own
+                    # `slow_after` decides whether the time it took was slow
+                    self._record(loser, True, time.perf_counter() - loser_started)
+                racing.clear()
+                for message in [first] if first is not None else []:
+                    yield await self._achunk(message, run_manager)
+                async for message in stream:
+                    yield await self._achunk(message, run_manager)
+                return
+        finally:
+            for task in racing:
+                task.cancel()
+        raise error
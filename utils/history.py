@@ -0,0 +1,345 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+from uuid import uuid4
+
+from langchain.schema.messages import AIMessage, BaseMessage, HumanMessage
+from langchain.schema.runnable import Runnable, RunnableConfig
+
+from utils.telemetry import history_summaries
+from utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+Turn = Tuple[str, str]
+
+_MESSAGES = {"human": HumanMessage, "ai": AIMessage}
+_SPEAKERS = {"human": "Human", "ai": "AI"}
+
+
+@lru_cache(maxsize=16384)
+def _turn_tokens(text: str) -> int:
+    return count_tokens(text)
+
+
+def prefix_hashes(turns: Sequence[Turn]) -> List[str]:
+    """`hashes[i]` identifies `turns[:i]`, so every prefix of a conversation
+    is hashed in a single pass"""
+    digest = hashlib.sha256()
+    hashes = [digest.hexdigest()]
+    for role, text in turns:
+        digest.update(f"{role}\0{text}\0".encode("utf-8"))
+        hashes.append(digest.hexdigest())
+    return hashes
+
+
+def to_messages(turns: Sequence[Turn]) -> List[BaseMessage]:
+    return [_MESSAGES[role](content=text) for role, text in turns if role in _MESSAGES]
+
+
+def format_turns(turns: Sequence[Turn]) -> str:
+    return "\n".join(f"{_SPEAKERS.get(role, role)}: {text}" for role, text in turns)
+
+
+class HistoryWindow:
+    """Bounds the chat history sent to the LLMs by tokens rather than turns.
+
+    The newest turns that fit in `max_tokens` are kept as messages; older
+    turns are replaced by a summary, prepended as a human message so roles
+    still alternate. Summaries are cached by a hash of the turns they cover
+    and rolled forward: a longer prefix is summarized by extending the
+    cached summary of a shorter one with just the turns after it. When a
+    summary takes longer than `timeout` seconds the older turns are dropped
+    for this request, and the summary is finished in the background for the
+    next one."""
+
+    def __init__(
+        self,
+        summarizer: Optional[Runnable] = None,
+        max_tokens: int = 2000,
+        timeout: float = 2.0,
+        max_entries: int = 4096,
+    ) -> None:
+        self.summarizer = summarizer
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    def _window_start(self, turns: Sequence[Turn]) -> int:
+        """Index of the oldest turn kept verbatim; the newest turn is always kept"""
+        start, used = len(turns), 0
+        while start > 0:
+            tokens = _turn_tokens(turns[start - 1][1])
+            if used + tokens > self.max_tokens and start < len(turns):
+                break
+            used += tokens
+            start -= 1
+        return start
+
+    @staticmethod
+    def _next_turn(turns: Sequence[Turn], start: int, role: str) -> int:
+        while start < len(turns) and turns[start][0] != role:
+            start += 1
+        return start
+
+    def _cached(self, hashes: List[str], end: int) -> Tuple[int, Optional[str]]:
+        """The longest summarized prefix of `turns[:end]` and its summary"""
+        with self._lock:
+            for i in range(end, 0, -1):
+                summary = self._summaries.get(hashes[i])
+                if summary is not None:
+                    self._summaries.move_to_end(hashes[i])
+                    return i, summary
+        return 0, None
+
+    def _remember(self, key: str, summary: str) -> str:
+        summary = summary.strip()
+        with self._lock:
+            self._summaries[key] = summary
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+        return summary
+
+    @staticmethod
+    def _summary_inputs(
+        turns: Sequence[Turn], done: int, end: int, previous: Optional[str]
+    ) -> Dict[str, str]:
+        return {
+            "summary": previous or "(none yet)",
+            "turns": format_turns(turns[done:end]),
+        }
+
+    def _messages(
+        self, turns: Sequence[Turn], window: int, start: int, summary: Optional[str]
+    ) -> List[BaseMessage]:
+        if summary is None:
+            # without a summary, the window begins on a human turn
+            return to_messages(turns[self._next_turn(turns, window, "human") :])
+        return [
+            HumanMessage(content=f"Summary of our conversation so far: {summary}")
+        ] + to_messages(turns[start:])
+
+    def _plan(self, history: Sequence[Turn]) -> Tuple[List[Turn], int, int]:
+        """The turns, where the token window starts, and where the turns kept
+        after a summary start: the summary is a human message, so those
+        begin with the ai"""
+        turns = [tuple(turn) for turn in history]
+        window = self._window_start(turns)
+        start = self._next_turn(turns, window, "ai") if window else 0
+        return turns, window, start
+
+    def window(
+        self, request: Dict, config: Optional[RunnableConfig] = None
+    ) -> List[BaseMessage]:
+        turns, window, start = self._plan(request.get("chat_history", []))
+        if start == 0 or self.summarizer is None:
+            return self._messages(turns, window, start, None)
+        hashes = prefix_hashes(turns[:start])
+        done, summary = self._cached(hashes, start)
+        if done < start:
+            summary = self._remember(
+                hashes[start],
+                self.summarizer.invoke(
+                    self._summary_inputs(turns, done, start, summary), config
+                ),
+            )
+            history_summaries.inc(outcome="built")
+        else:
+            history_summaries.inc(outcome="cached")
+        return self._messages(turns, window, start, summary)
+
+    async def awindow(
+        self, request: Dict, config: Optional[RunnableConfig] = None
+    ) -> List[BaseMessage]:
+        turns, window, start = self._plan(request.get("chat_history", []))
+        if start == 0 or self.summarizer is None:
+            return self._messages(turns, window, start, None)
+        hashes = prefix_hashes(turns[:start])
+        done, summary = self._cached(hashes, start)
+        if done == start:
+            history_summaries.inc(outcome="cached")
+            return self._messages(turns, window, start, summary)
+
+        key = hashes[start]
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            inputs = self._summary_inputs(turns, done, start, summary)
+            task = asyncio.ensure_future(self._summarize(key, inputs, config))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        try:
+            summary = await asyncio.wait_for(asyncio.shield(task), self.timeout)
+            history_summaries.inc(outcome="built" if summary is not None else "failed")
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Summarizing the chat history timed out, dropping older turns"
+            )
+            history_summaries.inc(outcome="timeout")
+            summary = None
+        return self._messages(turns, window, start, summary)
+
+    async def _summarize(
+        self, key: str, inputs: Dict[str, str], config: Optional[RunnableConfig]
+    ) -> Optional[str]:
+        try:
+            return self._remember(key, await self.summarizer.ainvoke(inputs, config))
+        except Exception as e:
+            logger.warning("Summarizing the chat history failed: %s", e)
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"summaries": len(self._summaries), "inflight": len(self._inflight)}
+
+
+class ConversationStore:
+    """SQLite-backed chat histories, so clients can send a conversation id
+    instead of replaying every turn with each request.
+
+    Ids are random uuid4s issued by `create`, and turns are only stored for
+    ids the store issued. Only the newest `max_turns` turns of a
+    conversation are kept, and conversations untouched for `ttl` seconds
+    are deleted. The async methods run the queries in a thread, since
+    another worker may hold the file's write lock."""
+
+    def __init__(
+        self, path: str = ":memory:", ttl: float = 24 * 3600, max_turns: int = 200
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._appends = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations (conversation_id TEXT PRIMARY KEY, "
+            "touched_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS turns (conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "role TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (conversation_id, seq))"
+        )
+        return conn
+
+    def reopen(self) -> None:
+        """Opens a fresh connection after fork(); see `PageCache.reopen`"""
+        if self.path != ":memory:":
+            self._lock = threading.Lock()
+            self._conn = self._connect()
+
+    def create(self) -> str:
+        """Issues a new conversation id"""
+        conversation_id = str(uuid4())
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO conversations VALUES (?, ?)", (conversation_id, time.time())
+            )
+            self._conn.commit()
+        return conversation_id
+
+    def exists(self, conversation_id: str) -> bool:
+        """Whether the id was issued by `create` and has not expired or been
+        deleted since"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT touched_at FROM conversations WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+        if row is not None and row[0] < time.time() - self.ttl:
+            self.delete(conversation_id)
+            return False
+        return row is not None
+
+    def load(self, conversation_id: str) -> List[Turn]:
+        if not self.exists(conversation_id):
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM turns WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,),
+            ).fetchall()
+        return [(role, content) for role, content in rows]
+
+    def append(self, conversation_id: str, turns: Sequence[Turn]) -> bool:
+        """Appends turns to an issued conversation; returns False, storing
+        nothing, for an id that was never issued or is gone"""
+        now = time.time()
+        with self._lock:
+            touched = self._conn.execute(
+                "UPDATE conversations SET touched_at = ? WHERE conversation_id = ? "
+                "AND touched_at >= ?",
+                (now, conversation_id, now - self.ttl),
+            ).rowcount
+            if not touched:
+                self._conn.rollback()
+                return False
+            (last,) = self._conn.execute(
+                "SELECT COALESCE(MAX(seq), -1) FROM turns WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+            self._conn.executemany(
+                "INSERT INTO turns VALUES (?, ?, ?, ?, ?)",
+                [
+                    (conversation_id, last + 1 + i, role, content, now)
+                    for i, (role, content) in enumerate(turns)
+                ],
+            )
+            self._conn.execute(
+                "DELETE FROM turns WHERE conversation_id = ? AND seq < ?",
+                (conversation_id, last + 1 + len(turns) - self.max_turns),
+            )
+            self._appends += 1
+            if self._appends % 100 == 0:
+                self._expire(now)
+            self._conn.commit()
+        return True
+
+    def _expire(self, now: float) -> None:
+        self._conn.execute(
+            "DELETE FROM conversations WHERE touched_at < ?", (now - self.ttl,)
+        )
+        self._conn.execute(
+            "DELETE FROM turns WHERE conversation_id NOT IN "
+            "(SELECT conversation_id FROM conversations)"
+        )
+
+    def delete(self, conversation_id: str) -> bool:
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,)
+            ).rowcount
+            self._conn.execute(
+                "DELETE FROM turns WHERE conversation_id = ?", (conversation_id,)
+            )
+            self._conn.commit()
+        return deleted > 0
+
+    async def acreate(self) -> str:
+        return await asyncio.to_thread(self.create)
+
+    async def aexists(self, conversation_id: str) -> bool:
+        return await asyncio.to_thread(self.exists, conversation_id)
+
+    async def aload(self, conversation_id: str) -> List[Turn]:
+        return await asyncio.to_thread(self.load, conversation_id)
+
+    async def aappend(self, conversation_id: str, turns: Sequence[Turn]) -> bool:
+        return await asyncio.to_thread(self.append, conversation_id, turns)
+
+    async def adelete(self, conversation_id: str) -> bool:
+        return await asyncio.to_thread(self.delete, conversation_id)
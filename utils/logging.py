@@ -12,78 +12,249 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict
+import atexit
+import copy
+import logging
+import os
+import queue
+import sys
+import threading
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, Optional, TextIO
 
-from flask import request
-import structlog
+import orjson
 
-from utils import metadata
+# X-Cloud-Trace-Context of the request being handled, set by TraceContextMiddleware
+trace_context: ContextVar[Optional[str]] = ContextVar("trace_context", default=None)
 
+# LogRecord attributes that are not structured fields passed with `extra=`
+_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | {"message", "asctime", "trace_header"}
+_EXCEPTION_FORMATTER = logging.Formatter()
 
-def field_name_modifier(
-    logger: structlog.PrintLogger, log_method: str, event_dict: Dict
-) -> Dict:
-    """Changes the keys for some of the fields,
-    to match Cloud Logging's expectations
-    https://cloud.google.com/run/docs/logging#special-fields
-    """
-    # structlog example adapted from
-    # https://github.com/ymotongpoo/cloud-logging-configurations/blob/master/python/structlog/main.py
 
-    event_dict["severity"] = event_dict["level"]
-    del event_dict["level"]
+class TraceContextMiddleware:
+    """ASGI middleware recording each request's trace header for the logs.
+    Pure ASGI, so it adds nothing to streamed responses."""
 
-    if "event" in event_dict:
-        event_dict["message"] = event_dict["event"]
-        del event_dict["event"]
-    return event_dict
+    def __init__(self, app: Callable) -> None:
+        self.app = app
 
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        header = None
+        for name, value in scope["headers"]:
+            if name == b"x-cloud-trace-context":
+                header = value.decode("latin-1")
+                break
+        token = trace_context.set(header)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            trace_context.reset(token)
 
-def trace_modifier(
-    logger: structlog.PrintLogger, log_method: str, event_dict: Dict
-) -> Dict:
-    """Adds Tracing correlation
-    https://cloud.google.com/run/docs/logging#correlate-logs
-    """
-    # Only attempt to get the context if in a request
-    if request:
 
-        trace_header = request.headers.get("X-Cloud-Trace-Context")
-        # Only append the trace if it exists in the request
+class ProjectId:
+    """Resolves the Google Cloud project once, off the request path, from
+    GOOGLE_CLOUD_PROJECT, the metadata server when `aresolve` has been
+    awaited, or else Application Default Credentials"""
+
+    def __init__(self) -> None:
+        self._project: Optional[str] = None
+        self._resolved = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[str]:
+        if not self._resolved:
+            with self._lock:
+                if not self._resolved:
+                    self._project = os.environ.get("GOOGLE_CLOUD_PROJECT")
+                    if self._project is None:
+                        try:
+                            from utils import metadata
+
+                            self._project = metadata.get_project_id()
+                        except Exception:
+                            self._project = None
+                    self._resolved = True
+        return self._project
+
+    async def aresolve(self, client: Any) -> Optional[str]:
+        """Resolves the project with `client`, a MetadataClient, so the log
+        writer never has to call google.auth.default(). Off Google Cloud the
+        lookup fails and `get()` falls back to the credentials later."""
+        if not self._resolved and "GOOGLE_CLOUD_PROJECT" not in os.environ:
+            try:
+                project = await client.project_id()
+            except Exception:
+                return None
+            with self._lock:
+                if not self._resolved:
+                    self._project, self._resolved = project, True
+        return self.get()
+
+
+def _truncate(value: Any, max_chars: int) -> Any:
+    if isinstance(value, str) and len(value) > max_chars:
+        return f"{value[:max_chars]}... [{len(value) - max_chars} more characters]"
+    return value
+
+
+class JSONFormatter(logging.Formatter):
+    """Renders records as Cloud Logging structured JSON with orjson.
+
+    Fields passed with `extra=` become top-level keys, and any string longer
+    than `max_field_chars` (the message included) is truncated, so a large
+    payload costs a bounded amount to write.
+    https://cloud.google.com/run/docs/logging#special-fields"""
+
+    def __init__(
+        self, project: Optional[ProjectId] = None, max_field_chars: int = 2000
+    ) -> None:
+        super().__init__()
+        self.project = project or ProjectId()
+        self.max_field_chars = max_field_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": _truncate(record.getMessage(), self.max_field_chars),
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "logger": record.name,
+        }
+        trace_header = getattr(record, "trace_header", None)
         if trace_header:
-            trace = trace_header.split("/")
-            project = metadata.get_project_id()
-            event_dict[
-                "logging.googleapis.com/trace"
-            ] = f"projects/{project}/traces/{trace[0]}"
-    return event_dict
-
-
-def getJSONLogger() -> structlog._config.BoundLoggerLazyProxy:
-    """Create a JSON logger using the field name and trace modifiers created above"""
-    # extend using https://www.structlog.org/en/stable/processors.html
-    structlog.configure(
-        processors=[
-            structlog.stdlib.add_log_level,
-            structlog.stdlib.PositionalArgumentsFormatter(),
-            field_name_modifier,
-            trace_modifier,
-            structlog.processors.TimeStamper("iso"),
-            structlog.processors.JSONRenderer(),
-        ],
-        wrapper_class=structlog.stdlib.BoundLogger,
-    )
-    return structlog.get_logger()
-
-
-logger = getJSONLogger()
-
-
-def flush() -> None:
-    # Setting PYTHONUNBUFFERED in Dockerfile/Buildpack ensured no buffering
-
-    # https://docs.python.org/3/library/logging.html#logging.shutdown
-    # When the logging module is imported, it registers this
-    # function as an exit handler (see atexit), so normally
-    # there’s no need to do that manually.
-    pass
+            trace = trace_header.split("/")[0]
+            project = self.project.get()
+            entry["logging.googleapis.com/trace"] = (
+                f"projects/{project}/traces/{trace}" if project else trace
+            )
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = _truncate(value, self.max_field_chars)
+        if record.exc_info:
+            entry["stack_trace"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["stack_trace"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+
+class StdoutHandler(logging.StreamHandler):
+    """StreamHandler writing to whatever `sys.stdout` is at the time"""
+
+    def __init__(self) -> None:
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self) -> TextIO:
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value: TextIO) -> None:
+        pass
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records on a bounded queue for a writer thread to format and
+    write. The calling thread records the trace header and snapshots the
+    record, merging its arguments into the message and rendering any
+    exception to text, so later changes to an argument don't show in the
+    log and no traceback keeps request frames alive in the queue; the JSON
+    is rendered by the writer. When the queue is full the record is dropped
+    and counted rather than blocking the request."""
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # a copy, since other handlers may still format the original
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        record.trace_header = trace_context.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundLogging:
+    """Routes the root logger through a NonBlockingQueueHandler to a
+    QueueListener thread writing JSON lines to `stream`.
+
+    Threads do not survive fork(), so a preloading server must call
+    `after_fork()` in each worker."""
+
+    def __init__(
+        self,
+        level: str = "INFO",
+        stream: Optional[TextIO] = None,
+        max_field_chars: int = 2000,
+        queue_size: int = 10_000,
+    ) -> None:
+        self.level = level
+        self.queue_size = queue_size
+        self.project = ProjectId()
+        self.output = logging.StreamHandler(stream) if stream else StdoutHandler()
+        self.output.setFormatter(
+            JSONFormatter(project=self.project, max_field_chars=max_field_chars)
+        )
+        self.handler: Optional[NonBlockingQueueHandler] = None
+        self.listener: Optional[QueueListener] = None
+
+    def start(self) -> "BackgroundLogging":
+        log_queue: queue.Queue = queue.Queue(self.queue_size)
+        root = logging.getLogger()
+        if self.handler is not None:
+            root.removeHandler(self.handler)
+        self.handler = NonBlockingQueueHandler(log_queue)
+        self.listener = QueueListener(log_queue, self.output)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+        return self
+
+    def after_fork(self) -> None:
+        # the inherited queue's lock may have been held by a thread that
+        # no longer exists, so start over with a new queue and thread
+        self.listener = None
+        self.start()
+
+    def stop(self) -> None:
+        """Writes out everything queued and stops the writer thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.handler.queue.qsize() if self.handler else 0,
+            "dropped": self.handler.dropped if self.handler else 0,
+        }
+
+
+def configure_logging(
+    level: Optional[str] = None,
+    max_field_chars: Optional[int] = None,
+    queue_size: Optional[int] = None,
+) -> BackgroundLogging:
+    """Starts background JSON logging, configured from LOG_LEVEL,
+    LOG_MAX_FIELD_CHARS and LOG_QUEUE_SIZE unless given"""
+    background = BackgroundLogging(
+        level=level or os.environ.get("LOG_LEVEL", "INFO"),
+        max_field_chars=max_field_chars
+        or int(os.environ.get("LOG_MAX_FIELD_CHARS", 2000)),
+        queue_size=queue_size or int(os.environ.get("LOG_QUEUE_SIZE", 10_000)),
+    ).start()
+    atexit.register(background.stop)
+    return background
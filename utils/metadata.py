@@ -12,35 +12,227 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import google.auth
+import asyncio
+import base64
+import logging
+import os
+import time
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import aiohttp
+import orjson
 import requests
 
-METADATA_URI = "http://metadata.google.internal/computeMetadata/v1/"
+from utils.early import detach
+from utils.telemetry import id_token_fetches
+
+logger = logging.getLogger(__name__)
+
+# GCE_METADATA_HOST is the variable google-auth honours, e.g. for a fake server
+METADATA_HOST = os.environ.get("GCE_METADATA_HOST", "metadata.google.internal")
+METADATA_URI = f"http://{METADATA_HOST}/computeMetadata/v1/"
+METADATA_HEADERS = {"Metadata-Flavor": "Google"}
+IDENTITY_PATH = "instance/service-accounts/default/identity"
+
+_session = requests.Session()
 
 
 def get_project_id() -> str:
     """Use the 'google-auth-library' to make a request to the metadata server or
     default to Application Default Credentials in your local environment."""
+    import google.auth
+
     _, project = google.auth.default()
     return project
 
 
+@lru_cache(maxsize=None)
 def get_service_region() -> str:
-    """Get region from local metadata server
+    """Get region from local metadata server, once per process
     Region in format: projects/PROJECT_NUMBER/regions/REGION"""
     slug = "instance/region"
-    data = requests.get(METADATA_URI + slug, headers={"Metadata-Flavor": "Google"})
-    return data.content
+    data = _session.get(METADATA_URI + slug, headers=METADATA_HEADERS, timeout=2)
+    data.raise_for_status()
+    return data.text
+
+
+def token_expiry(token: str) -> float:
+    """The `exp` claim of a JWT, read without verifying its signature"""
+    payload = token.split(".")[1]
+    payload += "=" * (-len(payload) % 4)
+    return float(orjson.loads(base64.urlsafe_b64decode(payload))["exp"])
+
+
+class MetadataClient:
+    """Async client for the metadata server over one pooled aiohttp session.
+
+    Metadata values do not change while an instance runs, so each one is
+    fetched once per process. ID tokens are cached per audience until
+    `expiry_skew` seconds before they expire, and are refreshed in the
+    background `refresh_margin` seconds before that, as long as they were
+    used since the last fetch; a token used inside the margin is still
+    returned at once while a fresh one is fetched. Concurrent requests for
+    the same value share one fetch. The session is created lazily on the running event loop
+    and must be closed with `close()`."""
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        timeout: float = 2.0,
+        refresh_margin: float = 300.0,
+        expiry_skew: float = 30.0,
+        max_connections: int = 16,
+    ) -> None:
+        self.base_url = base_url or METADATA_URI
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.expiry_skew = expiry_skew
+        self.max_connections = max_connections
+        self._values: Dict[str, str] = {}
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._refreshes: Dict[str, asyncio.TimerHandle] = {}
+        self._unused: Set[str] = set()
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _fetch(self, path: str, params: Optional[Dict[str, str]] = None) -> str:
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with self._get_session().get(
+            self.base_url + path,
+            params=params,
+            headers=METADATA_HEADERS,
+            timeout=timeout,
+        ) as resp:
+            resp.raise_for_status()
+            return (await resp.text()).strip()
+
+    def _shared(self, key: str, fetch: Callable[[], Awaitable[str]]) -> asyncio.Future:
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(
+                lambda done: self._inflight.get(key) is done and self._inflight.pop(key)
+            )
+        return task
+
+    async def get(self, path: str) -> str:
+        """A metadata value, e.g. `project/project-id` or `instance/region`"""
+        value = self._values.get(path)
+        if value is None:
+            value = await asyncio.shield(self._shared(path, lambda: self._load(path)))
+        return value
+
+    async def _load(self, path: str) -> str:
+        value = self._values[path] = await self._fetch(path)
+        return value
+
+    async def project_id(self) -> str:
+        return await self.get("project/project-id")
+
+    async def service_region(self) -> str:
+        """Region in format: projects/PROJECT_NUMBER/regions/REGION"""
+        return await self.get("instance/region")
+
+    async def id_token(self, audience: str) -> str:
+        key = f"id_token:{audience}"
+        cached = self._tokens.get(audience)
+        now = time.time()
+        if cached is not None and now < cached[1] - self.expiry_skew:
+            self._unused.discard(audience)
+            if now >= cached[1] - self.refresh_margin:
+                self._refresh(audience)
+            return cached[0]
+        reason = "missing" if cached is None else "expired"
+        token = await asyncio.shield(
+            self._shared(key, lambda: self._load_token(audience, reason))
+        )
+        self._unused.discard(audience)
+        return token
+
+    async def _load_token(self, audience: str, reason: str) -> str:
+        token = await self._fetch(
+            IDENTITY_PATH, {"audience": audience, "format": "full"}
+        )
+        expiry = token_expiry(token)
+        self._tokens[audience] = (token, expiry)
+        id_token_fetches.inc(reason=reason)
+        self._unused.add(audience)
+        self._schedule_refresh(audience, expiry)
+        return token
+
+    def _schedule_refresh(self, audience: str, expiry: float) -> None:
+        handle = self._refreshes.pop(audience, None)
+        if handle is not None:
+            handle.cancel()
+        delay = expiry - self.refresh_margin - time.time()
+        # a token that lives no longer than the margin is refreshed on use
+        if delay > 0:
+            self._refreshes[audience] = asyncio.get_running_loop().call_later(
+                delay, self._refresh, audience, True
+            )
+
+    def _refresh(self, audience: str, scheduled: bool = False) -> None:
+        key = f"id_token:{audience}"
+        if scheduled:
+            self._refreshes.pop(audience, None)
+            if audience in self._unused:
+                # nobody asked for it since the last fetch; stop refreshing
+                return
+        if key in self._inflight:
+            return
+        refresh = self._shared(key, lambda: self._load_token(audience, "refresh"))
+        refresh.add_done_callback(self._log_refresh_failure)
+        detach(refresh)
 
+    @staticmethod
+    def _log_refresh_failure(task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                "Refreshing an ID token failed, keeping the cached one: %s",
+                task.exception(),
+            )
 
-def authenticated_request(url: str, method: str) -> str:
-    """Make a request with an ID token to a protected service
-    https://cloud.google.com/functions/docs/securing/authenticating#functions-bearer-token-example-python"""
+    async def authenticated_request(
+        self,
+        url: str,
+        method: str = "GET",
+        audience: Optional[str] = None,
+        **kwargs: Any,
+    ) -> bytes:
+        """Makes a request with an ID token for `audience` (by default `url`)
+        to a protected service over the pooled session, raising
+        aiohttp.ClientResponseError for a non-2xx response. It times out
+        after `timeout` seconds unless a `timeout` is passed."""
+        token = await self.id_token(audience or url)
+        headers = {**kwargs.pop("headers", {}), "Authorization": f"Bearer {token}"}
+        kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=self.timeout))
+        async with self._get_session().request(
+            method, url, headers=headers, **kwargs
+        ) as resp:
+            resp.raise_for_status()
+            return await resp.read()
 
-    auth_req = google.auth.transport.requests.Request()
-    id_token = google.oauth2.id_token.fetch_id_token(auth_req, url)
+    def stats(self) -> Dict[str, int]:
+        return {
+            "values": len(self._values),
+            "id_tokens": len(self._tokens),
+            "inflight": len(self._inflight),
+        }
 
-    resp = requests.request(
-        method, url, headers={"Authorization": f"Bearer {id_token}"}
-    )
-    return resp.content
+    async def close(self) -> None:
+        for handle in self._refreshes.values():
+            handle.cancel()
+        self._refreshes.clear()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
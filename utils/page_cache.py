@@ -0,0 +1,205 @@
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from utils.fusion import normalize_url
+
+logger = logging.getLogger(__name__)
+
+# `usage` holds the total size of the stored text, kept by triggers so every
+# worker sharing the file enforces the same budget
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    title TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at);
+CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+INSERT OR IGNORE INTO usage VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM pages));
+CREATE TRIGGER IF NOT EXISTS pages_added AFTER INSERT ON pages
+BEGIN UPDATE usage SET size = size + NEW.size; END;
+CREATE TRIGGER IF NOT EXISTS pages_removed AFTER DELETE ON pages
+BEGIN UPDATE usage SET size = size - OLD.size; END;
+"""
+
+
+@dataclass
+class CachedPage:
+    url: str
+    text: str
+    title: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.fetched_at < ttl
+
+    def revalidation_headers(self) -> Dict[str, str]:
+        """Conditional request headers for revalidating a stale entry"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PageCache:
+    """SQLite-backed cache of extracted page text, keyed by normalized URL.
+
+    Entries older than `ttl` seconds are still returned so callers can
+    revalidate them with ETag/Last-Modified; the least recently used entries
+    are evicted once the stored text exceeds `max_bytes`. The size is kept in
+    the file, so the limit holds across all workers sharing it, and a failed
+    read or write (a "database is locked" from another worker, say) is
+    treated as a miss."""
+
+    def __init__(
+        self, path: str = ":memory:", ttl: float = 3600, max_bytes: int = 256 * 2**20
+    ) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "evictions": 0,
+            "bytes_served": 0,
+            "bytes_stored": 0,
+            "disk_errors": 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def reopen(self) -> None:
+        """Opens a fresh connection; call in each worker after a preloading
+        server forks, since SQLite connections must not cross fork()"""
+        if self.path != ":memory:":
+            self._lock = threading.Lock()
+            self._conn = self._connect()
+
+    def _disk_error(self, action: str, e: Exception) -> None:
+        # called with the lock held
+        self._counters["disk_errors"] += 1
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            pass
+        logger.warning("Page cache %s failed: %s", action, e)
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        key = normalize_url(url)
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT text, title, etag, last_modified, fetched_at FROM pages WHERE url = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE pages SET accessed_at = ? WHERE url = ?", (time.time(), key)
+                    )
+                    self._conn.commit()
+            except sqlite3.Error as e:
+                self._disk_error("read", e)
+                row = None
+            if row is None:
+                self._counters["misses"] += 1
+                return None
+        page = CachedPage(key, *row)
+        with self._lock:
+            if page.is_fresh(self.ttl):
+                self._counters["hits"] += 1
+                self._counters["bytes_served"] += len(page.text)
+            else:
+                self._counters["stale_hits"] += 1
+        return page
+
+    def put(
+        self,
+        url: str,
+        text: str,
+        title: Optional[str] = None,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        key = normalize_url(url)
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                # DELETE rather than INSERT OR REPLACE, whose implicit delete
+                # does not fire the usage trigger
+                self._conn.execute("DELETE FROM pages WHERE url = ?", (key,))
+                self._conn.execute(
+                    "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, text, title, etag, last_modified, now, now, size),
+                )
+                self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._disk_error("write", e)
+                return
+            self._counters["bytes_stored"] += size
+
+    def mark_revalidated(self, url: str) -> None:
+        """Restarts the TTL of an entry after the origin answered 304"""
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?",
+                    (now, now, normalize_url(url)),
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._disk_error("write", e)
+                return
+            self._counters["revalidated"] += 1
+
+    def _evict(self) -> None:
+        (size,) = self._conn.execute("SELECT size FROM usage").fetchone()
+        while size > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT url, size FROM pages ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not rows:
+                return
+            urls = []
+            for url, length in rows:
+                if size <= self.max_bytes:
+                    break
+                urls.append((url,))
+                size -= length
+            self._conn.executemany("DELETE FROM pages WHERE url = ?", urls)
+            self._counters["evictions"] += len(urls)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            try:
+                (entries,) = self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()
+                (size,) = self._conn.execute("SELECT size FROM usage").fetchone()
+            except sqlite3.Error:
+                entries = size = -1
+            return dict(self._counters, entries=entries, size_bytes=size)
@@ -0,0 +1,50 @@
+import logging
+import threading
+import time
+from functools import partial
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class LazyComponents:
+    """Named factories that are built on first use and then cached.
+
+    `lazy(name)` returns a zero-argument callable, which is what
+    `configurable_alternatives` accepts in place of a Runnable, so an
+    alternative (and the imports inside its factory) costs nothing until a
+    request selects it."""
+
+    def __init__(self) -> None:
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._build_seconds: Dict[str, float] = {}
+        # factories may build other components, e.g. the ensemble retriever
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> Callable[[], Any]:
+        self._factories[name] = factory
+        return self.lazy(name)
+
+    def lazy(self, name: str) -> Callable[[], Any]:
+        return partial(self.get, name)
+
+    def get(self, name: str) -> Any:
+        if name in self._instances:
+            return self._instances[name]
+        with self._lock:
+            if name not in self._instances:
+                started = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                self._build_seconds[name] = time.perf_counter() - started
+                logger.info("Built %s in %.3fs", name, self._build_seconds[name])
+        return self._instances[name]
+
+    def names(self) -> List[str]:
+        return list(self._factories)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "built": dict(self._build_seconds),
+            "pending": [name for name in self._factories if name not in self._instances],
+        }
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import math
+from collections import Counter
+from typing import List, Optional, Sequence
+
+import numpy as np
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+from utils.context import _terms
+from utils.early import detach
+from utils.embeddings import cosine_similarity_to
+from utils.telemetry import reranks
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(scores: np.ndarray) -> np.ndarray:
+    span = scores.max() - scores.min()
+    if span <= 0:
+        return np.zeros_like(scores)
+    return (scores - scores.min()) / span
+
+
+class HybridReranker:
+    """Reorders retrieved documents by relevance to the standalone question
+    and keeps the best `top_k`.
+
+    The leading `max_chars` characters of every document are scored with
+    BM25 against the question, using the retrieved set as the corpus, and
+    by cosine similarity of their embeddings to the question's. The two
+    scores are min-max normalized and mixed with `bm25_weight`. Embeddings
+    that take longer than `embedding_timeout` seconds (a cache miss) are
+    finished in the background so they are cached next time, and the
+    documents are ranked on BM25 alone meanwhile, as they are on the
+    synchronous path. Ties keep retrieval order."""
+
+    def __init__(
+        self,
+        embeddings: Optional[Embeddings] = None,
+        top_k: int = 4,
+        bm25_weight: float = 0.5,
+        embedding_timeout: float = 0.05,
+        max_chars: int = 4000,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ) -> None:
+        self.embeddings = embeddings
+        self.top_k = top_k
+        self.bm25_weight = bm25_weight
+        self.embedding_timeout = embedding_timeout
+        self.max_chars = max_chars
+        self.k1 = k1
+        self.b = b
+
+    def _texts(self, docs: Sequence[Document]) -> List[str]:
+        return [doc.page_content[: self.max_chars] for doc in docs]
+
+    def bm25(self, texts: Sequence[str], query: str) -> np.ndarray:
+        counts = [Counter(_terms(text)) for text in texts]
+        lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+        length_norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1))
+        scores = np.zeros(len(texts), dtype=np.float32)
+        for term in set(_terms(query)):
+            tf = np.array([c[term] for c in counts], dtype=np.float32)
+            df = np.count_nonzero(tf)
+            if df:
+                idf = math.log(1 + (len(texts) - df + 0.5) / (df + 0.5))
+                scores += idf * tf * (self.k1 + 1) / (tf + length_norm)
+        return scores
+
+    async def _similarity(self, texts: List[str], query: str) -> np.ndarray:
+        doc_vectors, query_vector = await asyncio.gather(
+            self.embeddings.aembed_documents(texts), self.embeddings.aembed_query(query)
+        )
+        return cosine_similarity_to(
+            np.asarray(doc_vectors, dtype=np.float32),
+            np.asarray(query_vector, dtype=np.float32),
+        )
+
+    def _select(
+        self,
+        docs: Sequence[Document],
+        bm25: np.ndarray,
+        similarity: Optional[np.ndarray],
+    ) -> List[Document]:
+        scores = _normalize(bm25)
+        if similarity is not None:
+            scores = self.bm25_weight * scores + (1 - self.bm25_weight) * _normalize(
+                similarity
+            )
+        reranks.inc(scorer="bm25" if similarity is None else "hybrid")
+        order = np.argsort(-scores, kind="stable")[: self.top_k]
+        return [docs[i] for i in order]
+
+    def rerank(self, docs: Sequence[Document], query: str) -> List[Document]:
+        """Reranks on BM25 alone"""
+        if len(docs) <= 1:
+            return list(docs)
+        return self._select(docs, self.bm25(self._texts(docs), query), None)
+
+    async def arerank(self, docs: Sequence[Document], query: str) -> List[Document]:
+        if len(docs) <= 1:
+            return list(docs)
+        texts = self._texts(docs)
+        similarity = None
+        if self.embeddings is None or self.bm25_weight >= 1:
+            return self._select(docs, self.bm25(texts, query), None)
+        task = asyncio.ensure_future(self._similarity(texts, query))
+        bm25 = self.bm25(texts, query)
+        try:
+            similarity = await asyncio.wait_for(
+                asyncio.shield(task), self.embedding_timeout
+            )
+        except asyncio.TimeoutError:
+            detach(task)
+        except Exception as e:
+            logger.warning("Embedding documents for reranking failed: %s", e)
+        return self._select(docs, bm25, similarity)
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Casefolds and collapses whitespace so trivially different spellings of
+    the same standalone question share a cache entry"""
+    return _WHITESPACE.sub(" ", query).strip().strip("?.!").strip().casefold()
+
+
+class RedisTier:
+    """Shared cache tier backed by any server speaking the Redis protocol.
+    Failures are logged and treated as misses so the tier stays optional."""
+
+    def __init__(self, url: str, prefix: str = "search-cache:") -> None:
+        import redis.asyncio as redis
+
+        self.prefix = prefix
+        self._client = redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            return await self._client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning("Shared search cache read failed: %s", e)
+            return None
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        try:
+            await self._client.set(self.prefix + key, value, ex=max(int(ttl), 1))
+        except Exception as e:
+            logger.warning("Shared search cache write failed: %s", e)
+
+
+class SearchResultCache:
+    """Two-tier cache for provider search results.
+
+    The first tier is an in-process LRU with a TTL, bounded both by entries
+    and by the JSON size of the stored results, since those carry full page
+    texts; the optional second tier is shared between workers and instances.
+    Concurrent async lookups for the same key are coalesced so only one of
+    them reaches the provider. If that one is cancelled, the lookups waiting
+    on it retry rather than fail with it."""
+
+    def __init__(
+        self,
+        max_entries: int = 2048,
+        ttl: float = 900,
+        shared: Optional[RedisTier] = None,
+        max_bytes: int = 64 * 2**20,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self._entries: "OrderedDict[str, Tuple[float, List[Any], int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._counters = {
+            "hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+        }
+
+    @staticmethod
+    def key(namespace: str, query: str) -> str:
+        raw = f"{namespace}\0{normalize_query(query)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get_local(self, key: str) -> Optional[List[Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, size = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._size -= size
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return value
+
+    @staticmethod
+    def _encode(value: List[Any]) -> bytes:
+        return json.dumps(value, default=str).encode("utf-8")
+
+    def put_local(self, key: str, value: List[Any], size: Optional[int] = None) -> None:
+        if size is None:
+            size = len(self._encode(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[2]
+            self._entries[key] = (time.monotonic() + self.ttl, value, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+    def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], List[Any]],
+        cacheable: Callable[[List[Any]], bool] = bool,
+    ) -> List[Any]:
+        """`cacheable` decides whether a computed value is stored; by default
+        empty results are not"""
+        value = self.get_local(key)
+        if value is not None:
+            return value
+        with self._lock:
+            self._counters["misses"] += 1
+        value = compute()
+        if cacheable(value):
+            self.put_local(key, value)
+        return value
+
+    async def aget_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[List[Any]]],
+        cacheable: Callable[[List[Any]], bool] = bool,
+    ) -> List[Any]:
+        value = self.get_local(key)
+        if value is not None:
+            return value
+        inflight = self._inflight.get(key)
+        while inflight is not None:
+            with self._lock:
+                self._counters["coalesced"] += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+            # the lookup we were waiting on was cancelled, not us: try again,
+            # searching ourselves if nobody else has started to
+            value = self.get_local(key)
+            if value is not None:
+                return value
+            inflight = self._inflight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            value = await self._aget_shared(key)
+            if value is None:
+                with self._lock:
+                    self._counters["misses"] += 1
+                value = await compute()
+                if cacheable(value):
+                    encoded = self._encode(value)
+                    self.put_local(key, value, len(encoded))
+                    await self._aput_shared(key, encoded)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _aget_shared(self, key: str) -> Optional[List[Any]]:
+        if self.shared is None:
+            return None
+        raw = await self.shared.get(key)
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        self.put_local(key, value, len(raw))
+        with self._lock:
+            self._counters["shared_hits"] += 1
+        return value
+
+    async def _aput_shared(self, key: str, encoded: bytes) -> None:
+        if self.shared is not None:
+            await self.shared.set(key, encoded, self.ttl)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._size)
@@ -0,0 +1,125 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    sources: List[Document]
+    similarity: float = 1.0
+
+
+class SemanticAnswerCache:
+    """Answers near-duplicate questions from earlier (question, sources, answer)
+    entries.
+
+    Question embeddings live in a preallocated, L2-normalized float32 matrix so
+    a lookup is a single matrix-vector product. Entries are partitioned by
+    namespace (the selected llm/retriever pair), expire after `ttl` seconds,
+    and the least recently used entry is evicted once `max_entries` is hit."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        threshold: float = 0.95,
+        ttl: float = 3600,
+        max_entries: int = 5000,
+    ) -> None:
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None
+        self._expires_at = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._namespace = np.full(max_entries, -1, dtype=np.int32)
+        self._namespaces: Dict[str, int] = {}
+        self._entries: List[Optional[CachedAnswer]] = [None] * max_entries
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _namespace_id(self, namespace: str) -> int:
+        return self._namespaces.setdefault(namespace, len(self._namespaces))
+
+    def _search(self, vector: np.ndarray, namespace: str) -> Optional[CachedAnswer]:
+        with self._lock:
+            if self._matrix is None or namespace not in self._namespaces:
+                self._counters["misses"] += 1
+                return None
+            now = time.time()
+            scores = self._matrix @ vector
+            live = (self._namespace == self._namespaces[namespace]) & (
+                self._expires_at > now
+            )
+            scores = np.where(live, scores, -np.inf)
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                self._counters["misses"] += 1
+                return None
+            self._last_used[slot] = now
+            self._counters["hits"] += 1
+            entry = self._entries[slot]
+            return CachedAnswer(
+                entry.question, entry.answer, entry.sources, float(scores[slot])
+            )
+
+    def _free_slot(self, now: float) -> int:
+        empty = np.flatnonzero(self._namespace < 0)
+        if len(empty):
+            return int(empty[0])
+        expired = np.flatnonzero(self._expires_at <= now)
+        if len(expired):
+            return int(expired[0])
+        self._counters["evictions"] += 1
+        return int(np.argmin(self._last_used))
+
+    def _insert(self, vector: np.ndarray, namespace: str, entry: CachedAnswer) -> None:
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            now = time.time()
+            slot = self._free_slot(now)
+            self._matrix[slot] = vector
+            self._expires_at[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._namespace[slot] = self._namespace_id(namespace)
+            self._entries[slot] = entry
+            self._counters["stores"] += 1
+
+    async def alookup(
+        self, question: str, namespace: str = ""
+    ) -> Tuple[Optional[CachedAnswer], np.ndarray]:
+        """Returns the best fresh match above the threshold, if any, together
+        with the question embedding so a miss can be stored without
+        embedding the question twice"""
+        vector = self._normalize(await self.embeddings.aembed_query(question))
+        return self._search(vector, namespace), vector
+
+    def store(
+        self,
+        vector: np.ndarray,
+        question: str,
+        answer: str,
+        sources: List[Document],
+        namespace: str = "",
+    ) -> None:
+        if answer:
+            self._insert(vector, namespace, CachedAnswer(question, answer, sources))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            live = int(np.count_nonzero(self._namespace >= 0))
+            return dict(self._counters, entries=live)
@@ -0,0 +1,46 @@
+import math
+import os
+import warnings
+from typing import Any, Optional
+
+with warnings.catch_warnings():
+    # uvicorn.workers is deprecated in favour of the separate uvicorn-worker
+    # package, which is not pinned in requirements.txt
+    warnings.simplefilter("ignore", DeprecationWarning)
+    from uvicorn.workers import UvicornWorker
+
+
+def _cgroup_cpus() -> Optional[int]:
+    """CPU limit from a cgroup v2 quota, as set by Cloud Run and Kubernetes"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return max(1, math.ceil(int(quota) / int(period)))
+
+
+def worker_count() -> int:
+    """WEB_CONCURRENCY if set, otherwise one worker per available CPU.
+
+    Each uvicorn worker serves many concurrent streams on its event loop, so
+    more workers than CPUs only adds memory."""
+    if os.environ.get("WEB_CONCURRENCY"):
+        return int(os.environ["WEB_CONCURRENCY"])
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    limit = _cgroup_cpus()
+    return max(1, min(cpus or 1, limit or cpus or 1))
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    """Uvicorn worker that waits for in-flight requests on shutdown.
+
+    Uvicorn waits for open connections for most of gunicorn's
+    `graceful_timeout`, leaving a couple of seconds for the app's shutdown
+    handlers before the arbiter kills the worker."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - 2, 1)
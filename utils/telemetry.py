@@ -0,0 +1,278 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import Document
+
+from utils.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+# Runnables named with run_name in app.py whose latency is worth tracking
+STAGES = frozenset(
+    [
+        "RouteDependingOnChatHistory",
+        "RetrievalChainWithHistory",
+        "RetrievalChainWithNoHistory",
+        "CondenseQuestionFastPath",
+        "CondenseQuestion",
+        "RetrievalChain",
+        "FormatDocumentChunks",
+        "SerializeHistory",
+        "GenerateResponse",
+    ]
+)
+
+_TRACE_HEADER = re.compile(r"^([0-9a-fA-F]{32})(?:/(\d+))?(?:;o=(\d))?")
+
+registry = MetricsRegistry()
+stage_latency = registry.histogram(
+    "chain_stage_latency_seconds", "Latency of named chain stages"
+)
+stage_errors = registry.counter("chain_stage_errors_total", "Chain stages that raised")
+llm_tokens = registry.counter(
+    "llm_tokens_total", "LLM tokens by model and kind (streamed, prompt, completion)"
+)
+retriever_documents = registry.histogram(
+    "retriever_documents", "Documents returned per retriever call", (0, 1, 2, 4, 6, 8, 12, 16, 32)
+)
+retriever_bytes = registry.histogram(
+    "retriever_bytes",
+    "Bytes of page content returned per retriever call",
+    (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 4e6),
+)
+admission_wait = registry.histogram(
+    "admission_wait_seconds", "Time chat requests waited for a concurrency slot"
+)
+admission_rejections = registry.counter(
+    "admission_rejections_total", "Chat requests rejected by admission control"
+)
+provider_wait = registry.histogram(
+    "provider_rate_limit_wait_seconds", "Time spent waiting on a provider's token bucket"
+)
+llm_hedges = registry.counter(
+    "llm_hedges_total", "Backup LLM requests started because the primary was slow"
+)
+llm_failovers = registry.counter(
+    "llm_failovers_total", "LLM requests retried on a backup after failing before a token"
+)
+breaker_transitions = registry.counter(
+    "circuit_breaker_transitions_total", "Circuit breaker state changes by provider"
+)
+provider_throttled = registry.counter(
+    "provider_throttled_total", "Provider calls refused because the token bucket was saturated"
+)
+retrieval_late_sources = registry.counter(
+    "retrieval_late_sources_total",
+    "Sources still loading when synthesis started, by retriever",
+)
+history_summaries = registry.counter(
+    "history_summaries_total",
+    "Chat history summaries by outcome (cached, built, timeout, failed)",
+)
+local_index_lookups = registry.counter(
+    "local_index_lookups_total", "Local vector index lookups by index and outcome (hit, fallback)"
+)
+id_token_fetches = registry.counter(
+    "id_token_fetches_total",
+    "ID tokens fetched from the metadata server by reason (missing, expired, refresh)",
+)
+reranks = registry.counter(
+    "reranks_total", "Retrieved document sets reranked, by scorer (hybrid, bm25)"
+)
+near_duplicates = registry.counter(
+    "near_duplicates_total", "Retrieved documents collapsed into a near-duplicate"
+)
+batch_requests = registry.counter(
+    "batch_requests_total", "Chat requests answered in batches, by outcome"
+)
+
+
+def parse_cloud_trace_context(header: str) -> Optional[Tuple[str, Optional[int], bool]]:
+    """Parses X-Cloud-Trace-Context ("TRACE_ID/SPAN_ID;o=OPTIONS") into
+    (trace id, span id, sampled)"""
+    match = _TRACE_HEADER.match(header or "")
+    if match is None:
+        return None
+    trace_id, span_id, options = match.groups()
+    return trace_id.lower(), int(span_id) if span_id else None, options == "1"
+
+
+def _otel_tracer() -> Optional[Any]:
+    """Returns an OpenTelemetry tracer exporting over OTLP when the
+    opentelemetry packages are installed and an endpoint is configured"""
+    if not os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return None
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry is not installed")
+        return None
+    provider = TracerProvider(
+        resource=Resource.create(
+            {"service.name": os.environ.get("K_SERVICE", "googlecloud-langchain")}
+        )
+    )
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    return provider.get_tracer(__name__)
+
+
+class StageMetricsHandler(BaseCallbackHandler):
+    """Callback handler recording per-stage latency, token counts and
+    retriever document counts/bytes, optionally exporting each stage as an
+    OpenTelemetry span parented to the request's Cloud Trace context.
+
+    It runs inline on the event loop and only touches a dict and a few
+    counters per callback."""
+
+    run_inline = True
+
+    def __init__(self, tracer: Optional[Any] = None) -> None:
+        self.tracer = tracer
+        self._runs: Dict[UUID, Tuple[str, float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _remote_parent(self, metadata: Optional[Dict]) -> Optional[Any]:
+        parsed = parse_cloud_trace_context((metadata or {}).get("cloud_trace_context"))
+        if parsed is None or parsed[1] is None:
+            return None
+        from opentelemetry import trace
+        from opentelemetry.trace import NonRecordingSpan, SpanContext, TraceFlags
+
+        trace_id, span_id, sampled = parsed
+        context = SpanContext(
+            trace_id=int(trace_id, 16),
+            span_id=span_id & 0xFFFFFFFFFFFFFFFF,
+            is_remote=True,
+            trace_flags=TraceFlags(TraceFlags.SAMPLED if sampled else 0),
+        )
+        return trace.set_span_in_context(NonRecordingSpan(context))
+
+    def _start(
+        self,
+        stage: str,
+        run_id: UUID,
+        parent_run_id: Optional[UUID],
+        metadata: Optional[Dict],
+    ) -> None:
+        span = None
+        if self.tracer is not None:
+            from opentelemetry import trace
+
+            with self._lock:
+                parent = self._runs.get(parent_run_id)
+            context = (
+                trace.set_span_in_context(parent[2])
+                if parent is not None and parent[2] is not None
+                else self._remote_parent(metadata)
+            )
+            span = self.tracer.start_span(stage, context=context)
+        with self._lock:
+            self._runs[run_id] = (stage, time.perf_counter(), span)
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None) -> Optional[str]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return None
+        stage, started, span = run
+        stage_latency.observe(time.perf_counter() - started, stage=stage)
+        if error is not None:
+            stage_errors.inc(stage=stage)
+        if span is not None:
+            if error is not None:
+                span.record_exception(error)
+            span.end()
+        return stage
+
+    def on_chain_start(
+        self,
+        serialized: Dict[str, Any],
+        inputs: Dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> None:
+        name = kwargs.get("name")
+        if name in STAGES:
+            self._start(name, run_id, parent_run_id, metadata)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+    def on_retriever_start(
+        self,
+        serialized: Dict[str, Any],
+        query: str,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> None:
+        name = kwargs.get("name") or (serialized or {}).get("id", ["retriever"])[-1]
+        self._start(name, run_id, parent_run_id, metadata)
+
+    def on_retriever_end(
+        self, documents: List[Document], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        stage = self._end(run_id)
+        if stage is not None:
+            retriever_documents.observe(len(documents), stage=stage)
+            retriever_bytes.observe(
+                sum(len(d.page_content.encode("utf-8")) for d in documents), stage=stage
+            )
+
+    def on_retriever_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._end(run_id, error)
+
+    def on_chat_model_start(
+        self,
+        serialized: Dict[str, Any],
+        messages: List[List[Any]],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> None:
+        model = (metadata or {}).get("ls_model_name") or "unknown"
+        self._start(f"llm:{model}", run_id, parent_run_id, metadata)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.get(run_id)
+        if run is not None:
+            llm_tokens.inc(model=run[0][len("llm:") :], kind="streamed")
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        stage = self._end(run_id)
+        usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+        if stage is not None:
+            model = stage[len("llm:") :]
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if usage.get(kind):
+                    llm_tokens.inc(usage[kind], model=model, kind=kind[: -len("_tokens")])
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error)
+
+
+stage_metrics = StageMetricsHandler(tracer=_otel_tracer())
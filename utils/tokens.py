@@ -0,0 +1,27 @@
+import logging
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _encoding(name: str) -> Optional[tiktoken.Encoding]:
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        # The BPE files are downloaded on first use; fall back to an estimate
+        # when that is not possible (e.g. in an offline container)
+        logger.warning("Could not load tiktoken encoding %s: %s", name, e)
+        return None
+
+
+def count_tokens(text: str, encoding: str = "cl100k_base") -> int:
+    """Number of tokens in `text`, or a 4-characters-per-token estimate when
+    the encoding is unavailable"""
+    enc = _encoding(encoding)
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
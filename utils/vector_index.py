@@ -0,0 +1,445 @@
+"""Local vector index tier for Kay filings and press releases.
+
+Serving workers answer from the index when it has enough close matches and
+otherwise call Kay, appending what Kay returned to a spool file. The
+ingestion job embeds spooled (or supplied) chunks and appends the new ones
+to the index:
+
+    python -m utils.vector_index --index kay --index kay_press_release
+"""
+
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import BaseRetriever, Document
+from langchain.schema.embeddings import Embeddings
+
+from utils.telemetry import local_index_lookups
+
+logger = logging.getLogger(__name__)
+
+KAY_INDEXES = ("kay", "kay_press_release")
+
+
+def _content_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex:
+    """Append-only flat vector index kept on disk and memory-mapped for search.
+
+    Vectors are unit-normalized float32 rows in `vectors.f32`, so a search is
+    one matrix-vector product over the mapped file; chunk text and metadata
+    live in `chunks.sqlite3`, keyed by row. Rows are written before the
+    SQLite transaction that records them commits, so readers in other
+    processes pick up new rows on their next search and never see a row
+    without its chunk. One process at a time may call `add`."""
+
+    def __init__(self, path: str, namespace: str = "") -> None:
+        self.path = path
+        self.namespace = namespace
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._matrix: Optional[np.ndarray] = None
+        self.dim = self._meta("dim", int)
+        stored = self._meta("namespace", str)
+        if namespace and stored and stored != namespace:
+            raise ValueError(
+                f"Index at {path} was built with {stored} embeddings, not {namespace}"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            os.path.join(self.path, "chunks.sqlite3"), check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, "
+            "page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        return conn
+
+    def reopen(self) -> None:
+        """Opens a fresh connection after fork(); see `PageCache.reopen`"""
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._matrix = None
+
+    def _meta(self, key: str, kind: type) -> Any:
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return kind(row[0]) if row else None
+
+    def _committed_rows(self) -> int:
+        (rows,) = self._conn.execute(
+            "SELECT COALESCE(MAX(row) + 1, 0) FROM chunks"
+        ).fetchone()
+        return rows
+
+    def _mapped(self) -> Optional[np.ndarray]:
+        """The vectors file mapped read-only, remapped when it has grown"""
+        if self.dim is None:
+            self.dim = self._meta("dim", int)
+            if self.dim is None:
+                return None
+        try:
+            rows = os.path.getsize(self._vectors_path) // (4 * self.dim)
+        except FileNotFoundError:
+            return None
+        if self._matrix is None or len(self._matrix) != rows:
+            self._matrix = (
+                np.memmap(
+                    self._vectors_path,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(rows, self.dim),
+                )
+                if rows
+                else None
+            )
+        return self._matrix
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._committed_rows()
+
+    def contains(self, texts: Sequence[str]) -> List[bool]:
+        keys = [_content_key(text) for text in texts]
+        found = set()
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                found.update(
+                    key
+                    for (key,) in self._conn.execute(
+                        f"SELECT key FROM chunks WHERE key IN ({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+        return [key in found for key in keys]
+
+    def add(
+        self, documents: Sequence[Document], vectors: Sequence[Sequence[float]]
+    ) -> int:
+        """Appends the documents not already indexed; returns how many were added"""
+        new: Dict[str, Tuple[Document, Sequence[float]]] = {}
+        for doc, vector, indexed in zip(
+            documents, vectors, self.contains([d.page_content for d in documents])
+        ):
+            if not indexed:
+                new.setdefault(_content_key(doc.page_content), (doc, vector))
+        if not new:
+            return 0
+        matrix = _normalize(np.asarray([v for _, v in new.values()], dtype=np.float32))
+        with self._lock:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    [("dim", str(self.dim)), ("namespace", self.namespace)],
+                )
+            elif matrix.shape[1] != self.dim:
+                raise ValueError(
+                    f"Expected {self.dim}-dimensional vectors, got {matrix.shape[1]}"
+                )
+            start = self._committed_rows()
+            if not os.path.exists(self._vectors_path):
+                open(self._vectors_path, "wb").close()
+            with open(self._vectors_path, "r+b") as f:
+                # overwrite rows left behind by an add that never committed;
+                # the file is never shrunk, as readers may have it mapped
+                f.seek(start * 4 * self.dim)
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._conn.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        start + i,
+                        key,
+                        doc.page_content,
+                        json.dumps(doc.metadata, default=str),
+                    )
+                    for i, (key, (doc, _)) in enumerate(new.items())
+                ],
+            )
+            self._conn.commit()
+        return len(new)
+
+    def search(
+        self, vector: Sequence[float], k: int = 6, min_score: float = 0.0
+    ) -> List[Tuple[Document, float]]:
+        """The `k` nearest chunks by cosine similarity with at least `min_score`"""
+        with self._lock:
+            matrix = self._mapped()
+        if matrix is None:
+            return []
+        scores = matrix @ _normalize(np.asarray(vector, dtype=np.float32))
+        top = (
+            np.argpartition(-scores, k)[:k]
+            if k < len(scores)
+            else np.arange(len(scores))
+        )
+        top = [int(i) for i in top[np.argsort(-scores[top])] if scores[i] >= min_score]
+        if not top:
+            return []
+        with self._lock:
+            chunks = {
+                row: (content, metadata)
+                for row, content, metadata in self._conn.execute(
+                    f"SELECT row, page_content, metadata FROM chunks WHERE row IN ({','.join('?' * len(top))})",
+                    top,
+                )
+            }
+        # rows whose chunks are not committed yet are skipped
+        return [
+            (
+                Document(page_content=chunks[i][0], metadata=json.loads(chunks[i][1])),
+                float(scores[i]),
+            )
+            for i in top
+            if i in chunks
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rows": len(self), "dim": self.dim}
+
+
+class ChunkSpool:
+    """Append-only JSONL files of chunks a provider returned, waiting for the
+    ingestion job. Each line is written with a single append, so several
+    worker processes can share a spool directory. Appends stop once
+    `max_bytes` are pending."""
+
+    def __init__(self, path: str, max_bytes: int = 64 * 2**20) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self._current = os.path.join(path, "spool.jsonl")
+
+    def append(self, documents: Sequence[Document]) -> None:
+        try:
+            if (
+                os.path.exists(self._current)
+                and os.path.getsize(self._current) > self.max_bytes
+            ):
+                return
+            lines = "".join(
+                json.dumps(
+                    {"page_content": d.page_content, "metadata": d.metadata},
+                    default=str,
+                )
+                + "\n"
+                for d in documents
+            )
+            with open(self._current, "a", encoding="utf-8") as f:
+                f.write(lines)
+        except OSError as e:
+            logger.warning("Could not spool chunks to %s: %s", self.path, e)
+
+    def claim(self) -> List[str]:
+        """Moves the current spool aside so workers start a new one, and returns
+        every claimed file not yet ingested, oldest first"""
+        if os.path.exists(self._current):
+            os.replace(
+                self._current, os.path.join(self.path, f"spool.{time.time_ns()}.jsonl")
+            )
+        return sorted(glob.glob(os.path.join(self.path, "spool.*.jsonl")))
+
+
+def open_kay_index(name: str, namespace: str) -> Tuple[VectorIndex, "ChunkSpool"]:
+    """The index and spool of a Kay retriever under KAY_INDEX_DIR"""
+    path = os.path.join(os.environ.get("KAY_INDEX_DIR", "/tmp/kay_index"), name)
+    spool = ChunkSpool(
+        os.path.join(path, "spool"),
+        max_bytes=int(os.environ.get("KAY_SPOOL_MAX_BYTES", 64 * 2**20)),
+    )
+    return VectorIndex(path, namespace=namespace), spool
+
+
+def read_chunks(path: str) -> List[Document]:
+    """Documents from a JSONL file of {"page_content", "metadata"} objects"""
+    documents = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                documents.append(
+                    Document(
+                        page_content=item["page_content"],
+                        metadata=item.get("metadata") or {},
+                    )
+                )
+    return documents
+
+
+class LocalFirstRetriever(BaseRetriever):
+    """Answers from a local VectorIndex when it holds at least `min_results`
+    chunks with cosine similarity of `min_score` or more to the query, and
+    calls `fallback` otherwise. Fallback results are appended to `spool` for
+    the ingestion job, so the index fills with what users actually ask."""
+
+    index: Any
+    embeddings: Embeddings
+    fallback: BaseRetriever
+    spool: Optional[Any] = None
+    name: str = "local"
+    k: int = 6
+    min_score: float = 0.8
+    min_results: int = 3
+
+    def _local(self, query_vector: Optional[List[float]]) -> Optional[List[Document]]:
+        if query_vector is None:
+            return None
+        hits = self.index.search(query_vector, self.k, self.min_score)
+        if len(hits) >= self.min_results:
+            local_index_lookups.inc(index=self.name, outcome="hit")
+            return [doc for doc, _ in hits]
+        local_index_lookups.inc(index=self.name, outcome="fallback")
+        return None
+
+    def _spool(self, documents: List[Document]) -> List[Document]:
+        if self.spool is not None and documents:
+            self.spool.append(documents)
+        return documents
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # an empty index can't answer, so don't embed the query for it
+        query_vector = self.embeddings.embed_query(query) if len(self.index) else None
+        local = self._local(query_vector)
+        if local is not None:
+            return local
+        return self._spool(
+            self.fallback.invoke(query, {"callbacks": run_manager.get_child()})
+        )
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # counting the rows is a SQLite query, so it runs in a thread too
+        has_rows = await asyncio.to_thread(len, self.index)
+        query_vector = await self.embeddings.aembed_query(query) if has_rows else None
+        # numpy releases the GIL for the scan, so run it off the event loop
+        local = await asyncio.to_thread(self._local, query_vector)
+        if local is not None:
+            return local
+        documents = await self.fallback.ainvoke(
+            query, {"callbacks": run_manager.get_child()}
+        )
+        return self._spool(documents)
+
+
+def ingest(
+    index: VectorIndex,
+    embeddings: Embeddings,
+    documents: Iterable[Document],
+    chunk_size: int = 800,
+    batch_size: int = 256,
+) -> int:
+    """Splits documents into chunks of at most `chunk_size` characters and
+    embeds and indexes the ones the index does not already hold; returns
+    the number of chunks added"""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=20)
+    chunks = splitter.split_documents(list(documents))
+    added = 0
+    for start in range(0, len(chunks), batch_size):
+        batch = chunks[start : start + batch_size]
+        batch = [
+            doc
+            for doc, indexed in zip(
+                batch, index.contains([d.page_content for d in batch])
+            )
+            if not indexed
+        ]
+        if batch:
+            vectors = embeddings.embed_documents([d.page_content for d in batch])
+            added += index.add(batch, vectors)
+    return added
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Add spooled Kay chunks to the local vector indexes"
+    )
+    parser.add_argument(
+        "--index",
+        action="append",
+        choices=KAY_INDEXES,
+        help="index to update (default: all)",
+    )
+    parser.add_argument(
+        "--from-file",
+        action="append",
+        default=[],
+        metavar="JSONL",
+        help="also ingest these files of {page_content, metadata} lines (needs a single --index)",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.from_file and len(args.index or []) != 1:
+        parser.error("--from-file needs exactly one --index")
+
+    # only what ingestion needs; importing app would build the whole service
+    from utils.embeddings import cached_openai_embeddings
+
+    embeddings = cached_openai_embeddings()
+    for name in args.index or KAY_INDEXES:
+        index, spool = open_kay_index(name, embeddings.namespace)
+        for path in args.from_file:
+            started = time.perf_counter()
+            added = ingest(index, embeddings, read_chunks(path))
+            logger.info(
+                "%s: added %d chunks from %s in %.1fs",
+                name,
+                added,
+                path,
+                time.perf_counter() - started,
+            )
+        for path in spool.claim():
+            started = time.perf_counter()
+            added = ingest(index, embeddings, read_chunks(path))
+            os.remove(path)
+            logger.info(
+                "%s: added %d chunks from %s in %.1fs",
+                name,
+                added,
+                path,
+                time.perf_counter() - started,
+            )
+        logger.info("%s: %s", name, index.stats())
+
+
+if __name__ == "__main__":
+    main()